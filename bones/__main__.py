@@ -1,11 +1,148 @@
 # -*- encoding: utf8 -*-
+import os
 import sys
+import json
+import signal
 import logging
 
-from twisted.internet import reactor
+from twisted.internet import reactor, task
 
 from bones.bot import BonesBotFactory
-from bones.config import BaseConfiguration
+from bones.config import (
+    BaseConfiguration,
+    InvalidConfigurationException,
+    duration,
+)
+
+
+log = logging.getLogger(__package__)
+
+
+def findServers(settings):
+    """Scan the configuration file for "server.name" sections."""
+    servers = []
+    for section in settings._conf.sections():
+        tmp = section.split(".")
+        if len(tmp) == 2 and tmp[0].lower() == "server":
+            servers.append(tmp[1])
+    return servers
+
+
+def rehash(settings, factories, allowed=None):
+    """Re-reads the configuration file and applies the changes to the running
+    bot factories. Factories are created for new server sections and shut
+    down for removed ones.
+
+    :param allowed: The names of the servers this process runs, like those
+        a supervisor's worker is started with, or :code:`None` for all of
+        them. Sections of other servers are ignored.
+    """
+    log.info("Reloading configuration from %s", settings.file)
+    try:
+        settings.rehash()
+    except Exception:
+        log.exception("Couldn't reload the configuration, keeping the old one")
+        return
+    servers = findServers(settings)
+    if allowed is not None:
+        servers = [server for server in servers if server in allowed]
+
+    for server, factory in factories.items():
+        if server in servers:
+            try:
+                factory.rehash()
+            except InvalidConfigurationException:
+                log.exception("Couldn't apply the new configuration for %s",
+                              server)
+            except Exception:
+                log.exception("Error while applying the new configuration "
+                              "for %s", server)
+            continue
+        log.info("Server section %s was removed, disconnecting", server)
+        del factories[server]
+        factory.stop()
+
+    for server in servers:
+        if server not in factories:
+            log.info("Server section %s was added, connecting", server)
+            try:
+                factory = BonesBotFactory(settings.server(server))
+            except Exception:
+                log.exception("Couldn't set up the bot for %s", server)
+                continue
+            factories[server] = factory
+            factory.connect()
+
+
+def watchConfiguration(settings, factories, interval, allowed=None):
+    """Reloads the configuration whenever the modification time of the
+    configuration file changes, checking every `interval` seconds."""
+    state = {"mtime": os.path.getmtime(settings.file)}
+
+    def check():
+        try:
+            mtime = os.path.getmtime(settings.file)
+        except OSError:
+            return
+        if mtime != state["mtime"]:
+            state["mtime"] = mtime
+            rehash(settings, factories, allowed)
+
+    watcher = task.LoopingCall(check)
+    watcher.start(interval, now=False)
+    return watcher
+
+
+def logStartupReport(factories, buildTimes, elapsed):
+    """Logs how long it took to set up each bot factory and its modules, and
+    which modules were the slowest to load."""
+    log.info("Started %d bot(s) in %.3f seconds", len(factories), elapsed)
+    for server, factory in sorted(factories.items()):
+        slowest = sorted(factory.moduleLoadTimes.items(),
+                         key=lambda (module, time): time, reverse=True)[:3]
+        log.info(
+            "%s: set up in %.3f seconds, %d module(s) loaded, %d deferred "
+            "until first use%s", server, buildTimes[server],
+            len(factory.modules), len(factory.lazyModules),
+            "; slowest: " + ", ".join("%s (%.3fs)" % m for m in slowest)
+            if slowest else ""
+        )
+
+
+def factoryMetrics(factory):
+    """Returns a dict with the current state of a bot factory and its
+    connection."""
+    client = factory.client
+    connected = bool(client and client.hasSignedOn)
+    metrics = {
+        "connected": connected,
+        "server": repr(factory.currentServer) if factory.currentServer
+        else None,
+        "lag": client.averageLag() if connected else None,
+        "channels": len(client.channels) if connected else 0,
+        "users": len(client.users) if connected else 0,
+        "modules": len(factory.modules),
+        "reconnectAttempts": factory.reconnectAttempts,
+    }
+    # Modules can report metrics of their own, like the database module's
+    # queue and wait times.
+    for module in factory.modules:
+        if hasattr(module, "metrics"):
+            metrics[module.name] = module.metrics()
+    return metrics
+
+
+def reportMetrics(factories, stream):
+    """Writes the metrics of all the bot factories to `stream` as a line of
+    JSON. This is read by the supervisor when running as a worker."""
+    metrics = dict((server, factoryMetrics(factory))
+                   for server, factory in factories.items())
+    try:
+        stream.write(json.dumps(metrics) + "\n")
+        stream.flush()
+    except (IOError, OSError):
+        # The supervisor has gone away.
+        pass
 
 
 def main():
@@ -18,15 +155,15 @@ def main():
         print "Couldn't load logger configuration:"
         print ex.message
         raise SystemExit()
-    log = logging.getLogger(__package__)
+    started = reactor.seconds()
     settings = BaseConfiguration(sys.argv[1])
 
-    # Scan the configuration file for "server.name" sections.
-    servers = []
-    for section in settings._conf.sections():
-        tmp = section.split(".")
-        if len(tmp) == 2 and tmp[0].lower() == "server":
-            servers.append(tmp[1])
+    servers = findServers(settings)
+    # The supervisor starts each worker with the servers it should run.
+    allowed = None
+    if len(sys.argv) > 2:
+        allowed = sys.argv[2:]
+        servers = [server for server in servers if server in allowed]
 
     # If the user hasn't updated his configuration file to support the
     # multi-server change, we won't find any server sections.
@@ -38,9 +175,34 @@ https://github.com/404d/Bones-IRCBot/pull/13""")
         raise SystemExit
 
     # Spin up a factory for each server section and tell it to connect.
+    factories = {}
+    buildTimes = {}
     for server in servers:
+        factoryStarted = reactor.seconds()
         botFactory = BonesBotFactory(settings.server(server))
         botFactory.connect()
+        factories[server] = botFactory
+        buildTimes[server] = reactor.seconds() - factoryStarted
+    logStartupReport(factories, buildTimes, reactor.seconds() - started)
+
+    if os.environ.get("BONES_METRICS_FD"):
+        stream = os.fdopen(int(os.environ["BONES_METRICS_FD"]), "w")
+        interval = float(os.environ.get("BONES_METRICS_INTERVAL", "30"))
+        task.LoopingCall(reportMetrics, factories, stream) \
+            .start(interval, now=False)
+
+    # The configuration is reloaded on SIGHUP, and if `configWatchInterval`
+    # is set, whenever the file is changed.
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(
+            signal.SIGHUP,
+            lambda signum, frame: reactor.callFromThread(
+                rehash, settings, factories, allowed)
+        )
+    interval = duration(settings.get("bot", "configWatchInterval",
+                                     default="0"))
+    if interval > 0:
+        watchConfiguration(settings, factories, interval, allowed)
     reactor.run()
 
 if __name__ == "__main__":
@@ -1,28 +1,61 @@
 # -*- encoding: utf8 -*-
+import os
 import re
+import ast
+import sys
+import inspect
+import pkgutil
+import threading
+import gzip
+import json
+import random
 import logging
 import logging.config
 import urllib2
+from collections import deque
 
 from twisted.words.protocols import irc
-from twisted.internet import defer, protocol, reactor
+from twisted.internet import defer, protocol, reactor, task, threads
 
 import bones.event
+from bones.config import (
+    InvalidConfigurationException,
+    Option,
+    Schema,
+    boolean,
+    duration,
+    integer,
+    stringlist,
+)
 
 logging.addLevelName(2, "RAW")
 log = logging.getLogger(__name__)
 log.raw = lambda *args: log.log(2, *args)
 
 
+# The instances of the modules listed in `sharedModules`, which are shared
+# by every bot factory in the process that loads them.
+sharedModules = {}
+
+
 def removeEmptyElementsFromList(l):
     return [e for e in l if e]
 
 
-class InvalidBonesModuleException(Exception):
-    pass
+def encodeStrings(data, encoding="utf-8"):
+    """Returns a copy of the given JSON data where all unicode strings have
+    been encoded, as the rest of the bot works with byte strings."""
+    if isinstance(data, unicode):
+        return data.encode(encoding)
+    if isinstance(data, list):
+        return [encodeStrings(e, encoding) for e in data]
+    if isinstance(data, dict):
+        return dict((encodeStrings(k, encoding), encodeStrings(v, encoding))
+                    for k, v in data.items())
+    return data
 
 
-class InvalidConfigurationException(Exception):
+class InvalidBonesModuleException(Exception):
     pass
 
 
@@ -34,7 +67,404 @@ class BonesModuleAlreadyLoadedException(Exception):
     pass
 
 
+def reconnectDelay(attempts, base, cap):
+    """Returns the number of seconds to wait before the given reconnect
+    attempt. The delay doubles with each attempt, starting at `base` and
+    never going above `cap`. The first attempt is immediate, and a random
+    jitter of up to half the delay is subtracted so that many bots that lost
+    their connection at the same time don't reconnect at the same time.
+
+    :param attempts: The number of failed attempts so far.
+    :type attempts: int
+    :param base: The delay before the second attempt, in seconds.
+    :type base: float
+    :param cap: The maximum delay, in seconds.
+    :type cap: float
+    """
+    if attempts <= 0:
+        return 0.0
+    delay = min(cap, base * 2 ** min(attempts - 1, 32))
+    return random.uniform(delay / 2.0, delay)
+
+
+def scanModuleHandlers(path):
+    """Finds the events and triggers that the specified module handles by
+    reading its source code, without importing it.
+
+    Only modules that inherit directly from :class:`Module` and only handle
+    triggers and events defined in :mod:`bones.event` can be scanned, as
+    anything else would need the module to be imported.
+
+    :param path: The Python dot-notation path to the module.
+    :type path: str.
+
+    :returns: A list of the event identifiers the module handles, or
+        :code:`None` if the module can't be scanned.
+    """
+    tmppath = path.split(".")
+    package = ".".join(tmppath[:-1])
+    name = tmppath[-1]
+    if package in sys.modules:
+        # It has been imported already, so there's nothing left to save.
+        return None
+    try:
+        loader = pkgutil.find_loader(package)
+        filename = loader.get_filename()
+    except Exception:
+        return None
+    if not filename or not filename.endswith(".py"):
+        return None
+    try:
+        with open(filename) as f:
+            tree = ast.parse(f.read(), filename)
+    except (IOError, SyntaxError):
+        return None
+
+    for klass in tree.body:
+        if isinstance(klass, ast.ClassDef) and klass.name == name:
+            break
+    else:
+        return None
+
+    def dotted(node):
+        if isinstance(node, ast.Name):
+            return node.id
+        if isinstance(node, ast.Attribute):
+            parent = dotted(node.value)
+            return parent and "%s.%s" % (parent, node.attr)
+        return None
+
+    if [dotted(base) for base in klass.bases] not in (
+            ["Module"], ["bones.bot.Module"]):
+        return None
+
+    events = []
+    for method in klass.body:
+        if not isinstance(method, ast.FunctionDef):
+            continue
+        for decorator in method.decorator_list:
+            if not isinstance(decorator, ast.Call) or \
+                    dotted(decorator.func) not in ("bones.event.handler",
+                                                   "handler"):
+                continue
+            for keyword in decorator.keywords:
+                if keyword.arg == "trigger" and \
+                        isinstance(keyword.value, ast.Str):
+                    events.append("<Trigger: %s>" % keyword.value.s.lower())
+                elif keyword.arg == "event":
+                    event = dotted(keyword.value) or ""
+                    if not event.startswith("bones.event."):
+                        return None
+                    event = getattr(bones.event, event[12:], None)
+                    if event is None:
+                        return None
+                    events.append(event)
+                else:
+                    return None
+    return events
+
+
+class LazyImport(object):
+    """Stands in for an expensive optional dependency, and imports it the
+    first time it is called or one of its attributes is used.
+
+    Example::
+
+        BeautifulSoup = LazyImport("bs4", "BeautifulSoup")
+        if BeautifulSoup.available:
+            soup = BeautifulSoup(html)
+
+    :param module: The name of the module to import.
+    :type module: str
+    :param name: The name of the object to import from the module, if not
+        the module itself.
+    :type name: str
+    """
+    def __init__(self, module, name=None):
+        self.module = module
+        self.name = name
+        self._object = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        """Whether the module can be imported, checked without importing
+        it."""
+        if self._object is not None:
+            return True
+        try:
+            return pkgutil.find_loader(self.module) is not None
+        except ImportError:
+            return False
+
+    def load(self):
+        """Imports and returns the object."""
+        if self._object is None:
+            with self._lock:
+                if self._object is None:
+                    obj = __import__(self.module,
+                                     fromlist=[self.name or "__name__"])
+                    if self.name:
+                        obj = getattr(obj, self.name)
+                    self._object = obj
+        return self._object
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+class ServerAddress():
+    """A single entry in a server's failover list, along with the
+    connection history used to pick which entry to connect to next.
+
+    :param host: The host name or IP address of the server.
+    :type host: str
+    :param port: The port to connect to.
+    :type port: int
+    :param ssl: Whether to use SSL when connecting.
+    :type ssl: bool
+    :param index: The position of the entry in the configured list.
+    :type index: int
+
+    .. attribute:: failures
+
+        The number of connection attempts that have failed in a row.
+
+    .. attribute:: latency
+
+        A moving average of the round-trip time to the server in seconds,
+        or :code:`None` if it hasn't been measured yet.
+    """
+
+    #: Failures older than this many seconds are forgotten.
+    failureMemory = 3600.0
+    #: The weight given to new latency samples in the moving average.
+    latencyWeight = 0.3
+
+    def __init__(self, host, port, ssl=False, index=0):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.index = index
+        self.failures = 0
+        self.lastFailure = None
+        self.latency = None
+
+    def __repr__(self):
+        host = self.host
+        if ":" in host:
+            host = "[%s]" % host
+        return "%s:%s%i" % (host, "+" if self.ssl else "", self.port)
+
+    def recordFailure(self):
+        self.failures += 1
+        self.lastFailure = reactor.seconds()
+
+    def recordSuccess(self):
+        self.failures = 0
+        self.lastFailure = None
+
+    def recordLatency(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.latencyWeight * (latency - self.latency)
+
+    def recentFailures(self):
+        if self.lastFailure is None or \
+                reactor.seconds() - self.lastFailure > self.failureMemory:
+            return 0
+        return self.failures
+
+    def sortKey(self):
+        """Healthy servers go first, then the fastest ones, then the ones that
+        failed the longest time ago, and finally the configured order."""
+        return (
+            self.recentFailures(),
+            self.latency is None,
+            self.latency,
+            self.lastFailure,
+            self.index,
+        )
+
+    @classmethod
+    def parse(cls, entry, defaultPort, defaultSSL, index=0):
+        """Parses a server list entry on the form :code:`host`,
+        :code:`host:port` or :code:`host:+port`, where :code:`+` means that
+        SSL should be used. IPv6 addresses needs to be enclosed in brackets
+        if a port is given."""
+        port = None
+        if entry.startswith("["):
+            host, _, rest = entry[1:].partition("]")
+            if rest.startswith(":"):
+                port = rest[1:]
+        elif entry.count(":") == 1:
+            host, port = entry.split(":")
+        else:
+            host = entry
+        ssl = defaultSSL
+        if port and port.startswith("+"):
+            ssl = True
+            port = port[1:]
+        if port:
+            try:
+                port = int(port)
+            except ValueError:
+                raise InvalidConfigurationException(
+                    "Invalid port in server address \"%s\"" % entry
+                )
+        else:
+            port = defaultPort
+        return cls(host, port, ssl, index)
+
+
+class UserInfoService():
+    """Looks up and caches the username, hostname, account and real name of
+    users using :code:`WHO` queries, or :code:`WHOX` queries if the server
+    supports them. Information is cached on the :class:`~bones.event.User`
+    instances for :attr:`~BonesBotFactory.whoCacheTTL` seconds.
+
+    Queries are sent one at a time. Looking up a user that shares a channel
+    with the bot queries the whole channel, which fills the cache for
+    everyone in it, and lookups for a target that is already being queried
+    share the query that is in flight.
+
+    Each :class:`BonesBot` has its own instance of this service as
+    :attr:`BonesBot.userInfo`. The methods of this class return
+    :class:`~twisted.internet.defer.Deferred` instances and needs to be called
+    from the reactor thread; event handlers may use
+    :func:`twisted.internet.threads.blockingCallFromThread` to call them.
+    """
+
+    #: The WHOX token used to recognize replies to our own queries.
+    token = "166"
+    #: The number of seconds to wait for the end of a WHO reply.
+    timeout = 60
+
+    def __init__(self, client):
+        self.client = client
+        self._queue = deque()
+        self._inflight = {}
+        self._current = None
+        self._timeout = None
+        self._channelsUpdated = {}
+
+    def _isFresh(self, updated):
+        ttl = self.client.factory.config.whoCacheTTL
+        return updated is not None and reactor.seconds() - updated < ttl
+
+    def lookup(self, nickname):
+        """Returns a Deferred that fires with the
+        :class:`~bones.event.User` instance for the given nickname once its
+        information is known, or with :code:`None` if the user doesn't
+        exist. Fires right away if the information is cached."""
+        user = self.client.users.get(nickname)
+        if user and self._isFresh(user.infoUpdated):
+            return defer.succeed(user)
+        target = nickname
+        if user and user.channels:
+            target = user.channels[0].name
+        d = self.query(target)
+        d.addCallback(lambda result: self.client.users.get(nickname))
+        return d
+
+    def channel(self, channel):
+        """Returns a Deferred that fires with the list of
+        :class:`~bones.event.User` instances in the given channel once the
+        information for all of them is known."""
+        name = getattr(channel, "name", channel)
+        if self._isFresh(self._channelsUpdated.get(name.lower())):
+            return defer.succeed(list(self.client.get_channel(name).users))
+        return self.query(name)
+
+    def query(self, target):
+        """Sends a WHO query for the given target, unless one is already
+        queued or in flight, and returns a Deferred that fires with the list
+        of users in the reply."""
+        key = target.lower()
+        d = defer.Deferred()
+        if key in self._inflight:
+            self._inflight[key]["deferreds"].append(d)
+            return d
+        self._inflight[key] = {"target": target, "deferreds": [d],
+                               "users": []}
+        self._queue.append(key)
+        if self._current is None:
+            self._sendNext()
+        return d
+
+    def _sendNext(self):
+        if not self._queue:
+            self._current = None
+            return
+        self._current = self._queue.popleft()
+        target = self._inflight[self._current]["target"]
+        if self.client.supported.hasFeature("WHOX"):
+            self.client.sendLine("WHO %s %%tcuhnfar,%s" % (target, self.token))
+        else:
+            self.client.sendLine("WHO %s" % target)
+        self._timeout = reactor.callLater(self.timeout, self.endOfReply,
+                                          target)
+
+    def reply(self, channel, username, hostname, nickname, flags, account,
+              realname):
+        """Stores the information from a single WHO or WHOX reply line."""
+        user = self.client.users.get(nickname)
+        if user is None:
+            user = self.client.create_user(
+                "%s!%s@%s" % (nickname, username, hostname)
+            )
+        user.username = username
+        user.hostname = hostname
+        user.realname = realname
+        if account is not None:
+            user.account = account if account != "0" else None
+        user.infoUpdated = reactor.seconds()
+        user.stale = False
+        if self._current is not None:
+            self._inflight[self._current]["users"].append(user)
+
+    def endOfReply(self, target):
+        """Called at the end of a WHO reply. Fires the Deferreds of the
+        query and sends the next one."""
+        if self._current is None or target.lower() != self._current:
+            return
+        if self._timeout and self._timeout.active():
+            self._timeout.cancel()
+        self._timeout = None
+        query = self._inflight.pop(self._current)
+        if target[0] in self.client.channel_types:
+            self._channelsUpdated[self._current] = reactor.seconds()
+        self._sendNext()
+        for d in query["deferreds"]:
+            d.callback(query["users"])
+
+    def connectionLost(self, reason):
+        """Fails all queued queries."""
+        if self._timeout and self._timeout.active():
+            self._timeout.cancel()
+        self._timeout = None
+        self._current = None
+        self._queue.clear()
+        inflight = self._inflight
+        self._inflight = {}
+        self._channelsUpdated = {}
+        for query in inflight.values():
+            for d in query["deferreds"]:
+                d.errback(reason)
+
+
 class BonesBot(irc.IRCClient):
+    # A quit message on the form "server1.example.net server2.example.net",
+    # which the server sends for every user lost in a netsplit.
+    reNetsplit = re.compile(r"^([\w\-\*]+(?:\.[\w\-\*]+)+) "
+                            r"([\w\-\*]+(?:\.[\w\-\*]+)+)$")
+
     def __init__(self, *args, **kwargs):
         self.channels = {}
         self.users = {}
@@ -48,6 +478,31 @@ class BonesBot(irc.IRCClient):
             "never": [],
         }
         self.prefixes = [("o", "@"), ("v", "+")]
+        self.hasSignedOn = False
+        # The NAMES replies that are currently being received, as a
+        # dictionary of channel name to the set of users seen so far.
+        self._namesSync = {}
+        # Netsplit and netjoin batches that are still being collected, keyed
+        # by the (server, server) pair of the split, the users that are
+        # gone because of a split, keyed by nickname, and the users in the
+        # netjoin batches, mapped to the key of their batch.
+        self._pendingSplits = {}
+        self._pendingJoins = {}
+        self._splitUsers = {}
+        self._rejoiningUsers = {}
+        self.userInfo = UserInfoService(self)
+        # Outgoing JOIN lines waiting to be sent, and the delayed call that
+        # will send the next one.
+        self._joinQueue = []
+        self._joinQueueEmptying = None
+        # Lag meter state. The bot pings the server every `pingInterval`
+        # seconds and keeps the round-trip times of the last `lagSamples`
+        # pings.
+        self.lag = None
+        self.lagHistory = deque()
+        self._lagPing = None
+        self._lagTimeout = None
+        self._staleStateCall = None
 
     def get_channel(self, name):
         """Returns the Channel object for the given channel."""
@@ -69,6 +524,7 @@ class BonesBot(irc.IRCClient):
         elif semiMask:
             self.users[name].username = semiMask[0]
             self.users[name].hostname = semiMask[1]
+            self.users[name].stale = False
         return self.users[name]
 
     def create_user(self, target):
@@ -84,6 +540,84 @@ class BonesBot(irc.IRCClient):
             raise Exception(error.format(target))
         return self.users[name]
 
+    def dumpState(self):
+        """Returns the channel and user registry of this connection as a
+        dictionary that can be serialized to JSON. The dictionary may be
+        passed to :meth:`restoreState` to recreate the registry."""
+        users = {}
+        channels = {}
+        for name, channel in self.channels.items():
+            modes = {}
+            for mode, value in channel.modes.items():
+                if isinstance(value, set):
+                    value = sorted(value)
+                modes[mode] = value
+            topic = None
+            if channel.topic:
+                topic = [channel.topic.text, channel.topic.user.mask]
+            channels[name] = {
+                "users": [user.nickname for user in channel.users],
+                "modes": modes,
+                "topic": topic,
+            }
+            for user in channel.users:
+                users[user.nickname] = [user.username, user.hostname]
+        return {
+            "version": 1,
+            "tag": self.tag,
+            "channels": channels,
+            "users": users,
+        }
+
+    def restoreState(self, state):
+        """Fills the channel and user registry from a dictionary returned by
+        :meth:`dumpState`. All restored channels and users are marked as
+        stale until the server confirms them."""
+        if not state or state.get("version") != 1:
+            return
+        for nickname, (username, hostname) in state["users"].items():
+            mask = nickname
+            if username and hostname:
+                mask = "%s!%s@%s" % (nickname, username, hostname)
+            if nickname not in self.users:
+                self.users[nickname] = bones.event.User(mask, self)
+                self.users[nickname].stale = True
+        for name, data in state["channels"].items():
+            channel = self.get_channel(name)
+            channel.stale = True
+            for nickname in data["users"]:
+                user = self.users.get(nickname)
+                if user is None:
+                    continue
+                if user not in channel.users:
+                    channel.users.append(user)
+                if channel not in user.channels:
+                    user.channels.append(channel)
+            for mode, value in data["modes"].items():
+                if isinstance(value, list):
+                    value = set(value)
+                channel.modes[mode] = value
+            if data["topic"]:
+                channel.topic = bones.event.Topic(
+                    data["topic"][0],
+                    bones.event.User(data["topic"][1], self)
+                )
+        log.info("{%s} Restored %i channels and %i users from the state "
+                 "snapshot.", self.tag, len(state["channels"]),
+                 len(state["users"]))
+
+    def removeStaleState(self):
+        """Removes all channels that are still stale, and all stale users that
+        aren't in any channel. Called a while after signing on, as any channel
+        that hasn't been confirmed by then wasn't rejoined."""
+        for name in [name for name, channel in self.channels.items()
+                     if channel.stale]:
+            log.debug("{%s} Removing stale channel %s", self.tag, name)
+            self.remove_channel(name)
+        for nickname in [nickname for nickname, user in self.users.items()
+                         if user.stale and not user.channels]:
+            del self.users[nickname]
+
     def remove_channel(self, name):
         # TODO: Remove the channel from all user instances.
         if name not in self.channels:
@@ -131,19 +665,30 @@ class BonesBot(irc.IRCClient):
         # We've connected to the server, reset this so that when we disconnect
         # we'll immediately try to reconnect.
         self.factory.reconnectAttempts = 0
+        self.hasSignedOn = True
+        if self.factory.currentServer:
+            self.factory.currentServer.recordSuccess()
 
         # InspIRCd mode that shows "user :is a bot" in whois.
-        if self.factory.settings.get("server", "setBot", default="false") \
-                == "true":
+        if self.factory.config.setBot:
             self.mode(self.nickname, True, "B")
 
         event = bones.event.BotSignedOnEvent(self)
         bones.event.fire(self.tag, event)
         log.info("Signed on as %s.", self.nickname)
 
+        # Anything restored from the state snapshot that hasn't been confirmed
+        # by the server after a while is gone.
+        if self.factory.config.stateTimeout:
+            self._staleStateCall = reactor.callLater(
+                self.factory.config.stateTimeout, self.removeStaleState
+            )
+
         # Join all the channels defined in our config.
-        for channel in self.factory.channels:
-            self.join(channel)
+        self.joinChannels([
+            (channel, self.factory.channelKeys.get(channel))
+            for channel in self.factory.channels
+        ])
 
     def created(self, when):
         log.debug(
@@ -294,6 +839,10 @@ class BonesBot(irc.IRCClient):
         user = self.get_user(mask)
         if not user:
             user = self.create_user(mask)
+        data = self.reNetsplit.match(quitMessage)
+        if data:
+            self._netsplitQuit(user, (data.group(1), data.group(2)))
+            return
         log.debug(
             "User %s quit (Reason: %s)",
             user, quitMessage
@@ -407,24 +956,286 @@ class BonesBot(irc.IRCClient):
             self.sendLine("MODE %s" % channel.name)
         else:
             self.sendLine("MODE #%s" % channel.name)
+        if self.factory.config.whoOnJoin:
+            self.userInfo.channel(channel)
 
         event = bones.event.BotJoinEvent(self, channel)
         bones.event.fire(self.tag, event)
 
-    def join(self, channel):
-        event = bones.event.BotPreJoinEvent(self, channel)
+    def join(self, channel, key=None):
+        """Joins a single channel. This is a shorthand for
+        :meth:`joinChannels`.
 
+        :param channel: The name of the channel to join.
+        :type channel: str.
+        :param key: The key needed to join the channel, if any.
+        :type key: str.
+        """
+        self.joinChannels([(channel, key)])
+
+    def joinChannels(self, channels):
+        """Joins all the given channels using as few :code:`JOIN` lines as
+        possible. The channels are split into batches that fit within the
+        protocol line length limit, and one
+        :class:`~bones.event.BotPreJoinEvent` is fired for each batch. The
+        batches that aren't cancelled are sent to the server one at a time,
+        :attr:`~bones.bot.BonesBotFactory.joinDelay` seconds apart.
+
+        :param channels: The channels to join, either as channel names or as
+            (name, key) tuples.
+        :type channels: list
+        """
         def doJoin(thisEvent):
-            if thisEvent.isCancelled is False:
-                irc.IRCClient.join(thisEvent.client, thisEvent.channel)
+            if thisEvent.isCancelled is False and thisEvent.channels:
+                reactor.callFromThread(
+                    self._queueJoin, thisEvent.channels, thisEvent.keys
+                )
+
+        for names, keys in self._buildJoinBatches(channels):
+            event = bones.event.BotPreJoinEvent(self, names, keys)
+            bones.event.fire(self.tag, event, callback=doJoin)
+
+    def _buildJoinBatches(self, channels):
+        """Splits the given channels into (names, keys) batches that each fit
+        in a single :code:`JOIN` line. Channels with keys are put first, as
+        the server pairs the keys with the channels in the order they are
+        given."""
+        keyed = []
+        unkeyed = []
+        for channel in channels:
+            if isinstance(channel, tuple):
+                name, key = channel
+            else:
+                name, key = channel, None
+            if name[0] not in irc.CHANNEL_PREFIXES:
+                name = "#" + name
+            if key:
+                keyed.append((name, key))
+            else:
+                unkeyed.append((name, None))
+
+        maxTargets = None
+        targmax = self.supported.getFeature("TARGMAX") \
+            if getattr(self, "supported", None) else None
+        if targmax:
+            maxTargets = targmax.get("JOIN")
+
+        batches = []
+        names = []
+        keys = {}
+        length = len("JOIN ")
+        for name, key in keyed + unkeyed:
+            # The separating comma, and for keyed channels the key plus its
+            # separator.
+            added = len(name) + (1 if names else 0)
+            if key:
+                added += len(key) + 1
+            if names and (length + added > irc.MAX_COMMAND_LENGTH - 2 or
+                          (maxTargets and len(names) >= maxTargets)):
+                batches.append((names, keys))
+                names = []
+                keys = {}
+                length = len("JOIN ")
+                added = len(name) + (len(key) + 1 if key else 0)
+            names.append(name)
+            if key:
+                keys[name] = key
+            length += added
+        if names:
+            batches.append((names, keys))
+        return batches
+
+    def _queueJoin(self, channels, keys):
+        """Adds the JOIN lines for the given channels to the join queue and
+        starts emptying it if it isn't already being emptied."""
+        for names, batchKeys in self._buildJoinBatches(
+                [(name, keys.get(name)) for name in channels]):
+            line = "JOIN %s" % ",".join(names)
+            if batchKeys:
+                line += " %s" % ",".join(
+                    [batchKeys[name] for name in names if name in batchKeys]
+                )
+            self._joinQueue.append(line)
+        if not self._joinQueueEmptying:
+            self._sendJoinQueue()
+
+    def _sendJoinQueue(self):
+        if self._joinQueue:
+            self.sendLine(self._joinQueue.pop(0))
+            self._joinQueueEmptying = reactor.callLater(
+                self.factory.config.joinDelay, self._sendJoinQueue
+            )
+        else:
+            self._joinQueueEmptying = None
+
+    def averageLag(self):
+        """Returns the average round-trip time of the last pings sent to the
+        server, in seconds as a float, or :code:`None` if the server hasn't
+        replied to any pings yet."""
+        if not self.lagHistory:
+            return None
+        return sum(self.lagHistory) / len(self.lagHistory)
+
+    def _sendHeartbeat(self):
+        """Pings the server and starts waiting for the reply. If the server
+        doesn't reply within :attr:`~bones.bot.BonesBotFactory.pingTimeout`
+        seconds, the connection is considered dead and is dropped."""
+        if self._lagPing is not None:
+            # We're still waiting for the previous reply.
+            return
+        token = "LAG%d" % (reactor.seconds() * 1000)
+        self._lagPing = (token, reactor.seconds())
+        self.sendLine("PING :%s" % token)
+        self._lagTimeout = reactor.callLater(self.factory.config.pingTimeout,
+                                             self._lagTimedOut)
+
+    def irc_PONG(self, prefix, params):
+        if self._lagPing is None or params[-1] != self._lagPing[0]:
+            return
+        self.lag = reactor.seconds() - self._lagPing[1]
+        self.lagHistory.append(self.lag)
+        if self.factory.currentServer:
+            self.factory.currentServer.recordLatency(self.lag)
+        self._lagPing = None
+        if self._lagTimeout and self._lagTimeout.active():
+            self._lagTimeout.cancel()
+        self._lagTimeout = None
+        log.debug("{%s} Lag: %.3fs (average %.3fs)", self.tag, self.lag,
+                  self.averageLag())
+
+    def _lagTimedOut(self):
+        self._lagTimeout = None
+        log.warning(
+            "{%s} Server didn't reply to PING within %i seconds, dropping "
+            "the connection.",
+            self.tag, self.factory.config.pingTimeout
+        )
+        # Try another server right away, as this one seems to be hanging.
+        if self.factory.currentServer:
+            self.factory.currentServer.recordFailure()
+        self.factory.reconnectAttempts = 0
+        self.transport.abortConnection()
+
+    def connectionMade(self):
+        self.heartbeatInterval = self.factory.config.pingInterval
+        self.lagHistory = deque(maxlen=self.factory.config.lagSamples)
+        irc.IRCClient.connectionMade(self)
+
+    def connectionLost(self, reason):
+        irc.IRCClient.connectionLost(self, reason)
+        self._joinQueue = []
+        if self._joinQueueEmptying and self._joinQueueEmptying.active():
+            self._joinQueueEmptying.cancel()
+        self._joinQueueEmptying = None
+        if self._lagTimeout and self._lagTimeout.active():
+            self._lagTimeout.cancel()
+        self._lagTimeout = None
+        self._lagPing = None
+        if self._staleStateCall and self._staleStateCall.active():
+            self._staleStateCall.cancel()
+        self._staleStateCall = None
+        for batch in self._pendingSplits.values() + \
+                self._pendingJoins.values():
+            if batch["call"].active():
+                batch["call"].cancel()
+        self._pendingSplits = {}
+        self._pendingJoins = {}
+        self._splitUsers = {}
+        self._rejoiningUsers = {}
+        self.userInfo.connectionLost(reason)
+
+    def _netsplitQuit(self, user, servers):
+        """Adds a user that quit because of a netsplit to the batch for that
+        split. The batch is fired as a single
+        :class:`~bones.event.NetsplitEvent` once no more users have quit
+        for :attr:`~bones.bot.BonesBotFactory.netsplitWindow` seconds."""
+        split = self._pendingSplits.get(servers)
+        if split is None:
+            log.info("{%s} Netsplit between %s and %s", self.tag,
+                     servers[0], servers[1])
+            split = self._pendingSplits[servers] = {
+                "users": [],
+                "call": reactor.callLater(self.factory.config.netsplitWindow,
+                                          self._flushNetsplit, servers),
+            }
+        else:
+            split["call"].reset(self.factory.config.netsplitWindow)
+        split["users"].append(user)
+
+    def _flushNetsplit(self, servers):
+        split = self._pendingSplits.pop(servers)
+        now = reactor.seconds()
+        self._expireSplitUsers(now)
+        log.debug("{%s} %i users lost in the netsplit between %s and %s",
+                  self.tag, len(split["users"]), servers[0], servers[1])
+
+        def netsplitCleanup(event):
+            for user in event.users:
+                self._splitUsers[user.nickname] = (event.servers, now)
+                for channel in list(user.channels):
+                    channel._remove_user(user)
+                if self.users.get(user.nickname) is user:
+                    del self.users[user.nickname]
+        event = bones.event.NetsplitEvent(self, servers, split["users"])
+        bones.event.fire(self.tag, event, callback=netsplitCleanup)
+
+    def _netjoin(self, user, channel, servers):
+        """Adds a user that came back from a netsplit to the batch of joins
+        for that split. The batch is fired as a single
+        :class:`~bones.event.NetjoinEvent` once no more users have joined for
+        :attr:`~bones.bot.BonesBotFactory.netsplitWindow` seconds."""
+        batch = self._pendingJoins.get(servers)
+        if batch is None:
+            batch = self._pendingJoins[servers] = {
+                "joins": [],
+                "call": reactor.callLater(self.factory.config.netsplitWindow,
+                                          self._flushNetjoin, servers),
+            }
+        else:
+            batch["call"].reset(self.factory.config.netsplitWindow)
+        batch["joins"].append((user, channel))
+        self._rejoiningUsers[user] = servers
+
+    def _flushNetjoin(self, servers):
+        batch = self._pendingJoins.pop(servers)
+        users = []
+        channels = {}
+        for user, channel in batch["joins"]:
+            if self._rejoiningUsers.pop(user, None) is not None:
+                users.append(user)
+            channels.setdefault(channel, []).append(user)
+            if channel not in user.channels:
+                user.channels.append(channel)
+            if user not in channel.users:
+                channel.users.append(user)
+        log.info("{%s} Netjoin between %s and %s, %i users rejoined",
+                 self.tag, servers[0], servers[1], len(users))
+        event = bones.event.NetjoinEvent(self, servers, users, channels)
+        bones.event.fire(self.tag, event)
 
-        bones.event.fire(self.tag, event, callback=doJoin)
+    def _expireSplitUsers(self, now):
+        timeout = self.factory.config.netsplitTimeout
+        for nickname in [nickname for nickname, (servers, when)
+                         in self._splitUsers.items() if now - when > timeout]:
+            del self._splitUsers[nickname]
 
     def userJoined(self, mask, channel):
         channel = self.get_channel(channel)
         user = self.get_user(mask)
         if not user:
             user = self.create_user(mask)
+        # A user is only part of one netjoin; once it has been fired, their
+        # joins are ordinary joins again.
+        split = self._splitUsers.pop(user.nickname, None)
+        if split and reactor.seconds() - split[1] <= \
+                self.factory.config.netsplitTimeout:
+            self._netjoin(user, channel, split[0])
+            return
+        # The rest of the channels they rejoin in the same netjoin.
+        servers = self._rejoiningUsers.get(user)
+        if servers is not None:
+            self._netjoin(user, channel, servers)
+            return
         log.debug("Event userJoined: %s %s", user, channel)
         event = bones.event.UserJoinEvent(self, channel, user)
         user = event.user
@@ -502,10 +1313,27 @@ class BonesBot(irc.IRCClient):
         if len(params) >= 4:
             args = params[3:]
         log.debug("RPL_CHANNELMODEIS: %s %s %s", channel, modes, args)
-        self.get_channel(channel)._set_modes(modes[1:], args, True)
+        channel = self.get_channel(channel)
+        # The reply contains every mode that isn't a list or prefix mode, so
+        # any such mode we know of that isn't in it is no longer set.
+        listModes = [m for m, p in self.prefixes]
+        listModes.extend(self.channel_modes["list"])
+        for mode in channel.modes.keys():
+            if mode not in listModes:
+                del channel.modes[mode]
+        channel._set_modes(modes[1:], list(args), True)
 
     def irc_RPL_NAMREPLY(self, prefix, params):
         channel = self.get_channel(params[2])
+        if channel.name not in self._namesSync:
+            # This is the first reply for this channel. If the channel was
+            # restored from a snapshot, its prefix modes will be replaced by
+            # the ones in the replies.
+            self._namesSync[channel.name] = set()
+            if channel.stale:
+                for mode, p in self.prefixes:
+                    channel.modes.pop(mode, None)
+        seen = self._namesSync[channel.name]
         nicks = params[3].split(" ")
         modes = []
         args = []
@@ -521,8 +1349,12 @@ class BonesBot(irc.IRCClient):
                 user = self.get_user(nickname)
                 if not user:
                     user = self.create_user(nickname)
-                user.channels.append(channel)
-                channel.users.append(user)
+                user.stale = False
+                seen.add(user)
+                if channel not in user.channels:
+                    user.channels.append(channel)
+                if user not in channel.users:
+                    channel.users.append(user)
                 if mode:
                     for prefixMode in mode:
                         modes.append(prefixMode)
@@ -533,13 +1365,38 @@ class BonesBot(irc.IRCClient):
         if modes:
             channel._set_modes("".join(modes), args, True)
 
+    def irc_RPL_ENDOFNAMES(self, prefix, params):
+        channel = self.get_channel(params[1])
+        seen = self._namesSync.pop(channel.name, set())
+        # Anyone we thought was in the channel but wasn't in the replies has
+        # left while we weren't looking.
+        for user in [user for user in channel.users if user not in seen]:
+            log.debug("Removing %s from %s, not in NAMES", user, channel)
+            channel._remove_user(user)
+        channel.stale = False
+
+    def irc_RPL_WHOREPLY(self, prefix, params):
+        # <me> <channel> <user> <host> <server> <nick> <flags> :<hops> <real>
+        realname = params[7].split(" ", 1)[-1] if len(params) > 7 else None
+        self.userInfo.reply(params[1], params[2], params[3], params[5],
+                            params[6], None, realname)
+
+    def irc_354(self, prefix, params):
+        # WHOX reply to "%tcuhnfar":
+        # <me> <token> <channel> <user> <host> <nick> <flags> <account> <real>
+        if len(params) < 9 or params[1] != self.userInfo.token:
+            return
+        self.userInfo.reply(*params[2:9])
+
+    def irc_RPL_ENDOFWHO(self, prefix, params):
+        self.userInfo.endOfReply(params[1])
+
     def irc_INVITE(self, prefix, params):
         event = bones.event.BotInviteEvent(self, params[1],
                                            self.get_user(prefix))
 
         def onInviteJoin(event):
-            if self.factory.settings.get("bot", "joinOnInvite",
-                                         default="false") != "true":
+            if not self.factory.config.joinOnInvite:
                 return
             if event.isCancelled:
                 log.debug("Got invited to '%s' on {%s} by %s, but the event "
@@ -676,6 +1533,27 @@ class BonesBotFactory(protocol.ClientFactory):
 
         The release name of the current bot version. Sent to clients
         as a part of a :code:`CTCP VERSION` reply.
+
+    .. attribute:: config
+
+        A :class:`~bones.config.CompiledConfiguration` with the typed values
+        of the options in :attr:`configSchema`.
+
+    .. attribute:: servers
+
+        A list of :class:`ServerAddress` instances, one for each entry in
+        the server section's :code:`host` option.
+
+    .. attribute:: currentServer
+
+        The :class:`ServerAddress` that the bot is currently connected or
+        connecting to.
+
+    .. attribute:: state
+
+        The last known channel and user registry, as returned by
+        :meth:`BonesBot.dumpState`. New connections start out with this
+        registry, marked as stale until the server confirms it.
     """
 
     sourceURL = "https://github.com/404d/Bones-IRCBot"
@@ -685,6 +1563,41 @@ class BonesBotFactory(protocol.ClientFactory):
 
     protocol = BonesBot
 
+    #: The options used by the bot core, compiled into :attr:`config`.
+    configSchema = Schema(
+        nicknames=Option("bot", "nickname", stringlist, []),
+        username=Option("bot", "username"),
+        realname=Option("bot", "realname"),
+        modules=Option("bot", "modules", stringlist, []),
+        lazyModules=Option("bot", "lazyModules", boolean, False),
+        sharedModules=Option("bot", "sharedModules", stringlist, []),
+        processModules=Option("bot", "processModules", stringlist, []),
+        processModuleTimeout=Option("bot", "processModuleTimeout", duration,
+                                    30.0),
+        triggerPrefixes=Option("bot", "triggerPrefixes", default="+"),
+        joinOnInvite=Option("bot", "joinOnInvite", boolean, False),
+        bindAddress=Option("bot", "bindAddress"),
+        quitMessage=Option("bot", "quitMessage", default="Reactor shutdown"),
+        joinDelay=Option("bot", "joinDelay", duration, 1.0),
+        pingInterval=Option("bot", "pingInterval", duration, 60.0),
+        pingTimeout=Option("bot", "pingTimeout", duration, 60.0),
+        lagSamples=Option("bot", "lagSamples", integer, 10),
+        reconnectDelay=Option("bot", "reconnectDelay", duration, 10.0),
+        reconnectMaxDelay=Option("bot", "reconnectMaxDelay", duration, 300.0),
+        stateDirectory=Option("bot", "stateDirectory"),
+        stateInterval=Option("bot", "stateInterval", duration, 300.0),
+        stateTimeout=Option("bot", "stateTimeout", duration, 120.0),
+        netsplitWindow=Option("bot", "netsplitWindow", duration, 2.0),
+        netsplitTimeout=Option("bot", "netsplitTimeout", duration, 3600.0),
+        whoCacheTTL=Option("bot", "whoCacheTTL", duration, 300.0),
+        whoOnJoin=Option("bot", "whoOnJoin", boolean, False),
+        hosts=Option("server", "host", stringlist, []),
+        port=Option("server", "port", integer, 6667),
+        useSSL=Option("server", "useSSL", boolean, False),
+        channels=Option("server", "channel", stringlist, []),
+        setBot=Option("server", "setBot", boolean, False),
+    )
+
     def __init__(self, settings):
         self.client = None
         self.modules = []
@@ -697,14 +1610,31 @@ class BonesBotFactory(protocol.ClientFactory):
         ]
 
         self.reconnectAttempts = 0
+        self.currentServer = None
+        self._connectStarted = None
+        self._reconnectCall = None
+        # Only set once the bot is shutting down.
+        self.shutdown_deferred = None
 
         self.settings = settings
-        self.channels = settings.get("server", "channel", default="") \
-            .split("\n")
-        self.channels = removeEmptyElementsFromList(self.channels)
-        self.nicknames = settings.get("bot", "nickname", default="") \
-            .split("\n")
-        self.nicknames = removeEmptyElementsFromList(self.nicknames)
+        self.config = config = settings.compile(self.configSchema)
+
+        # The channel and user registry is saved to a snapshot in this
+        # directory every `stateInterval` seconds, and restored on startup.
+        self.state = None
+        self._stateSaver = None
+        if config.stateDirectory:
+            self.state = self.loadState()
+            self._stateSaver = task.LoopingCall(self.saveState)
+            self._stateSaver.start(config.stateInterval, now=False)
+
+        # The server addresses that we'll fail over between.
+        self.servers = [
+            ServerAddress.parse(host, config.port, config.useSSL, i)
+            for i, host in enumerate(config.hosts)
+        ]
+        self.channels, self.channelKeys = self.parseChannels(config.channels)
+        self.nicknames = list(config.nicknames)
         try:
             self.nickname = self.nicknames.pop(0)
         except IndexError:
@@ -712,8 +1642,8 @@ class BonesBotFactory(protocol.ClientFactory):
                 "No nicknames configured, property bot.nickname does not "
                 "exist or is empty."
             )
-        self.realname = settings.get("bot", "realname", default=self.nickname)
-        self.username = settings.get("bot", "username")
+        self.realname = config.realname or self.nickname
+        self.username = config.username
         if not self.username:
             try:
                 import getpass
@@ -723,41 +1653,117 @@ class BonesBotFactory(protocol.ClientFactory):
         if not self.username:
             self.username = "bones"
 
-        # Build the trigger regex using the trigger prefixes
-        # specified in settings
-        prefixChars = settings.get("bot", "triggerPrefixes", default="+") \
-            .decode("utf-8")
-        regex = "^([%s])([^ ]*)( .+)*?$" % prefixChars
-        self.reCommand = re.compile(regex, re.UNICODE)
-
-        modules = settings.get("bot", "modules", default="").split("\n")
-        modules = removeEmptyElementsFromList(modules)
-        for module in modules:
-            self.loadModule(module)
+        self.reCommand = self.compileTriggerRegex(config.triggerPrefixes)
+
+        self._modulesSetUp = False
+        self.lazyModules = {}
+        self.remoteModules = {}
+        self.moduleLoadTimes = {}
+        for module in config.modules:
+            if module in config.processModules:
+                self.loadRemoteModule(module)
+            elif config.lazyModules:
+                self.loadModuleLazily(module)
+            else:
+                self.loadModule(module)
+        self._modulesSetUp = True
+        self.modulesReady = self.setupModules()
         self.reconnect = True
-        reactor.addSystemEventTrigger('before', 'shutdown',
-                                      self.twisted_shutdown)
+        self._shutdownTrigger = reactor.addSystemEventTrigger(
+            'before', 'shutdown', self.twisted_shutdown)
         bones.event.fire(self.tag, bones.event.BotInitializedEvent(self))
 
-    def loadModule(self, path):
+    def loadModule(self, path, previous=None):
         """Loads the specified module and adds it to the bot if it is a
         valid :term:`Bones module`.
 
         :param path: The Python dot-notation path to the module that should be
             loaded.
         :type path: str.
+        :param previous: The instance this module replaces, if it is being
+            reloaded. The attributes named in its
+            :attr:`~bones.bot.Module.persistentState` are copied to the new
+            instance before it is set up.
 
         :raises:
             :class:`~bones.bot.BonesModuleAlreadyLoadedException,`
             :class:`~bones.bot.InvalidBonesModuleException,`
             :class:`~bones.bot.InvalidConfigurationException,`
             :class:`~bones.bot.NoSuchBonesException`
+
+        :returns: The new module instance.
+        """
+        log.info("Loading module %s", path)
+        started = reactor.seconds()
+        lazy = self.lazyModules.pop(path, None)
+        if lazy is not None:
+            bones.event.unregister(lazy, self.tag)
+        module = self.importModule(path)
+
+        if issubclass(module, Module):
+            if module in [m.__class__ for m in self.modules]:
+                ex = BonesModuleAlreadyLoadedException(
+                    "Could not load module %s: Module already loaded" %
+                    (path,)
+                )
+                log.exception(ex)
+                raise ex
+            instance = None
+            if path in self.config.sharedModules:
+                instance = sharedModules.get(path)
+                if instance is not None and instance.__class__ is not module:
+                    instance = None
+            if instance is None:
+                instance = module(settings=self.settings, factory=self)
+                if previous is not None:
+                    for name in previous.persistentState:
+                        if hasattr(previous, name):
+                            setattr(instance, name, getattr(previous, name))
+                if path in self.config.sharedModules:
+                    sharedModules[path] = instance
+            else:
+                log.info("Sharing module %s with %s", path,
+                         ", ".join(sorted(instance.factories)))
+            instance.factories[self.tag] = self
+            self.modules.append(instance)
+            bones.event.register(instance, self.tag)
+            bones.event.fire(self.tag, bones.event.BotModuleLoaded(module))
+            self.moduleLoadTimes[path] = reactor.seconds() - started
+
+            # Load the modules this one depends on if they aren't loaded
+            # already. Events are held back from the module until it and
+            # its dependencies have been set up.
+            loaded = [m.name for m in self.modules]
+            for dependency in instance.dependencies:
+                if dependency not in loaded:
+                    self.loadModule(dependency)
+            if self._modulesSetUp:
+                self.setupModules()
+            return instance
+        else:
+            ex = InvalidBonesModuleException(
+                "Could not load module %s: Module is not a subclass of "
+                "bones.bot.Module" %
+
+                path
+            )
+            log.exception(ex)
+            raise ex
+
+    def importModule(self, path):
+        """Imports the specified module and returns its class, without
+        loading it.
+
+        :param path: The Python dot-notation path to the module.
+        :type path: str.
+
+        :raises:
+            :class:`~bones.bot.NoSuchBonesModuleException`
         """
         tmppath = path.split(".")
         package = ".".join(tmppath[:-1])
         name = tmppath[-1]
 
-        log.info("Loading module %s", path)
         try:
             module = __import__(package, fromlist=[name])
         except ImportError as ex_raised:
@@ -781,20 +1787,53 @@ class BonesBotFactory(protocol.ClientFactory):
             )
             log.exception(ex)
             raise ex
+        return module
 
-        if issubclass(module, Module):
-            if module in [m.__class__ for m in self.modules]:
-                ex = BonesModuleAlreadyLoadedException(
-                    "Could not load module %s: Module already loaded" %
-                    (path,)
-                )
-                log.exception(ex)
-                raise ex
-            instance = module(settings=self.settings, factory=self)
-            self.modules.append(instance)
-            bones.event.register(instance, self.tag)
-            bones.event.fire(self.tag, bones.event.BotModuleLoaded(module))
-        else:
+    def loadModuleLazily(self, path):
+        """Adds the specified module to the bot without importing it. The
+        module is imported and loaded by :meth:`loadModule` the first time
+        one of the events or triggers it handles is fired, which keeps the
+        startup fast when a lot of modules or servers are configured.
+
+        Modules that can't be scanned by :func:`scanModuleHandlers` are
+        loaded right away.
+
+        :param path: The Python dot-notation path to the module that should be
+            loaded.
+        :type path: str.
+        """
+        if path in self.lazyModules or \
+                path in [m.name for m in self.modules]:
+            return
+        events = scanModuleHandlers(path)
+        if events is None:
+            log.debug("Module %s can't be loaded lazily", path)
+            self.loadModule(path)
+            return
+        log.info("Deferring load of module %s until it is used", path)
+        stub = LazyModule(self, path)
+        self.lazyModules[path] = stub
+        for event in set(events):
+            bones.event.addHandler(stub, self.tag, event,
+                                   LazyModule.handlerFor(event))
+
+    def loadRemoteModule(self, path):
+        """Runs the specified module in a worker process of its own, see
+        :mod:`bones.worker`. The module is imported to find the events it
+        handles, but isn't loaded into the bot.
+
+        :param path: The Python dot-notation path to the module that should be
+            loaded.
+        :type path: str.
+
+        :raises:
+            :class:`~bones.bot.InvalidBonesModuleException,`
+            :class:`~bones.bot.NoSuchBonesException`
+        """
+        from bones.worker import RemoteModule
+
+        module = self.importModule(path)
+        if not issubclass(module, Module):
             ex = InvalidBonesModuleException(
                 "Could not load module %s: Module is not a subclass of "
                 "bones.bot.Module" %
@@ -803,11 +1842,402 @@ class BonesBotFactory(protocol.ClientFactory):
             )
             log.exception(ex)
             raise ex
+        events = set()
+        for name, method in inspect.getmembers(module,
+                                               bones.event.is_handler):
+            events.update(getattr(method, "_event", None) or ())
+        log.info("Loading module %s in a worker process", path)
+        remote = RemoteModule(self, path, events)
+        self.remoteModules[path] = remote
+        for event in events:
+            bones.event.addHandler(remote, self.tag, event,
+                                   RemoteModule.handlerFor(event))
+        remote.start()
+
+    def _loadLazyModule(self, path):
+        if path in self.lazyModules:
+            return self.loadModule(path)
+        return self.getModule(path)
+
+    def setupModules(self):
+        """Sets up every loaded module that hasn't been set up yet by calling
+        its :meth:`~bones.bot.Module.setup` method. A module is set up after
+        all of its :attr:`~bones.bot.Module.dependencies` are ready, while
+        modules that don't depend on each other are set up in parallel.
+
+        Modules that fail to set up, or that depend on a module which did,
+        are unloaded.
+
+        :raises:
+            :class:`~bones.bot.InvalidBonesModuleException` if the
+            dependencies are circular.
+
+        :returns: A :class:`~twisted.internet.defer.DeferredList` that fires
+            when all the modules have been set up, with :code:`True` for
+            every module that is ready and :code:`False` for every one that
+            failed.
+        """
+        modules = dict((instance.name, instance) for instance in self.modules)
+        order = []
+        visiting = []
+
+        def visit(instance):
+            if instance in order:
+                return
+            if instance in visiting:
+                cycle = visiting[visiting.index(instance):] + [instance]
+                ex = InvalidBonesModuleException(
+                    "Circular module dependencies: %s" %
+                    " -> ".join(m.name for m in cycle)
+                )
+                log.exception(ex)
+                raise ex
+            visiting.append(instance)
+            for dependency in instance.dependencies:
+                visit(modules[dependency])
+            visiting.pop()
+            order.append(instance)
+
+        for instance in self.modules:
+            visit(instance)
+
+        # The modules are ordered so that dependencies come first, which
+        # means that their Deferreds exist by the time their dependents
+        # need them.
+        setups = {}
+        for instance in order:
+            if instance.ready:
+                setups[instance] = defer.succeed(instance)
+                continue
+            if instance._setup is not None:
+                setups[instance] = instance._setup
+                continue
+            d = defer.gatherResults(
+                [setups[modules[dep]] for dep in instance.dependencies]
+            )
+            d.addCallback(self._setupModule, instance)
+            setups[instance] = instance._setup = d
+        return defer.DeferredList(setups.values())
+
+    def _setupModule(self, dependenciesReady, instance):
+        # The Deferreds in the setup graph never fail, they fire with
+        # whether the module is ready instead. This lets several dependents
+        # wait on the same module.
+        if not all(dependenciesReady):
+            log.error("A dependency of module %s failed to set up, unloading "
+                      "it", instance.name)
+            if instance in self.modules:
+                self.unloadModule(instance.name)
+            return False
+
+        log.debug("Setting up module %s", instance.name)
+        started = reactor.seconds()
+
+        def ready(result):
+            log.debug("Module %s ready after %.3f seconds", instance.name,
+                      reactor.seconds() - started)
+            instance._ready()
+            return True
+
+        def failed(failure):
+            log.error("Module %s failed to set up, unloading it: %s",
+                      instance.name, failure.getErrorMessage())
+            if instance in self.modules:
+                self.unloadModule(instance.name)
+            return False
+
+        d = defer.maybeDeferred(instance.setup)
+        d.addCallbacks(ready, failed)
+        return d
+
+    def getModule(self, path):
+        """Returns the loaded instance of the specified module.
+
+        :param path: The Python dot-notation path to the module.
+        :type path: str.
+
+        :raises:
+            :class:`~bones.bot.NoSuchBonesModuleException`
+        """
+        for instance in self.modules:
+            if instance.name == path:
+                return instance
+        if path in self.lazyModules:
+            return self.loadModule(path)
+        ex = NoSuchBonesModuleException(
+            "Module %s is not loaded" % path
+        )
+        log.exception(ex)
+        raise ex
+
+    def unloadModule(self, path):
+        """Removes the specified module from the bot and stops it from
+        receiving any further events. The module's
+        :meth:`~bones.bot.Module.unload` method is called before its event
+        handlers are removed. A shared module is only unloaded once it has
+        been removed from every bot that uses it.
+
+        :param path: The Python dot-notation path to the module that should be
+            unloaded.
+        :type path: str.
+
+        :raises:
+            :class:`~bones.bot.NoSuchBonesModuleException`
+
+        :returns: The module instance that was unloaded, or :code:`None` if
+            it hadn't been loaded yet or ran in a worker process.
+        """
+        lazy = self.lazyModules.pop(path, None) or \
+            self.remoteModules.pop(path, None)
+        if lazy is not None:
+            log.info("Unloading module %s", path)
+            bones.event.unregister(lazy, self.tag)
+            if hasattr(lazy, "stop"):
+                lazy.stop()
+            return None
+        instance = self.getModule(path)
+        log.info("Unloading module %s", path)
+        instance.factories.pop(self.tag, None)
+        if not instance.factories:
+            try:
+                instance.unload()
+            except Exception as ex:
+                log.exception(ex)
+            if sharedModules.get(path) is instance:
+                del sharedModules[path]
+        elif instance.factory is self:
+            instance.factory = instance.factories.values()[0]
+        bones.event.unregister(instance, self.tag)
+        self.modules.remove(instance)
+        if instance.configSchema is not None:
+            self.settings.discard(instance.configSchema)
+        bones.event.fire(self.tag,
+                         bones.event.BotModuleUnloaded(instance.__class__))
+        return instance
+
+    def reloadModule(self, path):
+        """Re-imports the Python module that the specified module is defined
+        in and replaces the loaded instance with one of the new class,
+        without disconnecting. The attributes named in the old instance's
+        :attr:`~bones.bot.Module.persistentState` are copied over to the new
+        instance.
+
+        If the module can't be re-imported, the old instance is kept. A
+        shared module is reloaded for every bot that uses it.
+
+        :param path: The Python dot-notation path to the module that should be
+            reloaded.
+        :type path: str.
+
+        :raises:
+            :class:`~bones.bot.NoSuchBonesModuleException`, or whatever was
+            raised while re-importing the module.
+
+        :returns: The new module instance.
+        """
+        old = self.getModule(path)
+        log.info("Reloading module %s", path)
+        try:
+            reload(sys.modules[old.__class__.__module__])
+        except Exception as ex:
+            log.exception(ex)
+            raise
+
+        factories = old.factories.values()
+        for factory in factories:
+            factory.unloadModule(path)
+        try:
+            for factory in factories:
+                instance = factory.loadModule(path, old)
+        except Exception:
+            # Put the old instance back, so that the bots are left as they
+            # were.
+            for factory in factories:
+                if path in [m.name for m in factory.modules]:
+                    factory.unloadModule(path)
+                factory.modules.append(old)
+                old.factories[factory.tag] = factory
+                bones.event.register(old, factory.tag)
+            if path in self.config.sharedModules:
+                sharedModules[path] = old
+            raise
+        return instance
+
+    def parseChannels(self, lines):
+        """Parses the lines of the :code:`channel` option.
+
+        Each line holds a channel name, optionally followed by the key needed
+        to join it.
+
+        :returns: A tuple with a list of the channel names, and a dict
+            mapping channel names to their keys.
+        """
+        channels = []
+        keys = {}
+        for channel in lines:
+            channel = channel.split()
+            channels.append(channel[0])
+            if len(channel) > 1:
+                keys[channel[0]] = channel[1]
+        return channels, keys
+
+    def compileTriggerRegex(self, prefixes):
+        """Builds the regex used to recognize triggers from the trigger
+        prefixes specified in settings."""
+        prefixChars = prefixes.decode("utf-8")
+        regex = "^([%s])([^ ]*)( .+)*?$" % prefixChars
+        return re.compile(regex, re.UNICODE)
+
+    def rehash(self):
+        """Reloads the configuration for this server and applies the changes
+        to the running factory, client and modules without dropping the
+        connection. Channels are joined and parted, modules are loaded and
+        unloaded, and the trigger prefixes, nicknames, server list and module
+        configurations are replaced.
+
+        The global configuration should have been
+        :meth:`~bones.config.BaseConfiguration.rehash`-ed before this is
+        called.
+
+        :returns: The changes, as returned by
+            :meth:`bones.config.ServerConfiguration.reload`.
+        :raises: :class:`~bones.config.InvalidConfigurationException` if the
+            new configuration is invalid, or whatever was raised while
+            importing a newly added module, in which case nothing is
+            changed.
+        """
+        changes = self.settings.reload()
+        if not changes:
+            return changes
+        old = self.config
+        config = self.settings.compile(self.configSchema)
+        # Modules are loaded one at a time, so the new ones are checked
+        # before anything is changed rather than leaving the bot with only
+        # some of them.
+        try:
+            self.checkModules(
+                [module for module in config.modules
+                 if module not in old.modules
+                 and module not in config.processModules
+                 and not config.lazyModules],
+                [m.name for m in self.modules if m.name in config.modules]
+            )
+        except Exception:
+            self.settings.revert()
+            raise
+        log.info("Configuration for %s changed: %s", self.tag,
+                 ", ".join("[%s] %s" % (section, ", ".join(sorted(options)))
+                           for section, options in sorted(changes.items())))
+        self.config = config
+        client = self.client
+        if client and not client.hasSignedOn:
+            client = None
+
+        if config.triggerPrefixes != old.triggerPrefixes:
+            self.reCommand = self.compileTriggerRegex(config.triggerPrefixes)
+
+        if config.nicknames != old.nicknames and config.nicknames:
+            self.nicknames = list(config.nicknames)
+            self.nickname = self.nicknames.pop(0)
+            if client and client.nickname != self.nickname:
+                client.setNick(self.nickname)
+        self.realname = config.realname or self.nickname
+
+        if (config.hosts, config.port, config.useSSL) != \
+                (old.hosts, old.port, old.useSSL):
+            # Keep the failure and latency history of servers that are
+            # still in the list.
+            known = dict((repr(server), server) for server in self.servers)
+            self.servers = []
+            for i, host in enumerate(config.hosts):
+                server = ServerAddress.parse(host, config.port,
+                                             config.useSSL, i)
+                server = known.get(repr(server), server)
+                server.index = i
+                self.servers.append(server)
+
+        channels, keys = self.parseChannels(config.channels)
+        joins = [(channel, keys.get(channel)) for channel in channels
+                 if channel not in self.channels
+                 or keys.get(channel) != self.channelKeys.get(channel)]
+        parts = [channel for channel in self.channels
+                 if channel not in channels]
+        self.channels, self.channelKeys = channels, keys
+        if client:
+            for channel in parts:
+                client.leave(channel)
+            if joins:
+                client.joinChannels(joins)
+
+        if client and config.pingInterval != old.pingInterval:
+            client.stopHeartbeat()
+            client.heartbeatInterval = config.pingInterval
+            client.startHeartbeat()
+
+        for module in old.modules:
+            if module not in config.modules:
+                self.unloadModule(module)
+        for instance in self.modules:
+            # Shared modules use the configuration of the bot that loaded
+            # them first.
+            if instance.configSchema is not None and \
+                    instance.factory is self:
+                instance.config = self.settings.compile(instance.configSchema)
+        for module in config.modules:
+            if module not in old.modules:
+                if module in config.processModules:
+                    self.loadRemoteModule(module)
+                elif config.lazyModules:
+                    self.loadModuleLazily(module)
+                else:
+                    self.loadModule(module)
+
+        bones.event.fire(self.tag,
+                         bones.event.ConfigurationReloadedEvent(self, changes))
+        return changes
+
+    def checkModules(self, paths, loaded=()):
+        """Checks that the specified modules and the dependencies they would
+        load can be loaded with the current settings, without loading them.
+
+        :param paths: The Python dot-notation paths of the modules.
+        :param loaded: The paths of the modules that are already loaded.
+
+        :raises:
+            :class:`~bones.bot.InvalidBonesModuleException,`
+            :class:`~bones.bot.InvalidConfigurationException,`
+            :class:`~bones.bot.NoSuchBonesModuleException`
+        """
+        checked = set(loaded)
+        paths = list(paths)
+        while paths:
+            path = paths.pop()
+            if path in checked:
+                continue
+            checked.add(path)
+            module = self.importModule(path)
+            if not issubclass(module, Module):
+                raise InvalidBonesModuleException(
+                    "Could not load module %s: Module is not a subclass of "
+                    "bones.bot.Module" % path
+                )
+            if module.configSchema is not None:
+                module.configSchema.compile(self.settings)
+            paths.extend(module.dependencies)
 
     def buildProtocol(self, addr):
         if not self.reconnect:
             raise Exception
+        # The TCP connection has been established, which gives us a first
+        # estimate of the latency to this server.
+        if self.currentServer and self._connectStarted is not None:
+            self.currentServer.recordLatency(
+                reactor.seconds() - self._connectStarted
+            )
+        self._connectStarted = None
         self.client = protocol.ClientFactory.buildProtocol(self, addr)
+        if self.state:
+            self.client.restoreState(self.state)
         return self.client
 
     def clientConnectionLost(self, connector, reason):
@@ -819,21 +2249,29 @@ class BonesBotFactory(protocol.ClientFactory):
         bones.event.fire(self.tag,
                          bones.event.ConnectionClosedEvent(*event_args))
 
+        if self.client:
+            # Keep the registry around so that the next connection can
+            # start out with it.
+            self.state = self.client.dumpState()
         if not self.reconnect:
-            reactor.callLater(0.0, self.shutdown_deferred.callback, 1)
+            self._shutdownDone()
             return
+        # If we never managed to register with the server, count this as a
+        # failure so that we'll try another one.
+        if self.currentServer and self.client \
+                and not self.client.hasSignedOn:
+            self.currentServer.recordFailure()
         self.client = None
 
         bones.event.fire(self.tag,
                          bones.event.ConnectionLostEvent(*event_args))
 
-        time = 10.0 * self.reconnectAttempts
-        self.reconnectAttempts += 1
+        time = self.nextReconnectDelay()
         log.info(
             "{%s} Lost connection (%s), reconnecting in %i seconds.",
             self.tag, reason, time
         )
-        reactor.callLater(time, connector.connect)
+        self._reconnectCall = reactor.callLater(time, self.connect)
 
     def clientConnectionFailed(self, connector, reason):
         """Called when an error occured with the connection. This method
@@ -845,43 +2283,55 @@ class BonesBotFactory(protocol.ClientFactory):
                          bones.event.ConnectionClosedEvent(*event_args))
 
         if not self.reconnect:
-            reactor.callLater(0.0, self.shutdown_deferred.callback, 1)
+            self._shutdownDone()
             return
+        if self.currentServer:
+            self.currentServer.recordFailure()
         self.client = None
 
         bones.event.fire(self.tag,
                          bones.event.ConnectionFailedEvent(*event_args))
 
-        time = 30.0 * self.reconnectAttempts
-        self.reconnectAttempts += 1
+        time = self.nextReconnectDelay()
         log.info(
-            "{%s} Could not connect (%s), reconnecting in %i seconds.",
-            self.tag, reason, time
+            "{%s} Could not connect to %s (%s), reconnecting in %i seconds.",
+            self.tag, self.currentServer, reason, time
         )
-        reactor.callLater(time, connector.connect)
+        self._reconnectCall = reactor.callLater(time, self.connect)
+
+    def nextReconnectDelay(self):
+        """Returns the number of seconds to wait before the next connection
+        attempt and counts the attempt. The backoff only grows once every
+        server in the failover list has been tried, so that a failing server
+        is followed by an immediate attempt at the next one."""
+        attempts = self.reconnectAttempts // max(len(self.servers), 1)
+        self.reconnectAttempts += 1
+        return reconnectDelay(attempts, self.config.reconnectDelay,
+                              self.config.reconnectMaxDelay)
+
+    def pickServer(self):
+        """Returns the :class:`ServerAddress` that should be connected to
+        next; the fastest healthy server, or if all of them have failed
+        recently the one with the fewest failures."""
+        return min(self.servers, key=lambda server: server.sortKey())
 
     def connect(self):
         """Connects this bot factory to the server it is configured for.
         Gets called automatically by the default manager at boot.
-        """
 
-        serverPort = int(self.settings.get("server", "port", default="6667"))
-        serverHost = self.settings.get("server", "host")
-        if not serverHost:
+        If the server section contains a list of hosts, the best one
+        according to :meth:`pickServer` is used.
+        """
+        if not self.servers:
             raise InvalidConfigurationException(
                 "Server {} does not contain a `host` option.".format(self.tag)
             )
-        log_serverHost = serverHost
-        if ":" in serverHost and not serverHost.startswith("[") \
-                and not serverHost.endswith("]"):
-            # IPv6 address, but not enclosed in brackets
-            log_serverHost = "[%s]" % serverHost
-        elif ":" in serverHost and (serverHost.startswith("[") and
-                                    serverHost.endswith("]")):
-            # IPv6 address and enclosed in brackets
-            serverHost = serverHost[1:-1]
-        if self.settings.get("bot", "bindAddress", default=None):
-            bind_address = (self.settings.get("bot", "bindAddress"), 0)
+        server = self.pickServer()
+        self.currentServer = server
+        serverHost = server.host
+        serverPort = server.port
+        if self.config.bindAddress:
+            bind_address = (self.config.bindAddress, 0)
             # Strip brackets if we're getting an IPv6 address
             if ":" in bind_address[0] and (bind_address[0].startswith("[") and
                                            bind_address[0].endswith("]")):
@@ -893,8 +2343,9 @@ class BonesBotFactory(protocol.ClientFactory):
             self, serverHost, serverPort, bind_address
         ))
 
-        if self.settings.get("server", "useSSL", default="false") == "true":
-            log.info("Connecting to server %s:+%i", log_serverHost, serverPort)
+        self._connectStarted = reactor.seconds()
+        log.info("{%s} Connecting to server %s", self.tag, server)
+        if server.ssl:
             try:
                 from twisted.internet import ssl
             except ImportError:
@@ -910,22 +2361,121 @@ class BonesBotFactory(protocol.ClientFactory):
                 bindAddress=bind_address
             )
         else:
-            log.info("Connecting to server %s:%i", log_serverHost, serverPort)
             reactor.connectTCP(serverHost, serverPort, self,
                                bindAddress=bind_address)
 
+    def stateFile(self):
+        return os.path.join(self.config.stateDirectory,
+                            "%s.json.gz" % self.tag)
+
+    def loadState(self):
+        """Loads the state snapshot for this server, returning
+        :code:`None` if there isn't one or it couldn't be read."""
+        path = self.stateFile()
+        if not os.path.exists(path):
+            return None
+        try:
+            with gzip.open(path, "rb") as f:
+                return encodeStrings(json.load(f))
+        except Exception:
+            log.exception("{%s} Unable to load the state snapshot %s",
+                          self.tag, path)
+            return None
+
+    def saveState(self):
+        """Writes the channel and user registry of the current connection
+        to the state snapshot. The registry is serialized right away, and
+        written to disk in a thread.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` that fires when
+            the snapshot has been written.
+        """
+        if self.client and self.client.hasSignedOn:
+            self.state = self.client.dumpState()
+        if not self.state:
+            return defer.succeed(None)
+        try:
+            data = json.dumps(self.state, separators=(",", ":"))
+        except Exception:
+            log.exception("{%s} Unable to serialize the state snapshot",
+                          self.tag)
+            return defer.succeed(None)
+
+        def write(path, data):
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = path + ".tmp"
+            with gzip.open(tmp, "wb") as f:
+                f.write(data)
+            os.rename(tmp, path)
+
+        d = threads.deferToThread(write, self.stateFile(), data)
+        d.addErrback(lambda failure: log.error(
+            "{%s} Unable to save the state snapshot: %s",
+            self.tag, failure.getErrorMessage()
+        ))
+        return d
+
+    def _shutdownDone(self):
+        if self.shutdown_deferred is not None and \
+                not self.shutdown_deferred.called:
+            reactor.callLater(0.0, self.shutdown_deferred.callback, 1)
+
+    def stop(self):
+        """Disconnects from the server and unloads all the modules, for when
+        the server's section has been removed from the configuration while
+        the other bots keep running.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` that fires
+            once the connection has been closed and the modules have been
+            unloaded.
+        """
+        self.shutdown_deferred = defer.Deferred()
+        self.reconnect = False
+        if self._reconnectCall is not None and self._reconnectCall.active():
+            self._reconnectCall.cancel()
+        self._reconnectCall = None
+        reactor.removeSystemEventTrigger(self._shutdownTrigger)
+        if self._stateSaver and self._stateSaver.running:
+            self._stateSaver.stop()
+
+        def unloadModules(result):
+            # Dependents are loaded after their dependencies, so they're
+            # unloaded first.
+            paths = [m.name for m in reversed(self.modules)] + \
+                self.lazyModules.keys() + self.remoteModules.keys()
+            for path in paths:
+                try:
+                    self.unloadModule(path)
+                except Exception as ex:
+                    log.exception(ex)
+            return result
+        self.shutdown_deferred.addCallback(unloadModules)
+        if self.client:
+            self.client.quit(self.config.quitMessage)
+        else:
+            self._shutdownDone()
+        return self.shutdown_deferred
+
     def twisted_shutdown(self):
         self.shutdown_deferred = defer.Deferred()
         self.reconnect = False
+        for remote in self.remoteModules.values():
+            remote.stop()
+        if self._stateSaver:
+            self._stateSaver.stop()
+            stateSaved = self.saveState()
+        else:
+            stateSaved = defer.succeed(None)
 
         def shutdown_hook(self):
             if self.client:
-                self.client.quit(self.settings.get("bot", "quitMessage",
-                                                   default="Reactor shutdown"))
+                self.client.quit(self.config.quitMessage)
             else:
-                reactor.callLater(0.0, self.shutdown_deferred.callback, 1)
+                self._shutdownDone()
         reactor.callLater(0.0, shutdown_hook, self)
-        return self.shutdown_deferred
+        return defer.DeferredList([self.shutdown_deferred, stateSaved])
 
 
 class Module():
@@ -946,10 +2496,151 @@ class Module():
 
         A :class:`bones.bot.BonesBotFactory` instance representing the factory
         which instanciates the clients whom this module is used with.
+
+    .. attribute:: factories
+
+        A dict mapping server tags to the :class:`bones.bot.BonesBotFactory`
+        instances that use this module. This only holds more than
+        :attr:`factory` for modules listed in the :code:`sharedModules`
+        option, which have one instance for all servers in the process.
+        Such modules can tell the servers apart by
+        :code:`event.client.tag`, and use the settings of the server that
+        loaded them first.
+
+    .. attribute:: configSchema
+
+        An optional :class:`bones.config.Schema` declaring the typed options
+        used by the module. Set this in subclasses to have the options
+        parsed once when the module is loaded.
+
+    .. attribute:: config
+
+        The :class:`bones.config.CompiledConfiguration` for
+        :attr:`configSchema`, or :code:`None` if the module doesn't have a
+        schema.
+
+    .. attribute:: persistentState
+
+        A tuple with the names of the attributes that should be copied over
+        to the new instance when the module is reloaded with
+        :meth:`~bones.bot.BonesBotFactory.reloadModule`. They are copied
+        before the new instance's :meth:`setup` is called, after the old
+        instance has been unloaded.
+
+    .. attribute:: dependencies
+
+        A tuple with the Python dot-notation paths of the modules this module
+        needs, like :code:`"bones.modules.storage.Database"`. They're loaded
+        automatically if they aren't in the configuration, and are set up
+        before this module.
+
+    .. attribute:: ready
+
+        Whether the module has been set up. Events for the module are held
+        back until it's ready, and are then delivered in the order they were
+        fired.
     """
 
+    configSchema = None
+    persistentState = ()
+    dependencies = ()
+
     def __init__(self, settings, factory):
         self.settings = settings
         self.factory = factory
+        self.factories = {}
+        self.config = None
+        if self.configSchema is not None:
+            self.config = settings.compile(self.configSchema)
         self.name = "%s.%s" % (self.__module__, self.__class__.__name__)
         self.log = logging.getLogger(self.name)
+        self.ready = False
+        self._setup = None
+        self._heldEvents = []
+        self._readyLock = threading.Lock()
+
+    def setup(self):
+        """Called once all of the module's
+        :attr:`~bones.bot.Module.dependencies` are ready. Override this to
+        do any initialization that needs other modules, like getting a
+        database session. Return a :class:`~twisted.internet.defer.Deferred`
+        if the module isn't ready until some asynchronous work is done.
+
+        This is called in the reactor thread, so blocking work should be
+        done with :func:`twisted.internet.threads.deferToThread`.
+        """
+        pass
+
+    def holdEvent(self, handler, args, kwargs):
+        """Holds back an event for the given handler if the module isn't
+        ready yet. This is called by :func:`bones.event.fire`.
+
+        :returns: :code:`True` if the event was held back, and :code:`False`
+            if it should be delivered right away.
+        """
+        with self._readyLock:
+            if self.ready:
+                return False
+            self._heldEvents.append((handler, args, kwargs))
+            return True
+
+    def _ready(self):
+        threads.deferToThread(self._deliverHeldEvents)
+
+    def _deliverHeldEvents(self):
+        # Keep delivering until there are no more held events, so that
+        # events fired meanwhile don't overtake the ones held before them.
+        while True:
+            with self._readyLock:
+                events = self._heldEvents
+                self._heldEvents = []
+                if not events:
+                    self.ready = True
+                    return
+            for handler, args, kwargs in events:
+                try:
+                    handler(self, *args, **kwargs)
+                except Exception as ex:
+                    self.log.exception(ex)
+
+    def unload(self):
+        """Called by the factory right before the module is unloaded or
+        reloaded. Override this to cancel timers, close connections and the
+        like; the module won't receive any events after this."""
+        pass
+
+
+class LazyModule():
+    """Stands in for a :term:`Bones module` that hasn't been imported yet.
+    It is registered for the events and triggers the module handles, and
+    loads the module when the first of them is fired. See
+    :meth:`BonesBotFactory.loadModuleLazily`.
+
+    .. attribute:: path
+
+        The Python dot-notation path to the module.
+    """
+
+    # Events are never held back from the stand-in, as it's what causes the
+    # module to be loaded and set up.
+    ready = True
+
+    def __init__(self, factory, path):
+        self.factory = factory
+        self.path = path
+        self.name = path
+
+    @staticmethod
+    def handlerFor(event):
+        def handler(self, *args, **kwargs):
+            self.handle(event, args, kwargs)
+        return handler
+
+    def handle(self, event, args, kwargs):
+        # Event handlers run in a thread, while modules must be loaded in the
+        # reactor thread.
+        instance = threads.blockingCallFromThread(
+            reactor, self.factory._loadLazyModule, self.path
+        )
+        bones.event.deliver(self.factory.tag, instance, event,
+                            *args, **kwargs)
@@ -1,12 +1,128 @@
 # -*- encoding: utf-8 -*-
+import re
 from ConfigParser import SafeConfigParser
 
 
+class InvalidConfigurationException(Exception):
+    pass
+
+
+def string(value):
+    """Option type for plain strings."""
+    return value
+
+
+def boolean(value):
+    """Option type for booleans. Accepts :code:`true`, :code:`yes`,
+    :code:`on` and :code:`1`, or :code:`false`, :code:`no`, :code:`off`
+    and :code:`0`."""
+    value = value.strip().lower()
+    if value in ("true", "yes", "on", "1"):
+        return True
+    if value in ("false", "no", "off", "0"):
+        return False
+    raise ValueError("not a boolean: %r" % value)
+
+
+def integer(value):
+    """Option type for integers."""
+    return int(value)
+
+
+def number(value):
+    """Option type for floating point numbers."""
+    return float(value)
+
+
+def stringlist(value):
+    """Option type for lists with one element per line. Empty lines are
+    skipped."""
+    return [line.strip() for line in value.split("\n") if line.strip()]
+
+
+_reDuration = re.compile(r"^\s*([0-9]*\.?[0-9]+)\s*(ms|s|m|h|d)?\s*$")
+_durationUnits = {None: 1, "ms": 0.001, "s": 1, "m": 60, "h": 3600,
+                  "d": 86400}
+
+
+def duration(value):
+    """Option type for periods of time, returned as seconds in a float. The
+    number may be followed by one of the units :code:`ms`, :code:`s`,
+    :code:`m`, :code:`h` and :code:`d`, and defaults to seconds."""
+    data = _reDuration.match(value)
+    if not data:
+        raise ValueError("not a duration: %r" % value)
+    return float(data.group(1)) * _durationUnits[data.group(2)]
+
+
+class Option(object):
+    """Declares a single option in a :class:`Schema`.
+
+    :param section: The name of the section the option is defined in.
+    :type section: str
+    :param name: The name of the option.
+    :type name: str
+    :param type: A callable that converts the option string to its typed
+        value, like :func:`boolean` or :func:`duration`.
+    :type type: callable
+    :param default: The value used if the option isn't set. This is used
+        as-is, and not converted by `type`.
+    """
+    def __init__(self, section, name, type=string, default=None):
+        self.section = section
+        self.name = name
+        self.type = type
+        self.default = default
+
+
+class Schema(object):
+    """A set of typed options that may be compiled by
+    :meth:`ServerConfiguration.compile` into a :class:`CompiledConfiguration`,
+    where the keyword names given here become attributes.
+
+    Example::
+
+        schema = Schema(
+            waitForNotice=Option("services", "nickserv.waitForNotice",
+                                 boolean, True),
+        )
+    """
+    def __init__(self, **options):
+        self.options = options
+
+    def compile(self, settings):
+        values = {}
+        for attribute, option in self.options.items():
+            value = settings.get(option.section, option.name, default=None)
+            if value is None:
+                values[attribute] = option.default
+                continue
+            try:
+                values[attribute] = option.type(value)
+            except ValueError as ex:
+                raise InvalidConfigurationException(
+                    "Invalid value for option %s in section [%s]: %s"
+                    % (option.name, option.section, ex)
+                )
+        return CompiledConfiguration(values)
+
+
+class CompiledConfiguration(object):
+    """The typed option values of a :class:`Schema`, available as
+    attributes."""
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def __repr__(self):
+        return "<CompiledConfiguration %r>" % self.__dict__
+
+
 class BaseConfiguration(object):
     """
     Global configuration instance.
     """
     def __init__(self, file):
+        self.file = file
         self._conf = SafeConfigParser()
         self._conf.read(file)
 
@@ -21,7 +137,27 @@ class BaseConfiguration(object):
         return default
 
     def rehash(self):
-        self._conf.read(file)
+        """Re-reads the configuration file. The file is parsed into a new
+        parser, so options that were removed from the file are removed here
+        too, and the current configuration is kept if the file can't be
+        read or parsed.
+
+        Running :class:`ServerConfiguration` instances have to be
+        :meth:`~ServerConfiguration.reload`-ed to see the changes.
+
+        :raises: :class:`ConfigParser.Error` if the file can't be parsed,
+            and :class:`InvalidConfigurationException` if it can't be read
+            or has no server sections, like while it is being replaced.
+        """
+        conf = SafeConfigParser()
+        if not conf.read(self.file):
+            raise InvalidConfigurationException(
+                "Couldn't read %s" % self.file)
+        if not [section for section in conf.sections()
+                if section.lower().startswith("server.")]:
+            raise InvalidConfigurationException(
+                "%s has no server sections" % self.file)
+        self._conf = conf
 
     def server(self, server):
         return ServerConfiguration(server, self)
@@ -38,8 +174,71 @@ class ServerConfiguration(object):
         self.config = configuration
         self.server = server
         self.data = {}
+        self._compiled = {}
+        self._previous = None
         self.load()
 
+    def compile(self, schema):
+        """Returns the values of the options in the given :class:`Schema` for
+        this server as a :class:`CompiledConfiguration`. The options are only
+        parsed the first time a schema is compiled.
+
+        :raises: :class:`~bones.config.InvalidConfigurationException` if an
+            option can't be converted to its type.
+        """
+        if schema not in self._compiled:
+            self._compiled[schema] = schema.compile(self)
+        return self._compiled[schema]
+
+    def discard(self, schema):
+        """Forgets the compiled values of the given :class:`Schema`, so that
+        it isn't compiled again when the configuration is reloaded."""
+        self._compiled.pop(schema, None)
+
+    def reload(self):
+        """Reloads the options for this server from the global configuration,
+        which should have been :meth:`~BaseConfiguration.rehash`-ed first.
+        All schemas compiled so far are compiled again.
+
+        :returns: A dict mapping the name of every section with options that
+            were added, removed or changed to a set of the names of those
+            options.
+        :raises: :class:`~bones.config.InvalidConfigurationException` if an
+            option in a compiled schema can't be converted to its type. The
+            old configuration is kept in that case.
+        """
+        oldData = self.data
+        self.data = {}
+        self.load()
+        try:
+            compiled = dict(
+                (schema, schema.compile(self)) for schema in self._compiled
+            )
+        except InvalidConfigurationException:
+            self.data = oldData
+            raise
+        self._previous = (oldData, self._compiled)
+        self._compiled = compiled
+
+        changes = {}
+        for section in set(oldData) | set(self.data):
+            old = oldData.get(section, {})
+            new = self.data.get(section, {})
+            options = set(
+                option for option in set(old) | set(new)
+                if old.get(option) != new.get(option)
+            )
+            if options:
+                changes[section] = options
+        return changes
+
+    def revert(self):
+        """Goes back to the options from before the last :meth:`reload`,
+        for when the new ones turn out to be unusable."""
+        if self._previous is not None:
+            self.data, self._compiled = self._previous
+            self._previous = None
+
     def load(self):
         queue = []
         sections = self.config._conf.sections()
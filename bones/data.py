@@ -0,0 +1,369 @@
+# -*- encoding: utf8 -*-
+"""Imports and exports the tables the modules keep their data in, like
+:code:`bones_quotes_channel`, :code:`bones_quotes_user` and
+:code:`bones_factoids`, as JSON Lines or CSV files. This can be used to
+move the data between databases, or to seed a database with an existing
+channel log.
+
+Rows are streamed a chunk at a time in both directions, so the memory used
+doesn't grow with the size of the table or file. Every chunk that is
+imported is inserted with a single :code:`executemany()` in a transaction
+of its own.
+"""
+import argparse
+import csv
+import importlib
+import json
+import re
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import (
+    DateTime,
+    Integer,
+    engine_from_config,
+    event,
+    select,
+    text,
+)
+from sqlalchemy.exc import DBAPIError
+
+from bones.config import BaseConfiguration
+from bones.modules import storage
+from bones.modules.archive import encodeValue
+
+# The modules that define the tables that can be imported and exported.
+modelModules = (
+    "bones.modules.funserv",
+    "bones.modules.lastfm",
+    "bones.modules.quotes",
+)
+
+formats = ("jsonl", "csv")
+
+
+def tables():
+    """Returns a dict mapping the names of the tables defined by
+    :data:`modelModules` to the tables."""
+    for name in modelModules:
+        importlib.import_module(name)
+    return dict((table.name, table)
+                for table in storage.Base.metadata.sorted_tables
+                if table is not storage.schemaTable)
+
+
+def guessFormat(path):
+    """Returns the format of a file going by its extension, or
+    :code:`None`."""
+    for format in formats:
+        if path.lower().endswith("." + format):
+            return format
+    if path.lower().endswith(".json"):
+        return "jsonl"
+    return None
+
+
+reDatetime = re.compile(
+    r"^\s*(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?\s*$")
+
+
+def parseDatetime(value):
+    """Parses a date and time in the ISO 8601 format, as written by
+    :func:`bones.modules.archive.encodeValue`. The date and time may be
+    separated by a space instead of a T."""
+    # This is several times faster than strptime(), which matters when
+    # there are millions of them.
+    match = reDatetime.match(value)
+    if not match:
+        raise ValueError("not a date and time: %r" % value)
+    fields = match.groups()
+    microseconds = int((fields[6] or "0").ljust(6, "0"))
+    return datetime(*[int(field) for field in fields[:6]] + [microseconds])
+
+
+def _decode(value):
+    if isinstance(value, str):
+        return value.decode("utf-8")
+    return value
+
+
+def rowConverter(table, keepIds=True):
+    """Returns a function that turns a row read from a file into a dict of
+    column values that can be inserted into the table. Columns that the
+    table doesn't have are left out. The function raises
+    :class:`ValueError` if a value has the wrong type.
+    """
+    converters = []
+    for column in table.columns:
+        if column.name == "id" and not keepIds:
+            continue
+        if isinstance(column.type, DateTime):
+            convert = parseDatetime
+        elif isinstance(column.type, Integer):
+            convert = int
+        else:
+            convert = _decode
+        converters.append((column.name, convert))
+
+    def convertRow(row):
+        result = {}
+        for name, convert in converters:
+            if name in row:
+                value = row[name]
+                result[name] = convert(value) if value is not None else None
+        return result
+    return convertRow
+
+
+def readJsonl(f):
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+def readCsv(f):
+    # Empty fields are read as NULL, as that's how they're written.
+    for row in csv.DictReader(f):
+        yield dict((name, value if value != "" else None)
+                   for name, value in row.items())
+
+
+class JsonlWriter():
+    def __init__(self, f, columns):
+        self.f = f
+
+    def write(self, row):
+        self.f.write(json.dumps(
+            dict((name, encodeValue(value)) for name, value in row.items())
+        ))
+        self.f.write("\n")
+
+
+class CsvWriter():
+    def __init__(self, f, columns):
+        self.writer = csv.DictWriter(f, columns)
+        self.writer.writeheader()
+
+    def write(self, row):
+        values = {}
+        for name, value in row.items():
+            value = encodeValue(value)
+            if value is None:
+                value = ""
+            elif isinstance(value, unicode):
+                value = value.encode("utf-8")
+            values[name] = value
+        self.writer.writerow(values)
+
+
+readers = {"jsonl": readJsonl, "csv": readCsv}
+writers = {"jsonl": JsonlWriter, "csv": CsvWriter}
+
+
+class Progress():
+    """Reports the number of rows handled so far on stderr, at most once a
+    second."""
+
+    def __init__(self, label, quiet=False):
+        self.label = label
+        self.quiet = quiet
+        self.count = 0
+        self.started = time.time()
+        self.reported = self.started
+
+    def add(self, count):
+        self.count += count
+        now = time.time()
+        if now - self.reported >= 1:
+            self.reported = now
+            self.report("\r")
+
+    def report(self, end):
+        if self.quiet:
+            return
+        elapsed = max(time.time() - self.started, 0.001)
+        sys.stderr.write("%s%s: %d rows, %d rows/s%s"
+                         % (end, self.label, self.count,
+                            self.count / elapsed, " " * 4))
+        sys.stderr.flush()
+
+    def done(self):
+        self.report("\r")
+        if not self.quiet:
+            sys.stderr.write("\n")
+
+
+def connect(path):
+    """Returns an engine for the database configured in the
+    :code:`[storage]` section of the configuration file."""
+    settings = BaseConfiguration(path)
+    options = {}
+    if settings._conf.has_section("storage"):
+        options = dict(settings._conf.items("storage", raw=True))
+    if options.get("backend", "sqlalchemy").strip().lower() != "sqlalchemy":
+        raise SystemExit("Error: Only the sqlalchemy storage backend can be "
+                         "imported to and exported from.")
+    engine = engine_from_config(storage.engineConfig(options), "sqlalchemy.")
+    if engine.dialect.name == "sqlite":
+        # The configuration parser lowercases the option names.
+        pragmas = (
+            ("journal_mode", storage._pragmaValue(
+                options.get("sqlite.journalmode", "WAL"))),
+            ("synchronous", storage._pragmaValue(
+                options.get("sqlite.synchronous", "NORMAL"))),
+        )
+
+        def setPragmas(connection, record):
+            cursor = connection.cursor()
+            for name, value in pragmas:
+                cursor.execute("PRAGMA %s = %s" % (name, value))
+            cursor.close()
+        event.listen(engine, "connect", setPragmas)
+    return engine
+
+
+def exportTable(engine, table, f, format, chunkSize=10000, quiet=False):
+    """Writes all the rows of a table to a file, in id order.
+
+    :returns: The number of rows written.
+    """
+    writer = writers[format](f, [column.name for column in table.columns])
+    progress = Progress(table.name, quiet)
+    lastId = 0
+    with engine.connect() as connection:
+        while True:
+            # Paging by id keeps the database from holding on to a cursor
+            # over the whole table.
+            rows = connection.execute(
+                select([table]).where(table.c.id > lastId)
+                .order_by(table.c.id).limit(chunkSize)
+            ).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                writer.write(dict(row))
+            lastId = rows[-1]["id"]
+            progress.add(len(rows))
+    progress.done()
+    return progress.count
+
+
+def importTable(engine, table, f, format, chunkSize=10000, keepIds=True,
+                quiet=False):
+    """Inserts the rows in a file into a table, creating the table first if
+    it doesn't exist.
+
+    :returns: The number of rows inserted.
+    :raises: :class:`ValueError` with the number of the offending row if a
+        row can't be read, or with the numbers of the rows in the chunk if
+        the database refuses it, like when ids are kept and rows with
+        those ids exist already. The rows before the chunk have been
+        inserted.
+    """
+    storage.migrate(engine, [table])
+    progress = Progress(table.name, quiet)
+
+    def insert(chunk, last):
+        try:
+            with engine.begin() as connection:
+                connection.execute(table.insert(), chunk)
+        except DBAPIError as ex:
+            progress.done()
+            raise ValueError("rows %d to %d: %s"
+                             % (last - len(chunk) + 1, last, ex.orig))
+        progress.add(len(chunk))
+
+    convertRow = rowConverter(table, keepIds)
+    chunk = []
+    number = 0
+    for number, row in enumerate(readers[format](f), 1):
+        try:
+            chunk.append(convertRow(row))
+        except (ValueError, TypeError) as ex:
+            progress.done()
+            raise ValueError("row %d: %s" % (number, ex))
+        if len(chunk) == chunkSize:
+            insert(chunk, number)
+            chunk = []
+    if chunk:
+        insert(chunk, number)
+    if keepIds:
+        advanceSequence(engine, table)
+    progress.done()
+    return progress.count
+
+
+def advanceSequence(engine, table):
+    """Moves the sequence that PostgreSQL takes the ids of a table from
+    past the highest id in it, which inserting rows with their ids doesn't
+    do. The other databases do that by themselves."""
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as connection:
+        connection.execute(text(
+            "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+            "coalesce(max(id), 0) + 1, false) FROM %s"
+            % engine.dialect.identifier_preparer.quote(table.name)
+        ), table=table.name)
+
+
+def main(argv=None):
+    known = tables()
+    parser = argparse.ArgumentParser(
+        prog="bones-data",
+        description="Imports and exports the data of Bones' modules.")
+    commands = parser.add_subparsers(dest="command")
+    for name, help in (("export", "write a table to a file"),
+                       ("import", "insert the rows in a file into a table")):
+        command = commands.add_parser(name, help=help)
+        command.add_argument("config", help="the configuration file")
+        command.add_argument("table", choices=sorted(known))
+        command.add_argument("file", help="the file to read or write, or - "
+                                          "for stdin or stdout")
+        command.add_argument("-f", "--format", choices=formats,
+                             help="the format of the file, guessed from "
+                                  "its extension by default")
+        command.add_argument("-c", "--chunk-size", type=int, default=10000,
+                             help="the number of rows read or written at "
+                                  "once (default: %(default)s)")
+        command.add_argument("-q", "--quiet", action="store_true",
+                             help="don't report the progress")
+        if name == "import":
+            command.add_argument("--new-ids", action="store_true",
+                                 help="let the database pick the ids "
+                                      "instead of keeping those in the "
+                                      "file")
+    args = parser.parse_args(argv)
+
+    format = args.format or guessFormat(args.file)
+    if format is None:
+        parser.error("can't tell the format of %s, use --format"
+                     % args.file)
+    engine = connect(args.config)
+    table = known[args.table]
+    if args.command == "export":
+        f = sys.stdout if args.file == "-" else open(args.file, "wb")
+        try:
+            exportTable(engine, table, f, format, args.chunk_size,
+                        args.quiet)
+        except DBAPIError as ex:
+            raise SystemExit("Error: Couldn't export %s: %s"
+                             % (args.table, ex.orig))
+        finally:
+            if f is not sys.stdout:
+                f.close()
+    else:
+        f = sys.stdin if args.file == "-" else open(args.file, "rb")
+        try:
+            importTable(engine, table, f, format, args.chunk_size,
+                        not args.new_ids, args.quiet)
+        except ValueError as ex:
+            raise SystemExit("Error: Couldn't import %s: %s"
+                             % (args.file, ex))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+if __name__ == "__main__":
+    main()
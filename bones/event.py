@@ -6,6 +6,9 @@ from twisted.internet import threads
 log = logging.getLogger(__name__)
 
 eventHandlers = {}
+# The events each loaded module has handlers for, per server, so that the
+# handlers of a module can be removed without scanning every event.
+moduleHandlers = {}
 
 
 def is_handler(x):
@@ -49,15 +52,40 @@ def fire(server, event, *args, **kwargs):
         if server.lower() in eventHandlers:
             if event in eventHandlers[server.lower()]:
                 for h in eventHandlers[server.lower()][event]:
-                    try:
-                        h['f'](h['c'], *args, **kwargs)
-                    except Exception as ex:
-                        log.exception(ex)
+                    callHandler(h, args, kwargs)
         if callback:
             callback(*args, **kwargs)
     threads.deferToThread(threadedFire, server, event, *args, **kwargs)
 
 
+def callHandler(h, args, kwargs):
+    # Modules that aren't set up yet get their events later on.
+    if not getattr(h['c'], "ready", True) and \
+            h['c'].holdEvent(h['f'], args, kwargs):
+        return
+    try:
+        h['f'](h['c'], *args, **kwargs)
+    except Exception as ex:
+        log.exception(ex)
+
+
+def deliver(server, obj, event, *args, **kwargs):
+    """Call the event handlers that the given Module has registered for the
+    event identifier, in the current thread. This is used to hand an event
+    over to a module that was loaded while the event was being fired.
+
+    :param server: the server tag that the module runs under.
+    :type server: str
+    :param obj: the :class:`Module` instance to call the handlers of.
+    :type obj: :class:`bones.bot.Module`
+    :param event: the event identifier
+    :type event: object
+    """
+    for h in eventHandlers.get(server.lower(), {}).get(event, ()):
+        if h["c"] is obj:
+            callHandler(h, args, kwargs)
+
+
 def handler(event=None, trigger=None):
     """Marks the decorated callable as an event handler for the given type of
     :term:`event`, or as a trigger handler for the given :term:`trigger`.
@@ -108,14 +136,54 @@ def register(obj, server):
     for name, method in inspect.getmembers(klass, is_handler):
         if getattr(method, '_event', None) is not None:
             for event in method._event:
-                if server.lower() not in eventHandlers:
-                    eventHandlers[server.lower()] = {}
-                if event not in eventHandlers[server.lower()]:
-                    eventHandlers[server.lower()][event] = []
-                eventHandlers[server.lower()][event].append({
-                    "c": obj,
-                    "f": method,
-                })
+                addHandler(obj, server, event, method)
+
+
+def addHandler(obj, server, event, func):
+    """Add a single event handler to the event handler list. `func` is called
+    with `obj` as its first argument, followed by the event arguments.
+
+    This is an internal function used by :func:`register`, and by the server
+    bot factory for modules that are loaded lazily.
+
+    :param obj: the :class:`Module` instance that the handler belongs to.
+    :type obj: :class:`bones.bot.Module`
+    :param server: the server tag that the supplied module runs under.
+    :type server: str
+    :param event: the event identifier
+    :type event: object
+    :param func: the handler
+    :type func: callable
+    """
+    handlers = eventHandlers.setdefault(server.lower(), {})
+    # The handler lists are replaced rather than changed, as they may be
+    # iterated over in an event thread right now.
+    handlers[event] = handlers.get(event, []) + [{
+        "c": obj,
+        "f": func,
+    }]
+    moduleHandlers.setdefault(server.lower(), {}) \
+        .setdefault(obj, set()).add(event)
+
+
+def unregister(obj, server):
+    """Remove all event handlers belonging to a Module from the event handler
+    list. This is the counterpart of :func:`register`, and is called by the
+    server bot factory when a module is unloaded.
+
+    :param obj: the :class:`Module` instance to remove.
+    :type obj: :class:`bones.bot.Module`
+    :param server: the server tag that the supplied module runs under.
+    :type server: str
+    """
+    handlers = eventHandlers.get(server.lower(), {})
+    events = moduleHandlers.get(server.lower(), {}).pop(obj, ())
+    for event in events:
+        remaining = [h for h in handlers.get(event, ()) if h["c"] is not obj]
+        if remaining:
+            handlers[event] = remaining
+        else:
+            handlers.pop(event, None)
 
 
 class Target():
@@ -193,6 +261,27 @@ class User(Target):
         the hostmask above, the username will be :code:`bot`.
         If the provided hostmask is missing the username part, this will
         be :code:`None`.
+
+    .. attribute:: account
+
+        The services account the user is logged in to, or :code:`None` if
+        the user isn't logged in or it isn't known. Filled in by
+        :class:`~bones.bot.UserInfoService`.
+
+    .. attribute:: realname
+
+        The real name of the user, or :code:`None` if it isn't known.
+        Filled in by :class:`~bones.bot.UserInfoService`.
+
+    .. attribute:: infoUpdated
+
+        The time at which :class:`~bones.bot.UserInfoService` last updated
+        the information of this user, or :code:`None` if it never has.
+
+    .. attribute:: stale
+
+        :code:`True` if this user was restored from a state snapshot and
+        hasn't been seen by the bot since.
     """
     def __init__(self, mask, server):
         self.mask = mask
@@ -207,6 +296,10 @@ class User(Target):
             self.hostname = None
         self.channels = []
         self.user_modes = {}
+        self.account = None
+        self.realname = None
+        self.infoUpdated = None
+        self.stale = False
 
     def __repr__(self):
         return "<User %s!%s@%s{%s}>" % (
@@ -259,12 +352,18 @@ class Channel(Target):
 
         An :class:`~bones.event.Topic` instance containing the current
         topic and the user that wrote it.
+
+    .. attribute:: stale
+
+        :code:`True` if this channel was restored from a state snapshot and
+        its user list hasn't been confirmed by the server yet.
     """
     def __init__(self, name, server):
         Target.__init__(self, name, server)
         self.modes = {}
         self.users = []
         self.topic = None
+        self.stale = False
 
     def __repr__(self):
         return "<Channel %s{%s}>" % (self.name, self.server.factory.tag)
@@ -409,7 +508,7 @@ class Event():
 class BotModuleLoaded(Event):
     """
     Called by the :class:`~bones.bot.BonesBotFactory` when a module is
-    loaded during initialization.
+    loaded, either during initialization or later on.
 
     .. attribute:: module
 
@@ -419,6 +518,20 @@ class BotModuleLoaded(Event):
         self.module = module
 
 
+class BotModuleUnloaded(Event):
+    """
+    Called by the :class:`~bones.bot.BonesBotFactory` when a module has been
+    unloaded, either because it was removed from the configuration or
+    because it is being reloaded.
+
+    .. attribute:: module
+
+        The class of the module that was unloaded.
+    """
+    def __init__(self, module):
+        self.module = module
+
+
 class BotNoticeReceivedEvent(Event):
     """
     Fired whenever the bot receives a notice.
@@ -580,27 +693,54 @@ class BotPartEvent(Event):
 
 class BotPreJoinEvent(Event):
     """
-    Called by the bot before the bot joins a channel. This may be
-    used to prevent the bot from joining a channel.
+    Called by the bot before the bot joins a batch of channels. This may be
+    used to prevent the bot from joining the channels. The bot fires one
+    event for every :code:`JOIN` line it is about to send, so a single event
+    may cover several channels.
 
     .. attribute:: client
 
         The client instance that this event applies to.
 
+    .. attribute:: channels
+
+        A list of the names of the channels that the bot is trying to join.
+        Channels removed from this list will not be joined.
+
+    .. attribute:: keys
+
+        A dictionary mapping the names of the channels in :attr:`channels`
+        that require a key to join to their key.
+
     .. attribute:: channel
 
-        The channel that the bot is trying to join, in string format.
+        The names of the channels the bot is trying to join, separated by
+        commas. Setting it replaces :attr:`channels`.
+
+        .. deprecated:: Use :attr:`channels` instead.
 
     .. attribute:: isCancelled
 
         A boolean that tells the bot whether to stop this event
-        chain and prevent the bot from joining a channel.
+        chain and prevent the bot from joining the channels.
 
     """
-    def __init__(self, client, channel):
+    def __init__(self, client, channels, keys=None):
         self.isCancelled = False
         self.client = client
-        self.channel = channel
+        self.channels = channels
+        self.keys = keys if keys is not None else {}
+
+    def _get_channel(self):
+        return ",".join(self.channels)
+    channel = property(_get_channel)
+
+    def __setattr__(self, name, value):
+        # Events are old-style classes, which ignore property setters.
+        if name == "channel":
+            name = "channels"
+            value = [channel for channel in value.split(",") if channel]
+        self.__dict__[name] = value
 
 
 class BotPreQuitEvent(Event):
@@ -609,6 +749,28 @@ class BotPreQuitEvent(Event):
         self.quitMessage = quitMessage
 
 
+class ConfigurationReloadedEvent(Event):
+    """
+    Fired by the :class:`~bones.bot.BonesBotFactory` after the configuration
+    has been reloaded and the changes have been applied to the factory, its
+    client and the loaded modules.
+
+    .. attribute:: factory
+
+        The :class:`~bones.bot.BonesBotFactory` instance whose configuration
+        was reloaded.
+
+    .. attribute:: changes
+
+        A dict mapping the name of every section with changed options to a
+        set of the names of those options, as returned by
+        :meth:`bones.config.ServerConfiguration.reload`.
+    """
+    def __init__(self, factory, changes):
+        self.factory = factory
+        self.changes = changes
+
+
 class ConnectionClosedEvent(Event):
     """
     Called by a bot factory whenever its connection gets closed.
@@ -707,6 +869,63 @@ class ConnectionStartedEvent(Event):
         self.bind_address = bind_address
 
 
+class NetjoinEvent(Event):
+    """
+    Fired when users that were lost in a netsplit join the bot's channels
+    again. All the joins that follow a netsplit are collected into a single
+    event, and no :class:`UserJoinEvent` is fired for them.
+
+    .. attribute:: client
+
+        The client instance that this event applies to.
+
+    .. attribute:: servers
+
+        A tuple of the names of the two servers that were split.
+
+    .. attribute:: users
+
+        A list of :class:`~bones.event.User` instances representing the users
+        that joined.
+
+    .. attribute:: channels
+
+        A dictionary mapping each :class:`~bones.event.Channel` that was
+        joined to a list of the users that joined it.
+    """
+    def __init__(self, client, servers, users, channels):
+        self.client = client
+        self.servers = servers
+        self.users = users
+        self.channels = channels
+
+
+class NetsplitEvent(Event):
+    """
+    Fired when users quit because of a netsplit. All the users lost in the
+    same split are collected into a single event, and no
+    :class:`UserQuitEvent` is fired for them. The users are removed from
+    their channels once all event handlers have been called.
+
+    .. attribute:: client
+
+        The client instance that this event applies to.
+
+    .. attribute:: servers
+
+        A tuple of the names of the two servers that were split.
+
+    .. attribute:: users
+
+        A list of :class:`~bones.event.User` instances representing the users
+        that were lost in the split.
+    """
+    def __init__(self, client, servers, users):
+        self.client = client
+        self.servers = servers
+        self.users = users
+
+
 class PreNicknameInUseError(Event):
     """
     An event that is fired before the bot's username is changed because
@@ -0,0 +1,229 @@
+"""Compressed, append-only archives of old database rows.
+
+An :class:`Archive` keeps one file per month. Rows are moved into it in
+blocks, each holding a header with the number of rows per key (like the
+nickname of a logged message) followed by the rows as zlib-compressed JSON
+lines. Only the headers are read when the archive is opened, which is
+enough to pick a random archived row for a key by decompressing a single
+block.
+"""
+import json
+import os
+import random
+import re
+import struct
+import threading
+import zlib
+from datetime import datetime
+
+from sqlalchemy import and_, or_, select, text
+
+# The lengths of a block's header and body.
+blockHeader = struct.Struct(">II")
+
+reArchiveFile = re.compile(
+    r"^(?P<name>.+)-(?P<month>\d{4}-\d{2}|undated)\.arc$")
+
+
+def decodeKey(value):
+    # Names from IRC are byte strings, JSON gives back unicode.
+    if isinstance(value, str):
+        return value.decode("utf-8", "ignore")
+    return value
+
+
+def encodeValue(value):
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None).isoformat()
+    return value
+
+
+class Archive():
+    """The archive files of one table.
+
+    :param directory: The directory the files are kept in. It is created if
+        it doesn't exist.
+    :type directory: str
+    :param name: The name the files start with, usually the table name.
+    :type name: str
+    :param key: The column rows are counted by.
+    :type key: str
+
+    .. attribute:: counts
+
+        A dict mapping keys to the number of archived rows with that key.
+
+    .. attribute:: lastId
+
+        The highest row id in the archive. Rows are archived in id order,
+        so every row up to this one has been archived. On SQLite the
+        table needs :code:`sqlite_autoincrement` for this to hold once all
+        its rows have been archived, or their ids are handed out again.
+    """
+
+    def __init__(self, directory, name, key):
+        self.directory = directory
+        self.name = name
+        self.key = key
+        self.counts = {}
+        self.blocks = {}
+        self.lastId = 0
+        self._lock = threading.Lock()
+
+    def path(self, month):
+        return os.path.join(self.directory, "%s-%s.arc" % (self.name, month))
+
+    def load(self):
+        """Reads the block headers of all the archive files."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with self._lock:
+            self.counts = {}
+            self.blocks = {}
+            self.lastId = 0
+            for filename in sorted(os.listdir(self.directory)):
+                match = reArchiveFile.match(filename)
+                if not match or match.group("name") != self.name:
+                    continue
+                self._loadFile(os.path.join(self.directory, filename))
+
+    def _loadFile(self, path):
+        with open(path, "rb") as f:
+            while True:
+                offset = f.tell()
+                data = f.read(blockHeader.size)
+                if len(data) < blockHeader.size:
+                    break
+                headerLength, bodyLength = blockHeader.unpack(data)
+                header = f.read(headerLength)
+                if len(header) < headerLength:
+                    break
+                f.seek(bodyLength, os.SEEK_CUR)
+                self._addBlock(path, offset, json.loads(header))
+
+    def _addBlock(self, path, offset, header):
+        for key, count in header["counts"].items():
+            self.counts[key] = self.counts.get(key, 0) + count
+            self.blocks.setdefault(key, []).append((path, offset, count))
+        self.lastId = max(self.lastId, header["last"])
+
+    def append(self, rows):
+        """Appends rows to the files of the months they were made in. The
+        files are synced before this returns.
+
+        :param rows: A list of dicts mapping column names to values, in id
+            order, each with an :code:`id` and a :code:`timestamp`.
+        """
+        months = {}
+        for row in rows:
+            month = "undated"
+            if row["timestamp"] is not None:
+                month = row["timestamp"].strftime("%Y-%m")
+            months.setdefault(month, []).append(row)
+        with self._lock:
+            for month, monthRows in sorted(months.items()):
+                self._appendBlock(self.path(month), monthRows)
+
+    def _appendBlock(self, path, rows):
+        counts = {}
+        for row in rows:
+            counts[row[self.key]] = counts.get(row[self.key], 0) + 1
+        header = json.dumps({"counts": counts, "first": rows[0]["id"],
+                             "last": rows[-1]["id"]})
+        body = zlib.compress("\n".join(
+            json.dumps(dict((k, encodeValue(v)) for k, v in row.items()))
+            for row in rows
+        ), 9)
+        with open(path, "ab") as f:
+            offset = f.tell()
+            f.write(blockHeader.pack(len(header), len(body)))
+            f.write(header)
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        self._addBlock(path, offset, json.loads(header))
+
+    def count(self, key):
+        """Returns the number of archived rows with the given key."""
+        return self.counts.get(decodeKey(key), 0)
+
+    def pick(self, key):
+        """Returns a random archived row with the given key as a dict, or
+        :code:`None` if there are none."""
+        key = decodeKey(key)
+        with self._lock:
+            total = self.counts.get(key, 0)
+            if not total:
+                return None
+            n = random.randrange(total)
+            for path, offset, count in self.blocks[key]:
+                if n < count:
+                    break
+                n -= count
+        with open(path, "rb") as f:
+            f.seek(offset)
+            headerLength, bodyLength = blockHeader.unpack(
+                f.read(blockHeader.size))
+            f.seek(headerLength, os.SEEK_CUR)
+            body = zlib.decompress(f.read(bodyLength))
+        rows = [row for row in (json.loads(line) for line in
+                                body.split("\n"))
+                if row[self.key] == key]
+        return rows[n]
+
+    def archiveRows(self, session, table, cutoff, limit=10000):
+        """Moves up to `limit` rows made before `cutoff` from the table into
+        the archive, in id order. It stops at the first row that is too new,
+        so the archived rows are always those with the lowest ids. This
+        should be called through :meth:`bones.modules.storage.Database.run`.
+
+        :returns: The number of rows archived.
+        """
+        idColumn = table.c.id
+
+        def deleteArchived():
+            # Only rows that are old enough are deleted, in case the archive
+            # has outlived the database.
+            session.execute(table.delete().where(and_(
+                idColumn <= self.lastId,
+                or_(table.c.timestamp < cutoff, table.c.timestamp.is_(None))
+            )))
+        # Rows that were archived by a run that didn't get to delete them.
+        deleteArchived()
+        self._reserveIds(session, table)
+        rows = session.execute(
+            select([table]).where(idColumn > self.lastId)
+            .order_by(idColumn).limit(limit)
+        )
+        archived = []
+        for row in rows:
+            if row["timestamp"] is not None and \
+                    row["timestamp"].replace(tzinfo=None) >= cutoff:
+                break
+            archived.append(dict(row))
+        if not archived:
+            return 0
+        self.append(archived)
+        deleteArchived()
+        return len(archived)
+
+    def _reserveIds(self, session, table):
+        # Rows with ids up to lastId are taken to have been archived, so new
+        # rows mustn't get those ids. AUTOINCREMENT keeps SQLite from
+        # reusing the ids it has handed out, but the table may have been
+        # emptied before it had that, or the archive may have outlived it.
+        if session.get_bind().dialect.name != "sqlite" or \
+                not table.dialect_options["sqlite"]["autoincrement"]:
+            return
+        values = {"name": table.name, "seq": self.lastId}
+        seq = session.execute(text(
+            "SELECT seq FROM sqlite_sequence WHERE name = :name"),
+            values).scalar()
+        if seq is None:
+            session.execute(text(
+                "INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"
+            ), values)
+        elif seq < self.lastId:
+            session.execute(text(
+                "UPDATE sqlite_sequence SET seq = :seq WHERE name = :name"),
+                values)
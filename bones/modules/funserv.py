@@ -4,29 +4,34 @@ import random
 from datetime import datetime
 import urllib2
 
-from twisted.internet import reactor
+from twisted.internet import reactor, task
 from sqlalchemy import (
     Column,
     Integer,
     Text,
 )
 
-from bones.bot import Module
+from bones.bot import LazyImport, Module
+from bones.config import (
+    Option,
+    Schema,
+    boolean,
+    duration,
+    integer,
+    number,
+)
 import bones.event
 from bones.modules import storage
 
 
 class QDB(Module):
-    try:
-        from bs4 import BeautifulSoup
-    except ImportError:
-        BeautifulSoup = None
+    BeautifulSoup = LazyImport("bs4", "BeautifulSoup")
 
     quotesCache = []
 
     def __init__(self, settings, factory):
         Module.__init__(self, settings, factory)
-        if not self.BeautifulSoup:
+        if not self.BeautifulSoup.available:
             ex = Exception(
                 "Unmet dependency: BeautifulSoup 4 not installed. This "
                 "dependency needs to be installed before you can use the "
@@ -128,10 +133,11 @@ class QDB(Module):
 
 class Factoid(storage.Base):
     __tablename__ = "bones_factoids"
+    __table_args__ = {"extend_existing": True}
 
     id = Column(Integer, primary_key=True)
     submitter = Column(Text)
-    topic = Column(Text)
+    topic = Column(Text, index=True)
     fact = Column(Text)
 
     def __init__(self, topic, fact, submitter):
@@ -140,76 +146,346 @@ class Factoid(storage.Base):
         self.fact = fact
 
 
+def _lookupMode(value):
+    """Option type for the lookup mode of :class:`Factoids`."""
+    value = value.strip().lower()
+    if value not in ("exact", "fuzzy"):
+        raise ValueError("not a lookup mode: %r" % value)
+    return value
+
+
+def trigrams(text):
+    """Returns the set of trigrams of a text, ignoring case. Each word is
+    padded with two spaces in front and one behind, so that short words
+    and the starts of words count for more."""
+    result = set()
+    for word in text.lower().split():
+        word = u"  %s " % word
+        for i in range(len(word) - 2):
+            result.add(word[i:i + 3])
+    return result
+
+
+class TopicIndex():
+    """Keeps the normalized topics of all factoids in memory, so that
+    messages that don't ask about a known topic never reach the store.
+    The factoids added to the store since the last :meth:`refresh` are
+    read by id, and those learned or forgotten here are passed to
+    :meth:`add` and :meth:`remove` right away. It is only used from the
+    reactor thread.
+
+    If `fuzzy` is set, the trigrams of every topic are indexed as well, so
+    that :meth:`similar` can find topics that are spelled differently by
+    looking only at the topics sharing a trigram with the query.
+
+    :param store: The store the factoids are kept in.
+    :type store: :class:`bones.modules.stores.Store`
+    :param normalize: A function that returns the normalized form of a
+        topic, which is what topics are looked up by.
+    :param fuzzy: Whether to keep the trigram index.
+    :type fuzzy: bool
+    """
+
+    def __init__(self, store, normalize, fuzzy=False):
+        self.store = store
+        self.normalize = normalize
+        self.fuzzy = fuzzy
+        self.lastId = 0
+        # Maps the ids of the factoids to their topics.
+        self.ids = {}
+        # Maps normalized topics to the topics stored under them, each with
+        # the number of factoids it has.
+        self.topics = {}
+        # Maps trigrams to the normalized topics containing them, and
+        # normalized topics to their number of trigrams.
+        self.trigrams = {}
+        self.trigramCounts = {}
+
+    def refresh(self):
+        """Adds the factoids that have been stored since the last refresh.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` that fires
+            once they have been added.
+        """
+        def added(rows):
+            for row in rows:
+                self.add(row.id, row.topic)
+                self.lastId = max(self.lastId, row.id)
+        return self.store.rows(Factoid.__table__, self.lastId) \
+            .addCallback(added)
+
+    def add(self, id, value):
+        """Adds a factoid, unless it's been added already."""
+        if id in self.ids:
+            return
+        if isinstance(value, str):
+            value = value.decode("utf-8", "ignore")
+        self.ids[id] = value
+        key = self.normalize(value)
+        if self.fuzzy and key not in self.topics:
+            grams = trigrams(key)
+            for gram in grams:
+                self.trigrams.setdefault(gram, set()).add(key)
+            self.trigramCounts[key] = len(grams)
+        stored = self.topics.setdefault(key, {})
+        stored[value] = stored.get(value, 0) + 1
+
+    def remove(self, id):
+        """Removes a forgotten factoid."""
+        value = self.ids.pop(id, None)
+        # Like SQLite, the stores hand the id of the last row out again
+        # once it has been deleted.
+        if id == self.lastId:
+            self.lastId = id - 1
+        if value is None:
+            return
+        key = self.normalize(value)
+        stored = self.topics.get(key)
+        if stored is None or value not in stored:
+            return
+        stored[value] -= 1
+        if not stored[value]:
+            del stored[value]
+        if not stored:
+            del self.topics[key]
+            if self.fuzzy:
+                for gram in trigrams(key):
+                    keys = self.trigrams.get(gram)
+                    keys.discard(key)
+                    if not keys:
+                        del self.trigrams[gram]
+                del self.trigramCounts[key]
+
+    def lookup(self, topic):
+        """Returns a list of the stored topics that `topic` normalizes to
+        the same as, which is empty if there are none."""
+        return list(self.topics.get(self.normalize(topic), ()))
+
+    def similar(self, topic, threshold=0.5, limit=3):
+        """Returns the normalized topics that are most similar to `topic`,
+        best first, along with their similarity. The similarity is the
+        Dice coefficient of the trigrams, from 0 to 1, which is 1 for
+        topics that only differ in case.
+
+        :param threshold: The lowest similarity of the topics returned.
+        :type threshold: float
+        :param limit: The most topics returned.
+        :type limit: int
+        :returns: A list of tuples of the normalized topic and its
+            similarity.
+        """
+        grams = trigrams(self.normalize(topic))
+        if not grams:
+            return []
+        shared = {}
+        for gram in grams:
+            for key in self.trigrams.get(gram, ()):
+                shared[key] = shared.get(key, 0) + 1
+        scores = [
+            (2.0 * count / (len(grams) + self.trigramCounts[key]), key)
+            for key, count in shared.items()
+        ]
+        scores = [(key, score) for score, key in scores
+                  if score >= threshold]
+        scores.sort(key=lambda match: (-match[1], match[0]))
+        return scores[:limit]
+
+    def storedTopics(self, key):
+        """Returns a list of the stored topics under a normalized topic."""
+        return list(self.topics.get(key, ()))
+
+
 class Factoids(Module):
+    """Remembers facts taught with :code:`learn <topic> is <fact>`, and
+    tells them when someone says :code:`?<topic>`. :code:`forget <topic>`
+    forgets the facts a user has taught about a topic.
+
+    The factoids are kept in the store of the
+    :class:`~bones.modules.storage.Database`, and the known topics in a
+    :class:`TopicIndex`, so questions that aren't about one are answered
+    without a lookup. Factoids learned by other processes sharing the
+    database are picked up every
+    :code:`topicRefresh`. If :code:`ignoreCase` is set topics are matched
+    regardless of case, and if :code:`ignorePunctuation` is set,
+    punctuation around them is ignored as well, so that "?Bones?" finds
+    the facts about "bones".
+
+    If :code:`lookup` is :code:`fuzzy`, questions that don't match a topic
+    are looked up in the trigram index of the :class:`TopicIndex`. A topic
+    that only differs in case is answered, and otherwise the topics at
+    least :code:`fuzzyThreshold` similar are suggested."""
+    dependencies = ("bones.modules.storage.Database",)
     reLearn = re.compile("(.+) is (.+)")
+    rePunctuation = re.compile(r"^[^\w]+|[^\w]+$", re.UNICODE)
+
+    configSchema = Schema(
+        ignoreCase=Option("module.Factoids", "ignoreCase", boolean, False),
+        ignorePunctuation=Option("module.Factoids", "ignorePunctuation",
+                                 boolean, False),
+        topicRefresh=Option("module.Factoids", "topicRefresh", duration,
+                            60.0),
+        lookup=Option("module.Factoids", "lookup", _lookupMode, "exact"),
+        fuzzyThreshold=Option("module.Factoids", "fuzzyThreshold", number,
+                              0.5),
+        suggestions=Option("module.Factoids", "suggestions", integer, 3),
+    )
+
+    def __init__(self, *args, **kwargs):
+        Module.__init__(self, *args, **kwargs)
+        self._refresher = task.LoopingCall(self.refreshTopics)
+
+    def setup(self):
+        self.db = self.factory.getModule("bones.modules.storage.Database")
+        self.store = self.db.store
+        self.topics = TopicIndex(self.store, self.normalizeTopic,
+                                 self.config.lookup == "fuzzy")
+        d = self.topics.refresh()
+        d.addCallback(self.startRefreshing)
+        return d
 
-    @bones.event.handler(event=storage.DatabaseInitializedEvent)
-    def gotDB(self, event):
-        self.db = event.module
+    def startRefreshing(self, result=None):
+        self._refresher.start(self.config.topicRefresh, now=False)
+
+    def unload(self):
+        if self._refresher.running:
+            self._refresher.stop()
+
+    def refreshTopics(self):
+        d = self.topics.refresh()
+        d.addErrback(self.databaseError)
+        return d
+
+    def normalizeTopic(self, topic):
+        """Returns the form of a topic it is looked up by."""
+        if isinstance(topic, str):
+            topic = topic.decode("utf-8", "ignore")
+        if self.config.ignorePunctuation:
+            topic = self.rePunctuation.sub("", topic)
+        if self.config.ignoreCase:
+            topic = topic.lower()
+        return u" ".join(topic.split())
 
     @bones.event.handler(trigger="learn")
     def cmdLearnFactoid(self, event):
         match = self.reLearn.match(" ".join(event.args))
         if match:
-            session = self.db.new_session()
-            session.begin()
             topic = match.group(1)
             fact = match.group(2)
-            factoid = Factoid(
-                topic,
-                fact,
-                event.user.nickname
-            )
-            session.add(factoid)
-            session.commit()
-            session.close()
-            event.reply("I understand")
+
+            def learned(id):
+                self.topics.add(id, topic)
+                event.reply("I understand")
+            d = self.store.append(Factoid.__table__, {
+                "topic": topic,
+                "fact": fact,
+                "submitter": event.user.nickname,
+            })
+            d.addCallback(learned)
+            d.addErrback(self.databaseError)
+
+    @bones.event.handler(trigger="forget")
+    def cmdForgetFactoid(self, event):
+        topic = " ".join(event.args)
+        stored = self.topics.lookup(topic)
+        if not stored:
+            event.user.notice("I don't know anything about that.")
+            return
+
+        def forgotten(factoids):
+            if not factoids:
+                event.user.notice("You haven't taught me anything about "
+                                  "that.")
+                return
+            for factoid in factoids:
+                self.topics.remove(factoid.id)
+            event.reply("I forgot %d thing%s about %s"
+                        % (len(factoids), "s" if len(factoids) > 1 else "",
+                           topic))
+        d = self.store.delete(Factoid.__table__, topic=stored,
+                              submitter=event.user.nickname)
+        d.addCallback(forgotten)
+        d.addErrback(self.databaseError)
 
     @bones.event.handler(event=bones.event.IrcPrivmsgEvent)
     def queryFactoid(self, event):
         if event.message.startswith("?"):
             topic = event.message[1:]
-            session = self.db.new_session()
-            factoids = session.query(Factoid) \
-                .filter(Factoid.topic == topic).all()
-            if not factoids:
+            stored = self.topics.lookup(topic)
+            if not stored and self.config.lookup == "fuzzy":
+                stored = self.fuzzyLookup(topic, event)
+            if not stored:
                 return
-            msg = "%s is" % topic.decode("utf-8")
-            i = 0
-            if len(factoids) > 1:
-                for factoid in factoids:
-                    if i > 0:
-                        msg = msg + ", or"
-                    i += 1
-                    msg = msg + " (#%d) %s" % (i, factoid.fact)
-            else:
-                msg = msg + " %s" % factoids[0].fact
-            event.reply(msg.encode("utf-8"))
-            session.close()
+            d = self.store.get(Factoid.__table__, topic=stored)
+            d.addCallback(self.sendFactoids, event, topic)
+            d.addErrback(self.databaseError)
+
+    def fuzzyLookup(self, topic, event):
+        """Returns the stored topics of a topic that only differs in case
+        from `topic`, or suggests the most similar topics and returns an
+        empty list."""
+        matches = self.topics.similar(topic, self.config.fuzzyThreshold,
+                                      self.config.suggestions)
+        if not matches:
+            return []
+        key, score = matches[0]
+        if key.lower() == self.normalizeTopic(topic).lower():
+            return self.topics.storedTopics(key)
+        names = []
+        for key, score in matches:
+            stored = self.topics.storedTopics(key)
+            if stored:
+                names.append(min(stored))
+        if names:
+            event.reply((u"Did you mean %s?"
+                         % u", ".join(names)).encode("utf-8"))
+        return []
+
+    def sendFactoids(self, factoids, event, topic):
+        if not factoids:
+            return
+        msg = "%s is" % topic.decode("utf-8")
+        i = 0
+        if len(factoids) > 1:
+            for factoid in factoids:
+                if i > 0:
+                    msg = msg + ", or"
+                i += 1
+                msg = msg + " (#%d) %s" % (i, factoid.fact)
+        else:
+            msg = msg + " %s" % factoids[0].fact
+        event.reply(msg.encode("utf-8"))
+
+    def databaseError(self, failure):
+        self.log.error("Database query failed: %s",
+                       failure.getTraceback())
 
 
 class UselessResponses(Module):
+    persistentState = ("danceCooldown",)
+
+    configSchema = Schema(
+        danceCooldownTime=Option("module.UselessResponses", "dance.cooldown",
+                                 integer, 300),
+    )
+
     def __init__(self, *args, **kwargs):
         Module.__init__(self, *args, **kwargs)
 
         self.danceCooldown = {}
-        self.danceCooldownTime = None
 
     @bones.event.handler(event=bones.event.ChannelMessageEvent)
     def DANCE(self, event, step=0):
         msg = re.sub("\x02|\x1f|\x1d|\x16|\x0f|\x03\d{0,2}(,\d{0,2})?", "",
                      event.message)
         if "DANCE" in msg:
-            if not self.danceCooldownTime:
-                self.danceCooldownTime = int(self.settings.get(
-                    "module.UselessResponses", "dance.cooldown", "300"))
             if step == 0:
                 if event.channel.name in self.danceCooldown:
                     last = self.danceCooldown[event.channel.name]
                     now = datetime.utcnow()
                     delta = now - last
-                    if delta.seconds < self.danceCooldownTime:
-                        wait = self.danceCooldownTime - delta.seconds
+                    cooldown = self.config.danceCooldownTime
+                    if delta.seconds < cooldown:
+                        wait = cooldown - delta.seconds
                         event.user.notice("Please wait %s more seconds."
                                           % wait)
                         return
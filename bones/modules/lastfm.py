@@ -8,13 +8,16 @@ from sqlalchemy import (
     Integer,
     Text,
 )
+from twisted.internet import reactor, threads
 
 import bones.event
 from bones.bot import Module
 from bones.modules import storage
+from bones.modules.stores import Row
 
 
 class Lastfm(Module):
+    dependencies = ("bones.modules.storage.Database",)
 
     def __init__(self, *args, **kwargs):
         Module.__init__(self, *args, **kwargs)
@@ -23,9 +26,9 @@ class Lastfm(Module):
         if not self.apikey:
             self.log.error("No API key provided. Last.fm will be disabled.")
 
-    @bones.event.handler(event=storage.DatabaseInitializedEvent)
-    def gotDB(self, event):
-        self.db = event.module
+    def setup(self):
+        self.db = self.factory.getModule("bones.modules.storage.Database")
+        self.store = self.db.store
 
     @bones.event.handler(trigger="lastfm")
     def trigger(self, event):
@@ -60,9 +63,17 @@ class Lastfm(Module):
         data = json.loads(data)
         return data
 
+    def query(self, operation, *args, **kwargs):
+        """Runs one of the operations of the
+        :class:`~bones.modules.stores.Store`, like :code:`"get"`, and waits
+        for its result. The handlers here wait for the Last.fm API anyway,
+        so they might as well wait for the store too."""
+        return threads.blockingCallFromThread(
+            reactor, getattr(self.store, operation), User.__table__, *args,
+            **kwargs)
+
     def showTrack(self, event, nickname, username):
-        session = self.db.new_session()
-        user = self.getUser(session, nickname, username)
+        user = self.getUser(nickname, username)
         if not user:
             event.channel.msg(
                 str("%s: No user registered for nick '%s'"
@@ -148,23 +159,23 @@ class Lastfm(Module):
         event.channel.msg(str(msg.encode("utf-8")))
 
     def registerUser(self, event, username):
-        session = self.db.new_session()
         if not username:
             event.user.notice(str(
                 "[Last.fm] You need to provide a Last.fm username."))
             return
 
-        user = self.getUser(session, event.user.nickname, username)
-        user.username = username
-        session.begin()
-        session.add(user)
-        session.commit()
+        user = self.getUser(event.user.nickname, username)
+        if not user:
+            event.user.notice(str(
+                "[Last.fm] No Last.fm user named '%s'." % username))
+            return
+        if user.username != username:
+            self.query("update", {"username": username}, id=user.id)
         event.user.notice(str(
             "[Last.fm] Registered '%s' to your nick." % username))
 
     def deleteUser(self, event):
-        session = self.db.new_session()
-        user = self.getUser(session, event.user.nickname)
+        user = self.getUser(event.user.nickname)
         if not user:
             event.user.notice(str(
                 "[Last.fm] No user registered for nick '%s'."
@@ -172,9 +183,7 @@ class Lastfm(Module):
             ))
             return
 
-        session.begin()
-        session.delete(user)
-        session.commit()
+        self.query("delete", id=user.id)
         event.user.notice(str(
             "[Last.fm] Unregistered your nick from '%s'." % user.username))
 
@@ -195,12 +204,10 @@ class Lastfm(Module):
             username = nickname
         return (nickname, username, action)
 
-    def getUser(self, session, nickname, username=None):
-        user = session.query(User).filter(User.nickname == nickname) \
-            .first()
-
-        if user or not username:
-            return user
+    def getUser(self, nickname, username=None):
+        users = self.query("get", nickname=nickname)
+        if users or not username:
+            return users[0] if users else None
 
         if not username:
             username = nickname
@@ -209,19 +216,17 @@ class Lastfm(Module):
             return None
 
         self.log.info("Found account for unknown user '%s', saving.", nickname)
-        user = User(nickname)
-        user.username = username
-        session.begin()
-        session.add(user)
-        session.commit()
+        user = Row(nickname=nickname, username=username)
+        user["id"] = self.query("append", user)
         return user
 
 
 class User(storage.Base):
     __tablename__ = "bones_lastfm"
+    __table_args__ = {"extend_existing": True}
 
     id = Column(Integer, primary_key=True)
-    nickname = Column(Text)
+    nickname = Column(Text, index=True)
     username = Column(Text)
 
     def __init__(self, nickname):
@@ -248,7 +253,7 @@ if __name__ == "__main__":
     print("Connecting to '%s'..."
           % settings._sections["storage"]["sqlalchemy.url"])
     engine = engine_from_config(settings._sections["storage"], "sqlalchemy.")
-    print "Creating table '%s'..." % User.__tablename__
-    from bones.modules.storage import Base
-    Base.metadata.create_all(engine)
+    print "Creating or upgrading table '%s'..." % User.__tablename__
+    from bones.modules.storage import migrate
+    migrate(engine, [User.__table__])
     print "Have a nice day!"
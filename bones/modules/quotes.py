@@ -1,4 +1,5 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import random
 
 from sqlalchemy import (
     Column,
@@ -7,42 +8,203 @@ from sqlalchemy import (
     Enum,
     DateTime,
 )
-from sqlalchemy.sql.expression import func
+from twisted.internet import task, threads
 
 import bones.event
 import bones.bot
+from bones.config import (
+    Option,
+    Schema,
+    boolean,
+    duration,
+    integer,
+    string,
+)
 from bones.modules import storage
+from bones.modules.archive import Archive
+from bones.modules.stores import Row
 
 
-class UserQuotes(bones.bot.Module):
+def parsePage(args):
+    """Splits a leading :code:`-p <page>` off the arguments of a search.
+
+    :returns: A tuple of the page number, starting at 1, and the remaining
+        arguments.
+    """
+    if len(args) >= 2 and args[0] == "-p" and args[1].isdigit():
+        return max(int(args[1]), 1), args[2:]
+    return 1, args
 
-    @bones.event.handler(event=storage.DatabaseInitializedEvent)
-    def gotDB(self, event):
-        self.db = event.module
+
+class UserQuotes(bones.bot.Module):
+    """Logs every message and action seen in the channels, and sends a
+    random one when triggered. Messages are written to the store of the
+    :class:`~bones.modules.storage.Database` in batches by a
+    :class:`~bones.modules.storage.BatchWriter`, so the latest few may not
+    be picked yet.
+
+    If :code:`search` is enabled, the logged messages can be searched with
+    the :code:`quotesearch` trigger.
+
+    If :code:`archiveAfter` is set, messages older than that are moved out
+    of the database into monthly :class:`~bones.modules.archive.Archive`
+    files every :code:`archiveInterval`. :code:`quoterandom -a` picks from
+    the archived messages as well. Archiving needs the :code:`sqlalchemy`
+    storage backend."""
+    dependencies = ("bones.modules.storage.Database",)
+
+    configSchema = Schema(
+        batchSize=Option("module.UserQuotes", "batchSize", integer, 100),
+        batchInterval=Option("module.UserQuotes", "batchInterval",
+                             duration, 1.0),
+        bufferLimit=Option("module.UserQuotes", "bufferLimit", integer,
+                           10000),
+        search=Option("module.UserQuotes", "search", boolean, False),
+        archiveAfter=Option("module.UserQuotes", "archiveAfter", duration,
+                            0),
+        archiveInterval=Option("module.UserQuotes", "archiveInterval",
+                               duration, 3600.0),
+        archiveDirectory=Option("module.UserQuotes", "archiveDirectory",
+                                string, "archive"),
+    )
+    # The most rows archived in one query.
+    archiveBatchSize = 10000
+
+    def __init__(self, *args, **kwargs):
+        bones.bot.Module.__init__(self, *args, **kwargs)
+        self.writer = None
+        self.archive = None
+        self._archiver = task.LoopingCall(self.archiveOld)
+
+    def setup(self):
+        self.db = self.factory.getModule("bones.modules.storage.Database")
+        self.writer = storage.BatchWriter(
+            self.db, UserQuote.__table__, self.config.batchSize,
+            self.config.batchInterval, self.config.bufferLimit
+        )
+        self.writer.start()
+        self.store = self.db.store
+        search = ("quote",) if self.config.search else ()
+        d = self.store.prepare(UserQuote.__table__, pick=("nickname",),
+                               search=search)
+        if self.config.archiveAfter and self.db.engine is None:
+            self.log.warn("Messages can only be archived with the "
+                          "sqlalchemy storage backend")
+        elif self.config.archiveAfter:
+            self.archive = Archive(self.config.archiveDirectory,
+                                   UserQuote.__tablename__, "nickname")
+            d.addCallback(lambda result:
+                          threads.deferToThread(self.archive.load))
+            d.addCallback(self.startArchiving)
+        return d
+
+    def startArchiving(self, result=None):
+        # The Deferred returned by start() only fires once the archiver is
+        # stopped, so it mustn't hold up the setup.
+        self._archiver.start(self.config.archiveInterval)
+
+    def unload(self):
+        if self.writer is not None:
+            self.writer.stop()
+        if self._archiver.running:
+            self._archiver.stop()
+
+    def archiveOld(self):
+        """Moves the messages older than :code:`archiveAfter` to the
+        archive, a batch at a time."""
+        cutoff = datetime.now() - timedelta(seconds=self.config.archiveAfter)
+
+        def archived(count):
+            if not count:
+                return
+            self.log.info("Archived %d messages", count)
+            self.store.discardBefore(UserQuote.__table__,
+                                     self.archive.lastId + 1)
+            if count == self.archiveBatchSize:
+                return archiveBatch()
+
+        def archiveBatch():
+            d = self.db.run(self.archive.archiveRows, UserQuote.__table__,
+                            cutoff, self.archiveBatchSize)
+            d.addCallback(archived)
+            return d
+        return archiveBatch().addErrback(
+            lambda failure: self.log.error("Unable to archive messages: %s",
+                                           failure.getTraceback()))
+
+    def metrics(self):
+        if self.writer is None:
+            return {}
+        return self.writer.metrics()
 
     @bones.event.handler(trigger="quoterandom")
     def trigger(self, event):
-        session = self.db.new_session()
+        args = event.args
+        archived = bool(args) and args[0] == "-a"
+        if archived:
+            args = args[1:]
         nick = event.user.nickname
-        if len(event.args) > 0:
-            nick = event.args[0]
-        quote = (
-            session.query(UserQuote)
-
-            .filter(UserQuote.nickname == nick)
-            .order_by(func.random())
-            .limit(1)
-            .first()
-        )
+        if len(args) > 0:
+            nick = args[0]
+
+        if archived and self.archive is not None:
+            d = self.pickArchived(nick)
+        else:
+            d = self.store.pick(UserQuote.__table__, nickname=nick)
+        d.addCallback(self.sendQuote, event)
+        d.addErrback(self.databaseError)
+
+    def pickArchived(self, nick):
+        """Picks a random message by `nick` from both the database and the
+        archive."""
+        def counted(live):
+            total = live + self.archive.count(nick)
+            if not total:
+                return None
+            if random.randrange(total) < live:
+                return self.store.pick(UserQuote.__table__, nickname=nick)
+            return threads.deferToThread(self.archive.pick, nick) \
+                .addCallback(Row)
+        return self.store.count(UserQuote.__table__, nickname=nick) \
+            .addCallback(counted)
+
+    def sendQuote(self, quote, event):
         if not quote:
             event.channel.msg(str("%s: The specified user is very quiet!"
                                   % event.user.nickname))
             return
+        event.channel.msg(self.formatQuote(quote))
+
+    def formatQuote(self, quote):
         style = "<%s> %s"
         if quote.type == "action":
             style = "* %s %s"
-        event.channel.msg(str((style %
-                               (quote.nickname, quote.quote)).encode("utf-8")))
+        return str((style % (quote.nickname, quote.quote)).encode("utf-8"))
+
+    @bones.event.handler(trigger="quotesearch")
+    def cmdSearch(self, event):
+        """Sends the best logged message containing all the given words, or
+        the one on the page given with :code:`-p`."""
+        if not self.config.search:
+            event.user.notice("[Quote] Searching is disabled.")
+            return
+        page, args = parsePage(event.args)
+        if not args:
+            event.user.notice("[Quote] You need to provide a search term!")
+            return
+        term = " ".join(args)
+
+        def found(result):
+            total, quotes = result
+            if not quotes:
+                event.channel.msg("[Quote] No results found")
+                return
+            event.channel.msg("[Quote] Match %d of %d: %s"
+                              % (page, total, self.formatQuote(quotes[0])))
+        d = self.store.search(UserQuote.__table__, "quote", term, 1,
+                              page - 1)
+        d.addCallback(found)
+        d.addErrback(self.databaseError)
 
     @bones.event.handler(event=bones.event.ChannelMessageEvent)
     @bones.event.handler(event=bones.event.UserActionEvent)
@@ -55,24 +217,29 @@ class UserQuotes(bones.bot.Module):
             msg = event.message
         tmp = msg.strip()
         if tmp[1:].lower() != "quoterandom":
-            session = self.db.new_session()
-            quote = UserQuote(
-                event.user.nickname,
-                event.channel.name,
-                msg.decode("utf-8", "ignore"),
-                eventtype
+            self.writer.add(
+                nickname=event.user.nickname,
+                channel=event.channel.name,
+                quote=msg.decode("utf-8", "ignore"),
+                type=eventtype,
+                timestamp=datetime.now(),
             )
-            session.begin()
-            session.add(quote)
-            session.commit()
-            session.close()
+
+    def databaseError(self, failure):
+        self.log.error("Database query failed: %s",
+                       failure.getTraceback())
 
 
 class ChannelQuotes(bones.bot.Module):
+    dependencies = ("bones.modules.storage.Database",)
+    # The number of quote ids listed per page of search results.
+    searchPageSize = 10
 
-    @bones.event.handler(event=storage.DatabaseInitializedEvent)
-    def gotDB(self, event):
-        self.db = event.module
+    def setup(self):
+        self.db = self.factory.getModule("bones.modules.storage.Database")
+        self.store = self.db.store
+        return self.store.prepare(ChannelQuote.__table__, pick=("channel",),
+                                  search=("quote",))
 
     @bones.event.handler(trigger="quote")
     def trigger(self, event):
@@ -101,39 +268,41 @@ class ChannelQuotes(bones.bot.Module):
             event.user.notice("[Quote] Quote id needs to be a number!")
             return
 
-        session = self.db.new_session()
-        quote = (
-            session.query(ChannelQuote)
-
-            .filter(ChannelQuote.id == event.args[1])
-            .limit(1)
-            .first()
-        )
-
-        if not quote:
-            event.channel.notice("[Quote] No such quote '%s'"
-                                 % event.args[1])
-            return
-
-        dateThen = quote.timestamp.replace(tzinfo=None)
-        dateNow = datetime.now()
-        diff = dateNow - dateThen
-        if quote.submitter != event.user.nickname:
-            event.user.notice(
-                "[Quote] You do not have permission do delete this quote."
-            )
-            return
-        if diff.seconds > 3600:
-            event.user.notice(
-                "[Quote] This quote has been archived and thus cannot be "
-                "removed."
-            )
-            return
-
-        session.begin()
-        session.delete(quote)
-        session.commit()
-        event.channel.msg("[Quote] Quote #%s deleted." % event.args[1])
+        id = int(event.args[1])
+
+        def deleteQuote(quotes):
+            if not quotes:
+                event.channel.notice("[Quote] No such quote '%s'"
+                                     % event.args[1])
+                return None
+            quote = quotes[0]
+
+            dateThen = quote.timestamp.replace(tzinfo=None)
+            dateNow = datetime.now()
+            diff = dateNow - dateThen
+            if quote.submitter != event.user.nickname:
+                event.user.notice(
+                    "[Quote] You do not have permission do delete this "
+                    "quote."
+                )
+                return None
+            if diff.seconds > 3600:
+                event.user.notice(
+                    "[Quote] This quote has been archived and thus cannot "
+                    "be removed."
+                )
+                return None
+
+            return self.store.delete(ChannelQuote.__table__, id=id)
+
+        def deleted(quotes):
+            if quotes:
+                event.channel.msg("[Quote] Quote #%s deleted."
+                                  % event.args[1])
+        d = self.store.get(ChannelQuote.__table__, id=id)
+        d.addCallback(deleteQuote)
+        d.addCallback(deleted)
+        d.addErrback(self.databaseError, event)
 
     def cmdQuoteAdd(self, event):
         """Adds a quote to the quote database for the current channel."""
@@ -142,58 +311,52 @@ class ChannelQuotes(bones.bot.Module):
             event.user.notice(str("[Quote] That quote is empty!"))
             return
 
-        cquote = ChannelQuote(
-            event.user.nickname,
-            event.channel.name,
-            quote.decode("utf-8", "ignore"),
-        )
-        session = self.db.new_session()
-        session.begin()
-        session.add(cquote)
-        session.commit()
-        event.channel.msg("Quote #%i saved." % cquote.id)
+        d = self.store.append(ChannelQuote.__table__, {
+            "submitter": event.user.nickname,
+            "channel": event.channel.name,
+            "quote": quote.decode("utf-8", "ignore"),
+            "timestamp": datetime.now(),
+        })
+        d.addCallback(lambda id: event.channel.msg("Quote #%i saved." % id))
+        d.addErrback(self.databaseError, event)
 
     def cmdQuoteRandom(self, event):
         """Sends a random quote from the current channel's quote database."""
-        session = self.db.new_session()
-        quote = (
-            session.query(ChannelQuote)
-
-            .filter(ChannelQuote.channel == event.channel.name)
-            .order_by(func.random())
-            .limit(1)
-            .first()
-        )
-        self.sendQuote(event, quote)
+        d = self.store.pick(ChannelQuote.__table__,
+                            channel=event.channel.name)
+        d.addCallback(self.sendQuote, event)
+        d.addErrback(self.databaseError, event)
 
     def cmdQuoteSearch(self, event):
-        """Searches for a quote matching the given string and returns results
-        from all channels' quote database."""
-        if len(event.args) < 2:
+        """Searches all channels' quote database for quotes containing all
+        the given words, and sends the ids of the best matches. Further
+        pages of results are requested with :code:`-p <page>`."""
+        page, args = parsePage(event.args[1:])
+        if not args:
             event.user.notice("[Quote] You need to provide a search term!")
             return
-        term = " ".join(event.args[1:])
-
-        session = self.db.new_session()
-        quotes = (
-            session.query(ChannelQuote)
-
-            .filter(ChannelQuote.quote.like("%%%s%%" % term))
-            .order_by(ChannelQuote.id.asc())
-            .all()
-        )
-        if len(quotes) > 1:
-            results = ""
-            for result in quotes:
-                if results != "":
-                    results = results + ", "
-                results = results + ("#%d" % result.id)
-            event.channel.msg("[Quote] Results found: %s" % results)
+        term = " ".join(args)
+        offset = (page - 1) * self.searchPageSize
+        d = self.store.search(ChannelQuote.__table__, "quote", term,
+                              self.searchPageSize, offset)
+        d.addCallback(self.sendSearchResults, event, page, offset)
+        d.addErrback(self.databaseError, event)
+
+    def sendSearchResults(self, result, event, page, offset):
+        total, quotes = result
+        if total == 1 and quotes:
+            self.sendQuote(quotes[0], event)
             return
-        if len(quotes) == 1:
-            self.sendQuote(event, quotes.pop())
+        if not quotes:
+            event.channel.msg("[Quote] No results found")
             return
-        event.channel.msg("[Quote] No results found")
+        msg = "[Quote] Results %d-%d of %d: %s" % (
+            offset + 1, offset + len(quotes), total,
+            ", ".join("#%d" % quote.id for quote in quotes)
+        )
+        if offset + len(quotes) < total:
+            msg += " (-p %d for more)" % (page + 1)
+        event.channel.msg(msg)
 
     def cmdQuoteRead(self, event):
         """Sends the quote matching the given ID to the current channel."""
@@ -204,17 +367,18 @@ class ChannelQuotes(bones.bot.Module):
             event.user.notice("[Quote] Quote id needs to be a number!")
             return
 
-        session = self.db.new_session()
-        quote = (
-            session.query(ChannelQuote)
+        d = self.store.get(ChannelQuote.__table__, id=int(event.args[1]))
+        d.addCallback(lambda quotes: quotes[0] if quotes else None)
+        d.addCallback(self.sendQuote, event)
+        d.addErrback(self.databaseError, event)
 
-            .filter(ChannelQuote.id == event.args[1])
-            .limit(1)
-            .first()
-        )
-        self.sendQuote(event, quote)
+    def databaseError(self, failure, event):
+        self.log.error("Database query failed: %s",
+                       failure.getTraceback())
+        event.channel.msg("[Quote] Something went wrong while looking "
+                          "that up, please try again later.")
 
-    def sendQuote(self, event, quote):
+    def sendQuote(self, quote, event):
         if not quote:
             event.channel.msg(str(("[Quote] No such quote '%s'"
                                    % event.args[1]).encode("utf-8")))
@@ -253,10 +417,12 @@ class ChannelQuotes(bones.bot.Module):
 
 class UserQuote(storage.Base):
     __tablename__ = "bones_quotes_user"
+    # Archived rows are told apart by their ids, so they mustn't be reused.
+    __table_args__ = {"extend_existing": True, "sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True)
-    nickname = Column(Text)
-    channel = Column(Text)
+    nickname = Column(Text, index=True)
+    channel = Column(Text, index=True)
     quote = Column(Text)
     type = Column(Enum(
         'privmsg',
@@ -282,10 +448,11 @@ class UserQuote(storage.Base):
 
 class ChannelQuote(storage.Base):
     __tablename__ = "bones_quotes_channel"
+    __table_args__ = {"extend_existing": True}
 
     id = Column(Integer, primary_key=True)
     submitter = Column(Text)
-    channel = Column(Text)
+    channel = Column(Text, index=True)
     quote = Column(Text)
     timestamp = Column(DateTime(timezone=True))
 
@@ -316,7 +483,7 @@ if __name__ == "__main__":
     print("Connecting to '%s'..."
           % settings._sections["storage"]["sqlalchemy.url"])
     engine = engine_from_config(settings._sections["storage"], "sqlalchemy.")
-    print("Creating tables...")
-    from bones.modules.storage import Base
-    Base.metadata.create_all(engine)
+    print("Creating and upgrading tables...")
+    from bones.modules.storage import migrate
+    migrate(engine)
     print("Have a nice day!")
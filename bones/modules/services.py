@@ -1,12 +1,19 @@
 import bones.event
 from bones.bot import Module
+from bones.config import Option, Schema, boolean
 
 
 class NickServ(Module):
+    configSchema = Schema(
+        password=Option("services", "nickserv.password"),
+        waitForNotice=Option("services", "nickserv.waitForNotice", boolean,
+                             True),
+    )
+
     def __init__(self, *args, **kwargs):
         Module.__init__(self, *args, **kwargs)
         self._disabled = False
-        if not self.settings.get("services", "nickserv.password"):
+        if not self.config.password:
             self.log.error(
                 "Configuration doesn't contain a NickServ password. Please "
                 "add `nickserv.password` to `[services]` and make it a "
@@ -20,16 +27,14 @@ class NickServ(Module):
         if self._disabled:
             return
         # Make sure that we're supposed to identify now.
-        if self.settings.get("services", "nickserv.waitForNotice",
-                             default="true") != "false":
+        if self.config.waitForNotice:
             return
 
         # We're good to go!
         self.log.info("Identifying with NickServ")
         event.client.msg(
             "NickServ",
-            "IDENTIFY %s" % self.settings.get("services",
-                                              "nickserv.password")
+            "IDENTIFY %s" % self.config.password
         )
 
     @bones.event.handler(event=bones.event.BotNoticeReceivedEvent)
@@ -38,8 +43,7 @@ class NickServ(Module):
             return
 
         # Make sure that we're supposed to handle on notices.
-        if self.settings.get("services", "nickserv.waitForNotice",
-                             default="true") != "true":
+        if not self.config.waitForNotice:
             return
 
         # Make sure that we're supposed to identify now.
@@ -50,12 +54,12 @@ class NickServ(Module):
             self.log.info("Identifying with NickServ (triggered by notice)")
             event.client.msg(
                 "NickServ",
-                "IDENTIFY %s" %
-                (self.settings.get("services", "nickserv.password"),)
+                "IDENTIFY %s" % (self.config.password,)
             )
 
 
 class HostServ(Module):
+    persistentState = ("channelJoinQueue", "haveVhost", "haveIdentified")
 
     def __init__(self, *args, **kwargs):
         Module.__init__(self, *args, **kwargs)
@@ -78,9 +82,12 @@ class HostServ(Module):
         # One of the most important things we need to do is prevent
         # joining while we do not have a vhost
         if not self.haveVhost:
-            self.log.debug("Queueing join to channel %s", event.channel)
-            # Add channel to join queue
-            self.channelJoinQueue.append(event.channel)
+            self.log.debug("Queueing join to channels %s", event.channel)
+            # Add the channels to the join queue
+            for channel in event.channels:
+                self.channelJoinQueue.append(
+                    (channel, event.keys.get(channel))
+                )
             # Cancel the event so that the bot won't join the channel
             event.isCancelled = True
 
@@ -98,5 +105,6 @@ class HostServ(Module):
             self.log.info("Received Vhost, joining all queued channels")
             # As we've got a vhost, we shouldn't prevent joins anymore.
             self.haveVhost = True
-            while self.channelJoinQueue:
-                event.client.join(self.channelJoinQueue.pop())
+            channels = self.channelJoinQueue
+            self.channelJoinQueue = []
+            event.client.joinChannels(channels)
@@ -1,44 +1,1114 @@
-from sqlalchemy import engine_from_config
+import logging
+import random
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    MetaData,
+    Table,
+    Text,
+    and_,
+    engine_from_config,
+    event,
+    func,
+    inspect,
+    select,
+    text,
+)
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import (
     sessionmaker,
 )
+from twisted.internet import defer, reactor, task, threads
+from twisted.python.threadpool import ThreadPool
 
 import bones.event
 from bones.bot import Module
+from bones.config import (
+    InvalidConfigurationException,
+    Option,
+    Schema,
+    duration,
+    integer,
+    string,
+)
+from bones.modules.stores import (
+    MemoryStore,
+    Row,
+    ShelveStore,
+    Store,
+    decode,
+    rank,
+)
+from bones.modules.stores import words as splitWords
 
 Base = declarative_base()
 
+# Holds the schema version of every table, which is the number of
+# migrations that have been applied to it.
+schemaTable = Table(
+    "bones_schema", Base.metadata,
+    Column("name", Text, primary_key=True),
+    Column("version", Integer),
+)
+
+# Functions that bring an existing table up to date, in the order they
+# were added. Each is called with a connection and the table, and should
+# only change the tables it knows about.
+migrations = []
+
+
+def migration(func):
+    """Decorator that adds a function to :data:`migrations`."""
+    migrations.append(func)
+    return func
+
+
+@migration
+def addIndexes(connection, table):
+    """Creates the indexes declared on the table that it doesn't have yet,
+    like those added to the nickname, channel and topic columns."""
+    existing = set(
+        index["name"] for index in inspect(connection).get_indexes(table.name)
+    )
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(connection)
+
+
+@migration
+def useAutoincrement(connection, table):
+    """Rebuilds the SQLite tables declared with :code:`sqlite_autoincrement`
+    that were created without it. Otherwise SQLite hands the ids of the
+    last rows out again once they have been deleted, like those of the
+    quotes that have been archived."""
+    if connection.dialect.name != "sqlite" or \
+            not table.dialect_options["sqlite"]["autoincrement"]:
+        return
+    sql = connection.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND "
+        "name = :name"), {"name": table.name}).scalar()
+    if "AUTOINCREMENT" in sql.upper():
+        return
+    copy = table.tometadata(MetaData(), name="%s_new" % table.name)
+    # The indexes are named after the table, so they're created once the
+    # copy has been renamed.
+    copy.indexes.clear()
+    copy.create(connection)
+    columns = ", ".join('"%s"' % column.name for column in table.columns)
+    # Inserting the ids sets the sequence to the highest one.
+    connection.execute(text('INSERT INTO "%s" (%s) SELECT %s FROM "%s"'
+                            % (copy.name, columns, columns, table.name)))
+    connection.execute(text('DROP TABLE "%s"' % table.name))
+    connection.execute(text('ALTER TABLE "%s" RENAME TO "%s"'
+                            % (copy.name, table.name)))
+    for index in table.indexes:
+        index.create(connection)
+    # The triggers of a full-text index were dropped with the table, so it
+    # is built again the next time it is prepared.
+    connection.execute(text('DROP TABLE IF EXISTS "%s_fts"' % table.name))
+
+
+def migrate(engine, tables=None):
+    """Creates the tables that don't exist yet, and applies the
+    :data:`migrations` that haven't been applied to those that do. New
+    tables are created at the latest version.
+
+    :param engine: The engine of the database.
+    :param tables: The tables to migrate, or :code:`None` for all the
+        tables in :data:`Base.metadata`.
+
+    :returns: A list of the names of the tables that were upgraded.
+    """
+    if tables is None:
+        tables = Base.metadata.sorted_tables
+    latest = len(migrations)
+    upgraded = []
+    with engine.begin() as connection:
+        schemaTable.create(connection, checkfirst=True)
+        versions = dict(connection.execute(
+            select([schemaTable.c.name, schemaTable.c.version])
+        ).fetchall())
+        existing = set(inspect(connection).get_table_names())
+        for table in tables:
+            if table is schemaTable:
+                continue
+            version = versions.get(table.name, 0)
+            if table.name not in existing:
+                table.create(connection)
+                version = latest
+            elif version < latest:
+                for func in migrations[version:]:
+                    func(connection, table)
+                upgraded.append(table.name)
+            if table.name not in versions:
+                connection.execute(schemaTable.insert(), name=table.name,
+                                   version=latest)
+            elif versions[table.name] != latest:
+                connection.execute(
+                    schemaTable.update()
+                    .where(schemaTable.c.name == table.name),
+                    version=latest,
+                )
+    return upgraded
+
+
+class Cache():
+    """A bounded least-recently-used cache of query results, whose entries
+    expire after `ttl` seconds. Keys are tuples that start with the name of
+    the table the result was read from, and all the entries for a table are
+    dropped by :meth:`invalidate`. Results of :code:`None` or empty lists
+    are cached too, so lookups of things that don't exist are cached as
+    well.
+
+    :param size: The most entries kept.
+    :type size: int
+    :param ttl: The number of seconds entries are kept.
+    :type ttl: float
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.hits = 0
+        self.negativeHits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Looks a key up.
+
+        :returns: A tuple of whether the key was found, and its value.
+        """
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return False, None
+            # Moves the entry to the end, as the most recently used one.
+            self.entries[key] = entry
+            if entry[1] is None or entry[1] == []:
+                self.negativeHits += 1
+            else:
+                self.hits += 1
+            return True, entry[1]
+
+    def generation(self, table):
+        """Returns a number that changes whenever the table is
+        invalidated."""
+        with self._lock:
+            return self.generations.get(table, 0)
+
+    def put(self, key, value, generation):
+        """Stores a value, unless its table has been invalidated since
+        `generation` was read, as it may be outdated already."""
+        if not self.size:
+            return
+        with self._lock:
+            if self.generations.get(key[0], 0) != generation:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, table):
+        """Drops all the entries for the table."""
+        with self._lock:
+            self.generations[table] = self.generations.get(table, 0) + 1
+            for key in [key for key in self.entries if key[0] == table]:
+                del self.entries[key]
+
+    def metrics(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "negativeHits": self.negativeHits,
+            "misses": self.misses,
+        }
+
+
+def engineConfig(options, threads=1):
+    """Returns the options of the :code:`[storage]` section given as a dict
+    with the defaults of the :code:`sqlalchemy.*` options filled in, to be
+    passed to :func:`sqlalchemy.engine_from_config`.
+
+    :param threads: The number of threads that use the engine. The
+        connection pool of databases other than SQLite is sized to match.
+    :type threads: int
+    """
+    config = dict(options)
+    if "sqlalchemy.url" not in config:
+        config["sqlalchemy.url"] = "sqlite:///bones.db"
+    if "sqlalchemy.encoding" not in config:
+        config["sqlalchemy.encoding"] = "utf-8"
+    if "sqlalchemy.convert_unicode" not in config:
+        config["sqlalchemy.convert_unicode"] = "true"
+    # SQLite gets a connection per thread from SQLAlchemy, the other
+    # databases get a pool with a connection for every thread that can use
+    # one.
+    if make_url(config["sqlalchemy.url"]).get_backend_name() != "sqlite":
+        config.setdefault("sqlalchemy.pool_size", str(threads))
+        config.setdefault("sqlalchemy.max_overflow", "0")
+        config.setdefault("sqlalchemy.pool_recycle", "3600")
+    return config
+
+
+def _backendName(value):
+    """Option type for the name of a storage backend."""
+    value = value.strip().lower()
+    if value not in ("sqlalchemy", "memory", "shelve"):
+        raise ValueError("not a storage backend: %r" % value)
+    return value
+
+
+def _pragmaValue(value):
+    """Option type for SQLite pragma values, which are put in the statement
+    as-is and so may only be a single word or number."""
+    if not re.match(r"^-?\w+$", value):
+        raise ValueError("not a pragma value: %r" % value)
+    return value
+
 
 class Database(Module):
+    """Holds the database engine used by the modules that store data.
+
+    Queries are run with :meth:`run`, which runs them on a thread pool of
+    their own, so that a slow database can't use up the threads that event
+    handlers run in. The pool has :code:`threads` threads, set in the
+    :code:`[storage]` section, and the engine's connection pool is sized to
+    match unless it is configured with :code:`sqlalchemy.pool_size`.
+
+    SQLite connections are set up with the pragmas from the
+    :code:`sqlite.*` options, which default to a write-ahead log and
+    :code:`synchronous = NORMAL`. Tables are created and migrated before
+    the first query that could use them.
+
+    Lookups that are repeated often can be run with :meth:`cached`, which
+    keeps their results in a :class:`Cache` until anything writes to the
+    table they read from.
+
+    Modules store their rows through :attr:`store`, a
+    :class:`~bones.modules.stores.Store` picked with :code:`backend`.
+    Only the :code:`sqlalchemy` backend has an engine, so :meth:`run` and
+    :meth:`cached` fail with the other backends.
+    """
+    persistentState = ("engine", "sessionmaker", "cache", "store",
+                       "_listeners")
+    configSchema = Schema(
+        backend=Option("storage", "backend", _backendName, "sqlalchemy"),
+        shelvePath=Option("storage", "shelve.path", string, "bones.shelf"),
+        threads=Option("storage", "threads", integer, 4),
+        journalMode=Option("storage", "sqlite.journalMode", _pragmaValue,
+                           "WAL"),
+        synchronous=Option("storage", "sqlite.synchronous", _pragmaValue,
+                           "NORMAL"),
+        cacheSize=Option("storage", "sqlite.cacheSize", integer, -16000),
+        mmapSize=Option("storage", "sqlite.mmapSize", integer, 268435456),
+        busyTimeout=Option("storage", "sqlite.busyTimeout", duration, 5.0),
+        cacheEntries=Option("storage", "cache.entries", integer, 1000),
+        cacheTTL=Option("storage", "cache.ttl", duration, 300.0),
+    )
 
     def __init__(self, **args):
         Module.__init__(self, **args)
         self.sessionmaker = None
         self.engine = None
+        self.threadpool = None
+        self.store = None
+        # The (target, event, listener) tuples registered on the engine
+        # and the sessionmaker.
+        self._listeners = []
+        # The tables written to by the transaction being committed in each
+        # thread.
+        self._committing = threading.local()
+        self._shutdownTrigger = None
+        self._statsLock = threading.Lock()
+        self._waits = 0
+        self._waitTotal = 0.0
+        self._waitMax = 0.0
+        self._running = 0
+        self._migrated = set()
+        self._migrateLock = threading.Lock()
+        self.cache = Cache(self.config.cacheEntries, self.config.cacheTTL)
 
     def new_session(self):
-        return self.sessionmaker()
+        """Returns an autocommitting session, which the caller needs to
+        close. Use :meth:`run` instead, which does that for you."""
+        return self.sessionmaker(autocommit=True)
 
     def get_config(self):
-        config = {}
-        if "storage" in self.settings.data:
-            config = self.settings.data["storage"]
-        if "sqlalchemy.url" not in config:
-            config["sqlalchemy.url"] = "sqlite:///bones.db"
-        if "sqlalchemy.encoding" not in config:
-            config["sqlalchemy.encoding"] = "utf-8"
-        if "sqlalchemy.convert_unicode" not in config:
-            config["sqlalchemy.convert_unicode"] = "true"
-        return config
-
-    @bones.event.handler(event=bones.event.BotInitializedEvent)
-    def botReady(self, event):
-        self.engine = engine_from_config(self.get_config(), "sqlalchemy.")
-        self.log.debug("Connected to database")
-        dbInitEvent = DatabaseInitializedEvent(self)
-        bones.event.fire(event.factory.tag, dbInitEvent)
-        self.sessionmaker = sessionmaker(bind=self.engine, autocommit=True)
+        return engineConfig(self.settings.data.get("storage", {}),
+                            self.config.threads)
+
+    def setup(self):
+        if self.engine is None and self.config.backend == "sqlalchemy":
+            self.engine = engine_from_config(self.get_config(), "sqlalchemy.")
+            self.sessionmaker = sessionmaker(bind=self.engine,
+                                             expire_on_commit=False)
+        if self.engine is not None:
+            self._listen()
+        if self.threadpool is None:
+            self.threadpool = ThreadPool(1, self.config.threads,
+                                         "bones-database")
+            self.threadpool.start()
+            self._shutdownTrigger = reactor.addSystemEventTrigger(
+                "during", "shutdown", self.threadpool.stop)
+        if self.store is None:
+            if self.config.backend == "sqlalchemy":
+                self.store = SQLAlchemyStore(self)
+            elif self.config.backend == "shelve":
+                self.store = ShelveStore(self.config.shelvePath,
+                                         self.threadpool)
+            else:
+                self.store = MemoryStore()
+            # The thread pool is gone by then, so nothing is using it.
+            reactor.addSystemEventTrigger("after", "shutdown",
+                                          self.store.close)
+        # A store kept through a reload still runs its operations through
+        # the old instance, whose thread pool has been stopped. Its class
+        # is from before the reload, so it's told apart by name.
+        elif self.store.name == "sqlalchemy":
+            self.store.db = self
+        elif self.store.name == "shelve":
+            self.store.threadpool = self.threadpool
+        self.log.debug("Using the %s storage backend", self.store.name)
+
+        def migrated(result):
+            dbInitEvent = DatabaseInitializedEvent(self)
+            for tag in self.factories:
+                bones.event.fire(tag, dbInitEvent)
+        if self.engine is None:
+            d = defer.succeed(None)
+        else:
+            d = threads.deferToThreadPool(reactor, self.threadpool,
+                                          self.migrate)
+        d.addCallback(migrated)
+        return d
+
+    def setPragmas(self, connection, record):
+        cursor = connection.cursor()
+        for name, value in (
+            ("journal_mode", self.config.journalMode),
+            ("synchronous", self.config.synchronous),
+            ("cache_size", self.config.cacheSize),
+            ("mmap_size", self.config.mmapSize),
+            ("busy_timeout", int(self.config.busyTimeout * 1000)),
+        ):
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+
+    def _listen(self):
+        # Listeners kept through a reload are those of the old instance,
+        # which would go on using its configuration.
+        for target, name, listener in self._listeners:
+            event.remove(target, name, listener)
+        self._listeners = [
+            (self.engine, "after_execute", self._afterExecute),
+            (self.engine, "commit", self._beforeCommit),
+            (self.engine, "rollback", self._afterRollback),
+            (self.sessionmaker, "after_commit", self._afterCommit),
+        ]
+        if self.engine.dialect.name == "sqlite":
+            self._listeners.append((self.engine, "connect", self.setPragmas))
+        for target, name, listener in self._listeners:
+            event.listen(target, name, listener)
+
+    def _afterExecute(self, connection, statement, multiparams, params,
+                      result):
+        if isinstance(statement, UpdateBase):
+            table = statement.table.name
+            self.cache.invalidate(table)
+            # Readers may cache the old rows again until the change is
+            # committed, so the table is invalidated once more then.
+            connection.info.setdefault("bones.written", set()).add(table)
+
+    def _beforeCommit(self, connection):
+        # The engine's commit event comes before the commit, while readers
+        # can still see the old rows, so the tables are only invalidated
+        # once the session has committed.
+        written = connection.info.pop("bones.written", None)
+        if written:
+            tables = getattr(self._committing, "tables", set())
+            self._committing.tables = tables | written
+
+    def _afterCommit(self, session):
+        tables = getattr(self._committing, "tables", ())
+        self._committing.tables = set()
+        for table in tables:
+            self.cache.invalidate(table)
+
+    def _afterRollback(self, connection):
+        connection.info.pop("bones.written", None)
+
+    def migrate(self):
+        """Creates and migrates the tables of the models that have been
+        defined since the last call. See :func:`migrate`."""
+        with self._migrateLock:
+            tables = [table for table in Base.metadata.sorted_tables
+                      if table.name not in self._migrated]
+            if not tables:
+                return
+            for name in migrate(self.engine, tables):
+                self.log.info("Upgraded table %s", name)
+            self._migrated.update(table.name for table in tables)
+
+    def unload(self):
+        if self.threadpool is not None:
+            reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            # Lets the queries already queued finish.
+            self.threadpool.stop()
+            self.threadpool = None
+
+    def run(self, func, *args, **kwargs):
+        """Calls :code:`func(session, *args, **kwargs)` in a database
+        thread, with a new session that is committed when `func` returns and
+        rolled back if it raises. The session is always closed afterwards.
+
+        Objects loaded in the session can still be read after it has been
+        closed, but changes to them aren't saved.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` that fires
+            in the reactor thread with whatever `func` returned.
+        :raises: :class:`~bones.config.InvalidConfigurationException` if
+            the storage backend isn't :code:`sqlalchemy`, as only that one
+            has a database to query.
+        """
+        if self.sessionmaker is None:
+            raise InvalidConfigurationException(
+                "Queries need backend = sqlalchemy in section [storage], "
+                "not %s" % self.config.backend)
+        return threads.deferToThreadPool(
+            reactor, self.threadpool, self._runInSession, time.time(),
+            func, args, kwargs
+        )
+
+    def cached(self, model, key, func, *args, **kwargs):
+        """Like :meth:`run`, but the result is cached under `key` for the
+        table of `model`. Further calls with the same key get the cached
+        result without using a database thread, until the table is written
+        to or the entry expires.
+
+        :param model: The model or table that `func` reads from.
+        :param key: A hashable value identifying the lookup, like
+            :code:`("topic", topic)`.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` that fires
+            with the result.
+        """
+        table = getattr(model, "__table__", model).name
+        key = (table,) + tuple(key)
+        found, value = self.cache.get(key)
+        if found:
+            return defer.succeed(value)
+        generation = self.cache.generation(table)
+
+        def store(result):
+            self.cache.put(key, result, generation)
+            return result
+        return self.run(func, *args, **kwargs).addCallback(store)
+
+    def _runInSession(self, queued, func, args, kwargs):
+        wait = time.time() - queued
+        # Modules loaded after the database may have defined new tables.
+        if len(self._migrated) != len(Base.metadata.tables):
+            self.migrate()
+        with self._statsLock:
+            self._waits += 1
+            self._waitTotal += wait
+            self._waitMax = max(self._waitMax, wait)
+            self._running += 1
+        session = self.sessionmaker()
+        try:
+            result = func(session, *args, **kwargs)
+            session.commit()
+            return result
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+            with self._statsLock:
+                self._running -= 1
+
+    def metrics(self):
+        """Returns a dict with the number of queries run, the time they
+        waited for a database thread and the current size of the queue."""
+        with self._statsLock:
+            waits = self._waits
+            return {
+                "queries": waits,
+                "running": self._running,
+                "queued": self.threadpool._queue.qsize()
+                if self.threadpool else 0,
+                "waitAverage": self._waitTotal / waits if waits else 0.0,
+                "waitMax": self._waitMax,
+                "cache": self.cache.metrics(),
+                "store": self.store.metrics() if self.store else {},
+            }
+
+
+class BatchWriter():
+    """Collects rows in memory and inserts them into a table in batches,
+    instead of running a query for every row. A batch is written when
+    `size` rows have been added, and every `interval` seconds.
+
+    At most `limit` rows are kept waiting. Rows added while the buffer is
+    full are dropped and counted, so that a slow database can't make the
+    bot run out of memory. The remaining rows are written when the reactor
+    shuts down, or when :meth:`stop` is called.
+
+    :param db: The database module whose store the rows are written to.
+    :type db: :class:`Database`
+    :param table: The table the rows are inserted into.
+    :type table: :class:`sqlalchemy.schema.Table`
+    """
+
+    def __init__(self, db, table, size=100, interval=1.0, limit=10000):
+        self.db = db
+        self.table = table
+        self.size = size
+        self.interval = interval
+        self.limit = limit
+        self.rows = []
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.log = logging.getLogger("%s.%s" % (__name__, table.name))
+        self._lock = threading.Lock()
+        self._writing = None
+        self._flusher = task.LoopingCall(self.flush)
+        self._shutdownTrigger = None
+
+    def start(self):
+        self._flusher.start(self.interval, now=False)
+        self._shutdownTrigger = reactor.addSystemEventTrigger(
+            "before", "shutdown", self.stop)
+
+    def stop(self):
+        """Stops the timer and writes the remaining rows.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` that fires
+            once they have been written.
+        """
+        if self._flusher.running:
+            self._flusher.stop()
+        if self._shutdownTrigger is not None:
+            reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        if self._writing is not None:
+            # Wait for the batch being written before writing the rest.
+            d = defer.Deferred()
+            self._writing.addBoth(lambda result: d.callback(None))
+            return d.addCallback(lambda result: self.flush())
+        return self.flush()
+
+    def add(self, **row):
+        """Adds a row, given as keyword arguments mapping column names to
+        values. This can be called from any thread."""
+        with self._lock:
+            if len(self.rows) >= self.limit:
+                self.dropped += 1
+                if self.dropped == 1 or self.dropped % 1000 == 0:
+                    self.log.warn("Buffer is full, %d rows dropped so far",
+                                  self.dropped)
+                return
+            self.rows.append(row)
+            full = len(self.rows) == self.size
+        if full:
+            reactor.callFromThread(self.flush)
+
+    def flush(self):
+        """Writes the rows waiting in the buffer in one statement. Nothing
+        is done while a batch is being written already; the rows are
+        written once it is done.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` that fires
+            once the batch has been written.
+        """
+        if self._writing is not None:
+            return defer.succeed(None)
+        with self._lock:
+            rows, self.rows = self.rows, []
+        if not rows:
+            return defer.succeed(None)
+
+        def written(result):
+            self.written += len(rows)
+            self.batches += 1
+
+        def failed(failure):
+            self.dropped += len(rows)
+            self.log.error("Unable to write %d rows: %s", len(rows),
+                           failure.getErrorMessage())
+
+        def done(result):
+            self._writing = None
+            if len(self.rows) >= self.size:
+                reactor.callLater(0, self.flush)
+        # Set before the callbacks are added, as stores that don't use
+        # threads return a Deferred that has already fired.
+        self._writing = d = self.db.store.extend(self.table, rows)
+        d.addCallbacks(written, failed)
+        d.addBoth(done)
+        return d
+
+    def metrics(self):
+        """Returns a dict with the number of rows waiting, written and
+        dropped, and the number of batches written."""
+        return {
+            "buffered": len(self.rows),
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+        }
+
+
+class MemoryIndex():
+    """Base class for indexes of a table column that are kept in memory.
+
+    The rows are read when the index is prepared, and those added since are
+    read by id before every lookup, so rows inserted by anything, like a
+    :class:`BatchWriter`, are picked up. Deleted rows have to be passed to
+    :meth:`remove`.
+
+    :param db: The database module the index is used through.
+    :type db: :class:`Database`
+    :param table: The table to index, which needs an integer :code:`id`
+        primary key.
+    :type table: :class:`sqlalchemy.schema.Table`
+    :param column: The name of the column to index.
+    :type column: str
+
+    Subclasses keep the index with :code:`_add(id, value)`,
+    :code:`_remove(id, value)` and :code:`_removeBefore(id)`, which are
+    called with the index's lock held.
+    """
+
+    def __init__(self, db, table, column):
+        self.db = db
+        self.table = table
+        self.column = column
+        self.lastId = 0
+        self._lock = threading.Lock()
+
+    def prepare(self):
+        """Builds the index.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` that fires
+            once the index can be used.
+        """
+        return self.db.run(self._prepare)
+
+    def _prepare(self, session):
+        self.refresh(session)
+
+    def refresh(self, session):
+        """Adds the rows that have been inserted since the last refresh."""
+        idColumn = self.table.c.id
+        with self._lock:
+            rows = session.execute(
+                select([idColumn, self.table.c[self.column]])
+                .where(idColumn > self.lastId)
+                .order_by(idColumn)
+            )
+            for id, value in rows:
+                self._add(id, value)
+                self.lastId = id
+
+    def remove(self, id, value):
+        """Removes a deleted row from the index.
+
+        :param id: The id of the row.
+        :param value: The value the row had in the indexed column.
+        """
+        with self._lock:
+            self._remove(id, value)
+            # SQLite hands the id of the last row out again once it has
+            # been deleted, so it has to be picked up by the next refresh.
+            if id == self.lastId:
+                self.lastId = id - 1
+
+    def update(self, id, old, new):
+        """Moves an updated row from one value of the column to another."""
+        with self._lock:
+            self._remove(id, old)
+            self._add(id, new)
+
+    def removeBefore(self, id):
+        """Removes the rows with ids lower than `id`, like those that have
+        been archived."""
+        with self._lock:
+            self._removeBefore(id)
+
+
+class RandomIndex(MemoryIndex):
+    """Keeps the ids of the rows for every value of a column, like the
+    quotes of each channel, so that a random row can be picked with a
+    single primary key lookup instead of sorting the rows by
+    :code:`random()`."""
+
+    def __init__(self, db, table, column):
+        MemoryIndex.__init__(self, db, table, column)
+        self.ids = {}
+
+    @staticmethod
+    def key(value):
+        # Names from IRC are byte strings, the database returns unicode.
+        if isinstance(value, str):
+            return value.decode("utf-8", "ignore")
+        return value
+
+    def _add(self, id, value):
+        value = self.key(value)
+        if value not in self.ids:
+            self.ids[value] = array("l")
+        # Rows are usually added in id order, but updated ones aren't, and
+        # _removeBefore() needs the arrays sorted.
+        insort(self.ids[value], id)
+
+    def _remove(self, id, value):
+        value = self.key(value)
+        ids = self.ids.get(value)
+        # Rows are rarely deleted, so this searches the array rather than
+        # keeping track of where every id is.
+        if ids is not None and id in ids:
+            ids.remove(id)
+            if not ids:
+                del self.ids[value]
+
+    def _removeBefore(self, id):
+        for value, ids in self.ids.items():
+            del ids[:bisect_left(ids, id)]
+            if not ids:
+                del self.ids[value]
+
+    def count(self, value):
+        """Returns the number of rows with the given value."""
+        ids = self.ids.get(self.key(value))
+        return len(ids) if ids is not None else 0
+
+    def pick(self, session, value):
+        """Returns a random row with the given value, or :code:`None` if
+        there are none. This should be called through
+        :meth:`Database.run`."""
+        self.refresh(session)
+        while True:
+            with self._lock:
+                ids = self.ids.get(self.key(value))
+                if not ids:
+                    return None
+                id = random.choice(ids)
+            row = session.execute(
+                select([self.table]).where(self.table.c.id == id)).first()
+            if row is not None:
+                return row
+            # Deleted without telling the index.
+            self.remove(id, value)
+
+
+class SearchIndex(MemoryIndex):
+    """A full-text index of a text column, for word searches that don't
+    have to scan the whole table.
+
+    On SQLite builds with FTS5, the index is an FTS5 table that is kept in
+    sync with the table by triggers, and results are ranked with bm25.
+    Elsewhere an inverted index is kept in memory instead, and results are
+    ranked by how often the words occur.
+
+    Both match rows containing all the words searched for.
+    """
+    words = staticmethod(splitWords)
+
+    def __init__(self, db, table, column):
+        MemoryIndex.__init__(self, db, table, column)
+        self.name = "%s_fts" % table.name
+        self.fts = False
+        self.postings = {}
+
+    def _prepare(self, session):
+        if self.db.engine.dialect.name == "sqlite":
+            try:
+                self._createFts(session)
+                self.fts = True
+                return
+            except OperationalError as ex:
+                session.rollback()
+                self.db.log.warn("FTS5 isn't available, searching %s in "
+                                 "memory: %s", self.table.name, ex)
+        self.refresh(session)
+
+    def _createFts(self, session):
+        values = {"table": self.table.name, "fts": self.name,
+                  "column": self.column}
+        exists = session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+            "name = :name"), {"name": self.name}).first()
+        if exists:
+            return
+        for statement in (
+            "CREATE VIRTUAL TABLE %(fts)s USING fts5(%(column)s, "
+            "content='%(table)s', content_rowid='id')",
+            "CREATE TRIGGER %(fts)s_insert AFTER INSERT ON %(table)s BEGIN "
+            "INSERT INTO %(fts)s (rowid, %(column)s) "
+            "VALUES (new.id, new.%(column)s); END",
+            "CREATE TRIGGER %(fts)s_delete AFTER DELETE ON %(table)s BEGIN "
+            "INSERT INTO %(fts)s (%(fts)s, rowid, %(column)s) "
+            "VALUES ('delete', old.id, old.%(column)s); END",
+            "CREATE TRIGGER %(fts)s_update AFTER UPDATE ON %(table)s BEGIN "
+            "INSERT INTO %(fts)s (%(fts)s, rowid, %(column)s) "
+            "VALUES ('delete', old.id, old.%(column)s); "
+            "INSERT INTO %(fts)s (rowid, %(column)s) "
+            "VALUES (new.id, new.%(column)s); END",
+            # Indexes the rows that were there before the index.
+            "INSERT INTO %(fts)s (%(fts)s) VALUES ('rebuild')",
+        ):
+            session.execute(text(statement % values))
+
+    def _add(self, id, value):
+        for word in self.words(value):
+            documents = self.postings.setdefault(word, {})
+            documents[id] = documents.get(id, 0) + 1
+
+    def _remove(self, id, value):
+        for word in set(self.words(value)):
+            documents = self.postings.get(word)
+            if documents is None:
+                continue
+            documents.pop(id, None)
+            if not documents:
+                del self.postings[word]
+
+    def _removeBefore(self, id):
+        for word, documents in self.postings.items():
+            for document in [d for d in documents if d < id]:
+                del documents[document]
+            if not documents:
+                del self.postings[word]
+
+    def remove(self, id, value):
+        # The triggers take care of the FTS5 table.
+        if not self.fts:
+            MemoryIndex.remove(self, id, value)
+
+    def update(self, id, old, new):
+        if not self.fts:
+            MemoryIndex.update(self, id, old, new)
+
+    def removeBefore(self, id):
+        if not self.fts:
+            MemoryIndex.removeBefore(self, id)
+
+    def search(self, session, query, limit=10, offset=0):
+        """Searches the index for rows containing all the words in `query`.
+        This should be called through :meth:`Database.run`.
+
+        :returns: A tuple of the total number of matching rows, and a list
+            of the ids of the `limit` best matches after the first
+            `offset`.
+        """
+        words = self.words(query)
+        if not words:
+            return 0, []
+        if self.fts:
+            # Quoting the words keeps FTS5 from reading them as operators.
+            match = " ".join('"%s"' % word for word in words)
+            total = session.execute(text(
+                "SELECT count(*) FROM %s WHERE %s MATCH :match"
+                % (self.name, self.name)), {"match": match}).scalar()
+            ids = [row[0] for row in session.execute(text(
+                "SELECT rowid FROM %s WHERE %s MATCH :match ORDER BY rank "
+                "LIMIT :limit OFFSET :offset" % (self.name, self.name)),
+                {"match": match, "limit": limit, "offset": offset})]
+            return total, ids
+
+        self.refresh(session)
+        with self._lock:
+            ranked = rank(self.postings, query)
+        return len(ranked), ranked[offset:offset + limit]
+
+
+class SQLAlchemyStore(Store):
+    """Keeps the rows in the database of a :class:`Database`, with every
+    operation run through :meth:`Database.run`. Lookups with :meth:`get`
+    are cached with :meth:`Database.cached`. Random picks use a
+    :class:`RandomIndex` and searches a :class:`SearchIndex` of the column,
+    which are built the first time the column is used unless they are
+    prepared.
+    """
+    name = "sqlalchemy"
+
+    def __init__(self, db):
+        Store.__init__(self)
+        self.db = db
+        # Maps (table, column) to the indexes of the column.
+        self.randomIndexes = {}
+        self.searchIndexes = {}
+        self._lock = threading.Lock()
+
+    def _where(self, table, where):
+        clauses = []
+        for column, value in sorted(where.items()):
+            if isinstance(value, (list, tuple, set)):
+                clauses.append(table.c[column].in_(
+                    [decode(v) for v in value]))
+            else:
+                clauses.append(table.c[column] == decode(value))
+        return and_(*clauses)
+
+    def _select(self, table, where):
+        query = select([table])
+        if where:
+            query = query.where(self._where(table, where))
+        return query
+
+    def _index(self, indexes, cls, session, table, column):
+        key = (table.name, column)
+        with self._lock:
+            index = indexes.get(key)
+            if index is None:
+                index = cls(self.db, table, column)
+                index._prepare(session)
+                indexes[key] = index
+        return index
+
+    def _tableIndexes(self, table):
+        with self._lock:
+            return [(column, index) for indexes in (self.randomIndexes,
+                                                    self.searchIndexes)
+                    for (name, column), index in indexes.items()
+                    if name == table.name]
+
+    def prepare(self, table, pick=(), search=()):
+        def prepare(session):
+            for column in pick:
+                self._index(self.randomIndexes, RandomIndex, session, table,
+                            column)
+            for column in search:
+                self._index(self.searchIndexes, SearchIndex, session, table,
+                            column)
+        return self._timed("prepare", self.db.run(prepare))
+
+    def append(self, table, row):
+        return self._timed("append", self.db.run(
+            lambda session: session.execute(table.insert(), row)
+            .inserted_primary_key[0]))
+
+    def extend(self, table, rows):
+        def extend(session):
+            # Passing a list of rows makes SQLAlchemy use executemany().
+            session.execute(table.insert(), rows)
+            return len(rows)
+        return self._timed("extend", self.db.run(extend))
+
+    def get(self, table, **where):
+        key = ("get",) + tuple(
+            (column, tuple(sorted(value))
+             if isinstance(value, (list, tuple, set)) else value)
+            for column, value in sorted(where.items()))
+        return self._timed("get", self.db.cached(
+            table, key, lambda session: [
+                Row(row) for row in session.execute(
+                    self._select(table, where).order_by(table.c.id))
+            ]))
+
+    def rows(self, table, after=0, limit=None):
+        def rows(session):
+            query = (select([table]).where(table.c.id > after)
+                     .order_by(table.c.id).limit(limit))
+            return [Row(row) for row in session.execute(query)]
+        return self._timed("rows", self.db.run(rows))
+
+    def pick(self, table, **where):
+        if len(where) != 1:
+            raise TypeError("pick() takes a single column")
+        column, value = where.items()[0]
+
+        def pick(session):
+            index = self._index(self.randomIndexes, RandomIndex, session,
+                                table, column)
+            row = index.pick(session, value)
+            return Row(row) if row is not None else None
+        return self._timed("pick", self.db.run(pick))
+
+    def search(self, table, column, query, limit=10, offset=0):
+        def search(session):
+            index = self._index(self.searchIndexes, SearchIndex, session,
+                                table, column)
+            total, ids = index.search(session, query, limit, offset)
+            if not ids:
+                return total, []
+            rows = dict((row["id"], Row(row)) for row in session.execute(
+                select([table]).where(table.c.id.in_(ids))))
+            return total, [rows[id] for id in ids if id in rows]
+        return self._timed("search", self.db.run(search))
+
+    def count(self, table, **where):
+        def count(session):
+            if len(where) == 1:
+                column, value = where.items()[0]
+                with self._lock:
+                    index = self.randomIndexes.get((table.name, column))
+                # A prepared index counts the rows without going through
+                # them, once the new ones have been read.
+                if index is not None and \
+                        not isinstance(value, (list, tuple, set)):
+                    index.refresh(session)
+                    return index.count(value)
+            query = self._select(table, where).alias()
+            return session.execute(
+                select([func.count()]).select_from(query)).scalar()
+        return self._timed("count", self.db.run(count))
+
+    def update(self, table, values, **where):
+        def update(session):
+            indexes = [(column, index)
+                       for column, index in self._tableIndexes(table)
+                       if column in values]
+            rows = []
+            if indexes:
+                rows = session.execute(self._select(table, where)).fetchall()
+            statement = table.update().values(**values)
+            if where:
+                statement = statement.where(self._where(table, where))
+            result = session.execute(statement)
+            for row in rows:
+                for column, index in indexes:
+                    index.update(row["id"], row[column], values[column])
+            return result.rowcount
+        return self._timed("update", self.db.run(update))
+
+    def delete(self, table, **where):
+        def delete(session):
+            rows = [Row(row) for row in
+                    session.execute(self._select(table, where))]
+            if not rows:
+                return []
+            session.execute(table.delete().where(
+                table.c.id.in_([row["id"] for row in rows])))
+            for column, index in self._tableIndexes(table):
+                for row in rows:
+                    index.remove(row["id"], row[column])
+            return rows
+        return self._timed("delete", self.db.run(delete))
+
+    def discardBefore(self, table, id):
+        """Removes the rows with ids lower than `id` from the indexes, after
+        they have been deleted from the database without the store, like
+        when they are archived."""
+        for column, index in self._tableIndexes(table):
+            index.removeBefore(id)
 
 
 class DatabaseInitializedEvent(bones.event.Event):
@@ -0,0 +1,457 @@
+"""Backends that the modules store their rows in.
+
+A :class:`Store` holds rows of the tables defined as models on
+:data:`bones.modules.storage.Base`, as dicts mapping column names to
+values, and every row has an integer :code:`id` that is handed out when it
+is appended. Which store is used is set with :code:`backend` in the
+:code:`[storage]` section:
+
+* :code:`sqlalchemy` keeps the rows in the database configured with
+  :code:`sqlalchemy.url`, see
+  :class:`bones.modules.storage.SQLAlchemyStore`.
+* :code:`memory` keeps them in a :class:`MemoryStore`, which loses them when
+  the bot stops. It's meant for tests and benchmarks, which can then measure
+  the modules without any disk I/O.
+* :code:`shelve` keeps them in a :class:`ShelveStore`, a :mod:`shelve` file
+  that is read into memory when the bot starts.
+
+All the stores count how often each operation is used and how long it
+takes in :meth:`Store.metrics`, so the backends can be compared.
+"""
+import random
+import re
+import shelve
+import threading
+import time
+from bisect import bisect_left, insort
+
+from twisted.internet import defer, reactor, threads
+
+reWords = re.compile(r"\w+", re.UNICODE)
+
+
+def words(value):
+    """Splits a string into the lowercased words that are indexed for
+    searches."""
+    if isinstance(value, str):
+        value = value.decode("utf-8", "ignore")
+    return [word.lower() for word in reWords.findall(value or u"")]
+
+
+def rank(postings, query):
+    """Ranks the ids of the rows containing all the words of `query` by
+    how often the words occur in them.
+
+    :param postings: A dict mapping words to dicts, that map the ids of
+        the rows containing the word to the number of times it does.
+    :returns: A list of ids, best first.
+    """
+    found = [postings.get(word, {}) for word in set(words(query))]
+    if not found:
+        return []
+    found.sort(key=len)
+    scores = dict(found[0])
+    for documents in found[1:]:
+        scores = dict((id, score + documents[id])
+                      for id, score in scores.iteritems()
+                      if id in documents)
+    return sorted(scores, key=lambda id: (-scores[id], id))
+
+
+def decode(value):
+    # Names from IRC are byte strings, the database returns unicode.
+    if isinstance(value, str):
+        return value.decode("utf-8", "ignore")
+    return value
+
+
+class Row(dict):
+    """A stored row. The columns can be read as attributes as well as
+    items, like :code:`row.id`."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class Store():
+    """The base class of the stores, which keeps track of how long their
+    operations take. Every store has the operations below, all of which
+    return a :class:`~twisted.internet.defer.Deferred` that fires in the
+    reactor thread with the result.
+
+    Rows are selected by keyword arguments mapping column names to values,
+    where a list, tuple or set of values matches any of them. Tables are
+    given as :class:`sqlalchemy.schema.Table` instances, like
+    :code:`Factoid.__table__`.
+
+    .. method:: prepare(table, pick=(), search=())
+
+        Builds the indexes that :meth:`pick` and :meth:`search` use for
+        the given columns ahead of their first use.
+
+    .. method:: append(table, row)
+
+        Adds a row, given as a dict without an id, and returns the id of
+        the new row.
+
+    .. method:: extend(table, rows)
+
+        Adds a list of rows at once, and returns the number of rows added.
+
+    .. method:: get(table, **where)
+
+        Returns a list of the matching rows as :class:`Row` instances, in
+        id order.
+
+    .. method:: rows(table, after=0, limit=None)
+
+        Returns a list of up to `limit` rows with ids higher than `after`,
+        in id order.
+
+    .. method:: pick(table, **where)
+
+        Returns a random row with the value given for a single column, or
+        :code:`None` if there are none.
+
+    .. method:: search(table, column, query, limit=10, offset=0)
+
+        Searches a text column for rows containing all the words in
+        `query`, and returns a tuple of the total number of matching rows
+        and a list of the `limit` best matches after the first `offset`.
+
+    .. method:: count(table, **where)
+
+        Returns the number of matching rows.
+
+    .. method:: update(table, values, **where)
+
+        Sets the columns in the dict `values` on the matching rows, and
+        returns the number of rows updated.
+
+    .. method:: delete(table, **where)
+
+        Deletes the matching rows, and returns a list of them.
+    """
+    name = None
+
+    def __init__(self):
+        self._stats = {}
+        self._statsLock = threading.Lock()
+
+    def _timed(self, operation, d):
+        started = time.time()
+
+        def done(result):
+            taken = time.time() - started
+            with self._statsLock:
+                calls, total, most = self._stats.get(operation, (0, 0.0, 0.0))
+                self._stats[operation] = (calls + 1, total + taken,
+                                          max(most, taken))
+            return result
+        return d.addBoth(done)
+
+    def close(self):
+        """Releases what the store holds on to once the bot stops."""
+
+    def metrics(self):
+        """Returns a dict with the backend's name and, for every operation
+        used, the number of calls and their average and longest duration in
+        seconds."""
+        result = {"backend": self.name}
+        with self._statsLock:
+            for operation, (calls, total, most) in self._stats.items():
+                result[operation] = {
+                    "calls": calls,
+                    "average": total / calls,
+                    "max": most,
+                }
+        return result
+
+
+class MemoryStore(Store):
+    """Keeps the rows in dicts in memory. Lookups by a single column and
+    random picks use an index of the ids for every value of the column,
+    and searches use an inverted index of the words, both built the first
+    time a column is used.
+    """
+    name = "memory"
+
+    def __init__(self):
+        Store.__init__(self)
+        self.tables = {}
+        self.lastIds = {}
+        # Maps (table, column) to dicts mapping values to lists of ids,
+        # and to dicts of search postings.
+        self.indexes = {}
+        self.postings = {}
+        self._lock = threading.RLock()
+
+    def _call(self, operation, func, *args, **kwargs):
+        """Runs an operation with the store locked."""
+        def locked():
+            with self._lock:
+                return func(*args, **kwargs)
+        return self._timed(operation, defer.maybeDeferred(locked))
+
+    def _table(self, table):
+        return self.tables.setdefault(table.name, {})
+
+    def _rowMatches(self, row, where):
+        for column, value in where.items():
+            if isinstance(value, (list, tuple, set)):
+                if row.get(column) not in value:
+                    return False
+            elif row.get(column) != value:
+                return False
+        return True
+
+    def _normalize(self, where):
+        result = {}
+        for column, value in where.items():
+            if isinstance(value, (list, tuple, set)):
+                value = set(decode(v) for v in value)
+            else:
+                value = decode(value)
+            result[column] = value
+        return result
+
+    def _index(self, table, column):
+        key = (table.name, column)
+        index = self.indexes.get(key)
+        if index is None:
+            index = self.indexes[key] = {}
+            rows = self._table(table)
+            for id in sorted(rows):
+                index.setdefault(rows[id].get(column), []).append(id)
+        return index
+
+    def _postings(self, table, column):
+        key = (table.name, column)
+        postings = self.postings.get(key)
+        if postings is None:
+            postings = self.postings[key] = {}
+            for id, row in self._table(table).items():
+                self._addPostings(postings, id, row.get(column))
+        return postings
+
+    def _addPostings(self, postings, id, value):
+        for word in words(value):
+            documents = postings.setdefault(word, {})
+            documents[id] = documents.get(id, 0) + 1
+
+    def _matching(self, table, where):
+        """Returns the ids of the matching rows, in order."""
+        where = self._normalize(where)
+        rows = self._table(table)
+        if not where:
+            return sorted(rows)
+        if "id" in where:
+            value = where.pop("id")
+            if isinstance(value, set):
+                ids = sorted(id for id in value if id in rows)
+            else:
+                ids = [value] if value in rows else []
+        else:
+            # Narrows the rows down by the first column through its index.
+            column = sorted(where)[0]
+            value = where.pop(column)
+            index = self._index(table, column)
+            if isinstance(value, set):
+                ids = sorted(id for v in value for id in index.get(v, ()))
+            else:
+                ids = index.get(value, [])
+        return [id for id in ids if self._rowMatches(rows[id], where)]
+
+    def _added(self, table, rows):
+        """Called with the rows that have been appended."""
+
+    def _removed(self, table, ids):
+        """Called with the ids of the rows that have been deleted or
+        updated, before the updated rows are passed to :meth:`_added`."""
+
+    def _insert(self, table, rows):
+        added = []
+        for row in rows:
+            id = self.lastIds.get(table.name, 0) + 1
+            self.lastIds[table.name] = id
+            row = Row((column.name, decode(row.get(column.name)))
+                      for column in table.columns)
+            row["id"] = id
+            self._table(table)[id] = row
+            self._indexRow(table, row)
+            added.append(row)
+        self._added(table, added)
+        return added
+
+    def _indexRow(self, table, row):
+        for (name, column), index in self.indexes.items():
+            if name == table.name:
+                # Updated rows can come back with a lower id than the
+                # last, and the ids have to stay sorted to be found.
+                insort(index.setdefault(row.get(column), []), row["id"])
+        for (name, column), postings in self.postings.items():
+            if name == table.name:
+                self._addPostings(postings, row["id"], row.get(column))
+
+    def _unindexRow(self, table, row):
+        id = row["id"]
+        for (name, column), index in self.indexes.items():
+            if name != table.name:
+                continue
+            ids = index.get(row.get(column))
+            if ids is not None:
+                i = bisect_left(ids, id)
+                if i < len(ids) and ids[i] == id:
+                    del ids[i]
+                if not ids:
+                    del index[row.get(column)]
+        for (name, column), postings in self.postings.items():
+            if name != table.name:
+                continue
+            for word in set(words(row.get(column))):
+                documents = postings.get(word)
+                if documents is not None:
+                    documents.pop(id, None)
+                    if not documents:
+                        del postings[word]
+
+    def prepare(self, table, pick=(), search=()):
+        def prepare():
+            for column in pick:
+                self._index(table, column)
+            for column in search:
+                self._postings(table, column)
+        return self._call("prepare", prepare)
+
+    def append(self, table, row):
+        return self._call("append",
+                          lambda: self._insert(table, [row])[0]["id"])
+
+    def extend(self, table, rows):
+        return self._call("extend",
+                          lambda: len(self._insert(table, rows)))
+
+    def get(self, table, **where):
+        def get():
+            rows = self._table(table)
+            return [rows[id] for id in self._matching(table, where)]
+        return self._call("get", get)
+
+    def rows(self, table, after=0, limit=None):
+        def rows():
+            rows = self._table(table)
+            ids = sorted(id for id in rows if id > after)
+            if limit is not None:
+                ids = ids[:limit]
+            return [rows[id] for id in ids]
+        return self._call("rows", rows)
+
+    def pick(self, table, **where):
+        if len(where) != 1:
+            raise TypeError("pick() takes a single column")
+
+        def pick():
+            ids = self._matching(table, where)
+            if not ids:
+                return None
+            return self._table(table)[random.choice(ids)]
+        return self._call("pick", pick)
+
+    def search(self, table, column, query, limit=10, offset=0):
+        def search():
+            ranked = rank(self._postings(table, column), query)
+            rows = self._table(table)
+            return len(ranked), [rows[id] for id in
+                                 ranked[offset:offset + limit]]
+        return self._call("search", search)
+
+    def count(self, table, **where):
+        return self._call("count",
+                          lambda: len(self._matching(table, where)))
+
+    def update(self, table, values, **where):
+        def update():
+            rows = self._table(table)
+            ids = self._matching(table, where)
+            self._removed(table, ids)
+            updated = []
+            for id in ids:
+                row = rows[id]
+                self._unindexRow(table, row)
+                row.update((column, decode(value))
+                           for column, value in values.items())
+                self._indexRow(table, row)
+                updated.append(row)
+            self._added(table, updated)
+            return len(ids)
+        return self._call("update", update)
+
+    def delete(self, table, **where):
+        def delete():
+            rows = self._table(table)
+            ids = self._matching(table, where)
+            deleted = []
+            for id in ids:
+                row = rows.pop(id)
+                self._unindexRow(table, row)
+                deleted.append(row)
+            self._removed(table, ids)
+            return deleted
+        return self._call("delete", delete)
+
+
+class ShelveStore(MemoryStore):
+    """A :class:`MemoryStore` that writes every change through to a
+    :mod:`shelve` file, and reads the file back into memory when it is
+    opened. Writes run on the database threads, so that the disk doesn't
+    hold up the reactor.
+
+    :param path: The path of the file.
+    :type path: str
+    :param threadpool: The thread pool that operations are run on.
+    :type threadpool: :class:`twisted.python.threadpool.ThreadPool`
+    """
+    name = "shelve"
+
+    def __init__(self, path, threadpool):
+        MemoryStore.__init__(self)
+        self.path = path
+        self.threadpool = threadpool
+        self.shelf = shelve.open(path, protocol=2)
+        for key in self.shelf.keys():
+            name, id = key.rsplit("/", 1)
+            id = int(id)
+            self.tables.setdefault(name, {})[id] = Row(self.shelf[key])
+            self.lastIds[name] = max(self.lastIds.get(name, 0), id)
+
+    def _call(self, operation, func, *args, **kwargs):
+        def locked():
+            with self._lock:
+                return func(*args, **kwargs)
+        return self._timed(operation, threads.deferToThreadPool(
+            reactor, self.threadpool, locked))
+
+    def _key(self, table, id):
+        # Table names are unicode, the keys of some dbm modules can't be.
+        return "%s/%d" % (table.name.encode("utf-8"), id)
+
+    def _added(self, table, rows):
+        for row in rows:
+            self.shelf[self._key(table, row["id"])] = dict(row)
+        if rows:
+            self.shelf.sync()
+
+    def _removed(self, table, ids):
+        for id in ids:
+            key = self._key(table, id)
+            if key in self.shelf:
+                del self.shelf[key]
+        if ids:
+            self.shelf.sync()
+
+    def close(self):
+        with self._lock:
+            self.shelf.close()
@@ -4,10 +4,12 @@ import re
 import urllib
 
 import bones.event
-from bones.bot import Module
+from bones.bot import LazyImport, Module
 
 
 class NickFix(Module):
+    persistentState = ("nickIWant", "isRecovering")
+
     def __init__(self, *args, **kwargs):
         Module.__init__(self, *args, **kwargs)
         self.nickIWant = None
@@ -15,20 +17,22 @@ class NickFix(Module):
 
     @bones.event.handler(event=bones.event.UserQuitEvent)
     @bones.event.handler(event=bones.event.UserNickChangedEvent)
+    @bones.event.handler(event=bones.event.NetsplitEvent)
     def somethingHappened(self, myEvent):
-        user = None
+        users = None
         if self.nickIWant is None:
-            self.nickIWant = \
-                self.settings.get("bot", "nickname").split("\n")[0]
+            self.nickIWant = myEvent.client.factory.config.nicknames[0]
 
         if isinstance(myEvent, bones.event.UserNickChangedEvent) is True:
-            user = myEvent.oldname
+            users = [myEvent.oldname]
+        elif isinstance(myEvent, bones.event.NetsplitEvent) is True:
+            users = [user.nickname for user in myEvent.users]
         else:
-            user = myEvent.user.nickname
+            users = [myEvent.user.nickname]
 
-        if user.lower() == self.nickIWant.lower():
+        if self.nickIWant.lower() in [user.lower() for user in users]:
             myEvent.client.factory.nicknames = \
-                self.settings.get("bot", "nickname").split("\n")[1:]
+                myEvent.client.factory.config.nicknames[1:]
             self.isRecovering = True
             myEvent.client.setNick(self.nickIWant)
 
@@ -45,6 +49,8 @@ class NickFix(Module):
 
 
 class Ping(Module):
+    persistentState = ("ongoingPings",)
+
     def __init__(self, *args, **kwargs):
         Module.__init__(self, *args, **kwargs)
         self.ongoingPings = {}
@@ -79,10 +85,12 @@ class Twitter(Module):
 
     def __init__(self, *args, **kwargs):
         Module.__init__(self, *args, **kwargs)
-        try:
-            from bs4 import BeautifulSoup
-            self.bs = BeautifulSoup
-        except ImportError:
+        # BeautifulSoup is slow to import, so it's only imported once a link
+        # needs to be parsed.
+        bs = LazyImport("bs4", "BeautifulSoup")
+        if bs.available:
+            self.bs = bs
+        else:
             self.log.warn(
                 "Unmet dependency BeautifulSoup4: The URL checkers will be "
                 "disabled."
@@ -167,10 +175,10 @@ class YouTube(Module):
             self.fetchData = self.fetchData_YouTubeApi
 
         if not self.apikey:
-            try:
-                from bs4 import BeautifulSoup
-                self.bs = BeautifulSoup
-            except ImportError:
+            bs = LazyImport("bs4", "BeautifulSoup")
+            if bs.available:
+                self.bs = bs
+            else:
                 self.log.warn(
                     "Unmet dependency BeautifulSoup4: The URL checkers will "
                     "be disabled."
@@ -0,0 +1,345 @@
+# -*- encoding: utf8 -*-
+"""Runs every network in its own worker process.
+
+The supervisor reads the same configuration file as the bot, and starts one
+worker process per :code:`[server.*]` section, or per group of sections as
+configured in :code:`[supervisor]`. Each worker is a normal bot process
+limited to its servers. Crashed workers are restarted with an exponential
+backoff, and their log output and metrics are collected by the supervisor.
+
+On SIGHUP the supervisor reads the configuration again. Workers are started
+for server sections or groups that were added and stopped for those that
+were removed, and the rest are sent SIGHUP to reload the configuration
+themselves.
+"""
+import os
+import sys
+import json
+import signal
+import logging
+import logging.config
+
+from twisted.internet import defer, protocol, reactor, task
+
+from bones.bot import reconnectDelay
+from bones.config import BaseConfiguration, duration, stringlist
+from bones.__main__ import findServers
+
+
+log = logging.getLogger(__name__)
+
+# The file descriptor that workers write their metrics to, one JSON object
+# per line.
+METRICS_FD = 3
+
+
+def workerGroups(servers, groups):
+    """Splits the server sections between workers.
+
+    :param servers: The names of all the server sections.
+    :type servers: list
+    :param groups: The lines of the :code:`workers` option, each holding the
+        names of servers that should share a worker.
+    :type groups: list
+
+    :returns: A list of lists of server names, one for each worker. Servers
+        that aren't in any group get a worker of their own.
+    """
+    workers = []
+    grouped = set()
+    for line in groups:
+        group = [server for server in line.split() if server in servers
+                 and server not in grouped]
+        if group:
+            workers.append(group)
+            grouped.update(group)
+    for server in servers:
+        if server not in grouped:
+            workers.append([server])
+    return workers
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """Relays the output and metrics of a worker process to its
+    :class:`Worker`."""
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.buffers = {}
+
+    def childDataReceived(self, fd, data):
+        data = self.buffers.get(fd, "") + data
+        lines = data.split("\n")
+        self.buffers[fd] = lines.pop()
+        for line in lines:
+            self.worker.lineReceived(fd, line.rstrip("\r"))
+
+    def processEnded(self, reason):
+        for fd, data in self.buffers.items():
+            if data:
+                self.worker.lineReceived(fd, data)
+        self.buffers = {}
+        self.worker.processEnded(reason)
+
+
+class Worker():
+    """A worker process running the bots for one or more server sections.
+
+    .. attribute:: name
+
+        The name of the worker, made from the names of its servers.
+
+    .. attribute:: servers
+
+        The names of the server sections the worker runs.
+
+    .. attribute:: metrics
+
+        The latest metrics reported by the worker, as a dict mapping server
+        names to dicts of values.
+
+    .. attribute:: restarts
+
+        The number of times the worker has been restarted.
+    """
+
+    def __init__(self, supervisor, servers):
+        self.supervisor = supervisor
+        self.servers = servers
+        self.name = "+".join(servers)
+        self.log = logging.getLogger("%s.%s" % (__name__, self.name))
+        self.process = None
+        self.started = None
+        self.attempts = 0
+        self.restarts = 0
+        self.metrics = {}
+        self.stopping = False
+        self._restartCall = None
+        self._ended = None
+
+    def start(self):
+        self._restartCall = None
+        args = [sys.executable, "-m", "bones", self.supervisor.configFile]
+        args.extend(self.servers)
+        env = dict(os.environ)
+        env["BONES_METRICS_FD"] = str(METRICS_FD)
+        env["BONES_METRICS_INTERVAL"] = str(self.supervisor.metricsInterval)
+        self.log.info("Starting worker for %s", ", ".join(self.servers))
+        self.started = reactor.seconds()
+        self._ended = defer.Deferred()
+        self.process = reactor.spawnProcess(
+            WorkerProtocol(self), sys.executable, args, env=env,
+            childFDs={0: "w", 1: "r", 2: "r", METRICS_FD: "r"},
+        )
+
+    def lineReceived(self, fd, line):
+        if fd == METRICS_FD:
+            try:
+                self.metrics = json.loads(line)
+            except ValueError:
+                self.log.warn("Invalid metrics from worker: %r", line)
+            return
+        if line:
+            # The worker formats its own log records, so they're passed on
+            # as-is.
+            self.log.info("%s", line)
+
+    def processEnded(self, reason):
+        self.process = None
+        ended, self._ended = self._ended, None
+        uptime = reactor.seconds() - self.started
+        if self.stopping or self.supervisor.stopping:
+            self.log.info("Worker stopped")
+        else:
+            # A worker that ran for a while is considered to have been
+            # healthy, so its backoff starts over.
+            if uptime >= self.supervisor.restartMaxDelay:
+                self.attempts = 0
+            self.attempts += 1
+            self.restarts += 1
+            delay = reconnectDelay(self.attempts,
+                                   self.supervisor.restartDelay,
+                                   self.supervisor.restartMaxDelay)
+            self.log.error("Worker exited after %.1f seconds (%s), "
+                           "restarting in %.1f seconds", uptime,
+                           reason.getErrorMessage(), delay)
+            self._restartCall = reactor.callLater(delay, self.start)
+        if ended is not None:
+            ended.callback(None)
+
+    def signal(self, signum):
+        if self.process is not None:
+            try:
+                self.process.signalProcess(signum)
+            except Exception as ex:
+                self.log.exception(ex)
+
+    def stop(self, timeout):
+        """Asks the worker to shut down, and kills it if it hasn't exited
+        within `timeout` seconds.
+
+        :returns: A :class:`~twisted.internet.defer.Deferred` that fires
+            when the worker has exited.
+        """
+        self.stopping = True
+        if self._restartCall is not None and self._restartCall.active():
+            self._restartCall.cancel()
+        if self.process is None:
+            return defer.succeed(None)
+        ended = self._ended
+        self.signal("TERM")
+        kill = reactor.callLater(timeout, self.signal, "KILL")
+        ended.addBoth(lambda result: kill.active() and kill.cancel())
+        return ended
+
+
+class Supervisor():
+    """Starts and watches the worker processes.
+
+    :param configFile: The path to the configuration file, which is passed
+        on to the workers.
+    :type configFile: str
+    :param settings: The loaded configuration.
+    :type settings: :class:`bones.config.BaseConfiguration`
+    """
+
+    def __init__(self, configFile, settings):
+        self.configFile = configFile
+        self.settings = settings
+        self.stopping = False
+        self.configure()
+        self.workers = [Worker(self, servers) for servers in self.groups()]
+        self._reporter = task.LoopingCall(self.reportMetrics)
+
+    def configure(self):
+        """Reads the options in the :code:`[supervisor]` section."""
+        settings = self.settings
+        self.restartDelay = duration(settings.get(
+            "supervisor", "restartDelay", default="1"))
+        self.restartMaxDelay = duration(settings.get(
+            "supervisor", "restartMaxDelay", default="60"))
+        self.stopTimeout = duration(settings.get(
+            "supervisor", "stopTimeout", default="10"))
+        self.metricsInterval = duration(settings.get(
+            "supervisor", "metricsInterval", default="30"))
+        self.metricsFile = settings.get("supervisor", "metricsFile",
+                                        default=None)
+
+    def groups(self):
+        """Returns the lists of server names that the workers should run,
+        as split by :func:`workerGroups`."""
+        groups = stringlist(self.settings.get("supervisor", "workers",
+                                              default=""))
+        return workerGroups(findServers(self.settings), groups)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self._reporter.start(self.metricsInterval, now=False)
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def stop(self):
+        self.stopping = True
+        if self._reporter.running:
+            self._reporter.stop()
+        return defer.DeferredList([
+            worker.stop(self.stopTimeout) for worker in self.workers
+        ])
+
+    def rehash(self):
+        """Reads the configuration again, starts workers for the server
+        groups that were added and stops those of the groups that were
+        removed. SIGHUP is passed on to the other workers so that they
+        reload the configuration too.
+
+        If the configuration can't be read, the old one is kept and
+        nothing changes."""
+        log.info("Reloading configuration from %s", self.configFile)
+        try:
+            self.settings.rehash()
+            self.configure()
+        except Exception:
+            log.exception("Couldn't reload the configuration, keeping the "
+                          "old one")
+            return
+        if self._reporter.running and \
+                self._reporter.interval != self.metricsInterval:
+            self._reporter.stop()
+            self._reporter.start(self.metricsInterval, now=False)
+
+        groups = self.groups()
+        workers = []
+        for worker in self.workers:
+            if worker.servers in groups:
+                worker.signal("HUP")
+                workers.append(worker)
+            else:
+                worker.log.info("Servers were removed or regrouped, "
+                                "stopping worker")
+                worker.stop(self.stopTimeout)
+        running = [worker.servers for worker in workers]
+        for servers in groups:
+            if servers not in running:
+                worker = Worker(self, servers)
+                worker.start()
+                workers.append(worker)
+        self.workers = workers
+
+    def metrics(self):
+        """Returns the metrics of all the workers, as a dict mapping worker
+        names to their state, restart count and reported metrics."""
+        return dict(
+            (worker.name, {
+                "running": worker.process is not None,
+                "restarts": worker.restarts,
+                "servers": worker.metrics,
+            })
+            for worker in self.workers
+        )
+
+    def reportMetrics(self):
+        metrics = self.metrics()
+        running = len([m for m in metrics.values() if m["running"]])
+        log.info("%d of %d workers running, %d restarts", running,
+                 len(metrics), sum(m["restarts"] for m in metrics.values()))
+        for name, worker in sorted(metrics.items()):
+            for server, values in sorted(worker["servers"].items()):
+                log.debug("%s: %s", server, ", ".join(
+                    "%s=%s" % item for item in sorted(values.items())
+                ))
+        if self.metricsFile:
+            tmp = "%s.tmp" % self.metricsFile
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(metrics, f)
+                os.rename(tmp, self.metricsFile)
+            except (IOError, OSError) as ex:
+                log.exception(ex)
+
+
+def main():
+    try:
+        logging.config.fileConfig(sys.argv[1])
+    except Exception, ex:
+        import traceback
+        traceback.print_exc()
+        print "-" * 10
+        print "Couldn't load logger configuration:"
+        print ex.message
+        raise SystemExit()
+    settings = BaseConfiguration(sys.argv[1])
+    supervisor = Supervisor(sys.argv[1], settings)
+    if not supervisor.workers:
+        log.error("No server sections found in your configuration file!")
+        raise SystemExit
+
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(
+            signal.SIGHUP,
+            lambda signum, frame: reactor.callFromThread(supervisor.rehash)
+        )
+    supervisor.start()
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,494 @@
+# -*- encoding: utf8 -*-
+"""Runs :term:`Bones modules` in a separate worker process.
+
+Modules listed in the :code:`processModules` option aren't loaded into the
+bot. Instead a :class:`RemoteModule` is registered for the events and
+triggers they handle, and sends those events to a worker process over AMP
+on a Unix socket. The worker loads the module as usual, and the messages it
+sends through :code:`event.client`, :code:`event.channel` or
+:code:`event.user` are sent back and performed by the bot. This keeps
+CPU-heavy handlers from holding up the connection.
+
+Events are copied to the worker, so a module running in a worker only sees
+a snapshot of the users and channels in them: a channel has its name, modes
+and topic but no user list. The :code:`match` of a trigger event becomes a
+:class:`RemoteMatch` with only the groups, and other attributes that can't
+be encoded as JSON become :code:`None`. Calls made on :code:`event.client`
+are performed by the bot without waiting, and always return :code:`None`.
+Modules that need more than that should be loaded normally.
+"""
+import os
+import re
+import sys
+import json
+import types
+import shutil
+import logging
+import logging.config
+import tempfile
+import urllib2
+from collections import deque
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.protocols import amp
+
+import bones.bot
+import bones.event
+from bones.config import BaseConfiguration
+
+
+log = logging.getLogger(__name__)
+
+MatchType = type(re.match("", ""))
+
+
+class Deliver(amp.Command):
+    """Sent to the worker with an event to pass to the module."""
+    arguments = [("event", amp.String()), ("args", amp.String())]
+    response = []
+    requiresAnswer = False
+
+
+class ClientCall(amp.Command):
+    """Sent to the bot with a method that should be called on the
+    client."""
+    arguments = [("method", amp.String()), ("args", amp.String())]
+    response = []
+    requiresAnswer = False
+
+
+class Ping(amp.Command):
+    """Sent to the worker to check that it is still responsive."""
+    arguments = []
+    response = []
+
+
+def encodeEventKey(event):
+    """Turns an event identifier into a string."""
+    if isinstance(event, basestring):
+        return "trigger:%s" % event
+    return "class:%s.%s" % (event.__module__, event.__name__)
+
+
+def decodeEventKey(data):
+    """Turns a string from :func:`encodeEventKey` back into an event
+    identifier."""
+    kind, name = data.split(":", 1)
+    if kind == "trigger":
+        return name
+    module, name = name.rsplit(".", 1)
+    return getattr(__import__(module, fromlist=[name]), name)
+
+
+class RemoteMatch():
+    """Stands in for the regex match object of a
+    :class:`~bones.event.TriggerEvent` in a worker. Only the matched text
+    and the groups are kept.
+
+    :param groups: The whole match followed by the values of the groups.
+    :type groups: list
+    :param named: A dict mapping the names of the named groups to their
+        values.
+    :type named: dict
+    """
+
+    def __init__(self, groups, named):
+        self._groups = groups
+        self._named = named
+
+    def group(self, *groups):
+        """Returns the value of a group by number or name, or a tuple of
+        the values of several. Group 0 is the whole match."""
+        values = tuple(self._named[group] if isinstance(group, basestring)
+                       else self._groups[group] for group in groups or (0,))
+        return values[0] if len(values) == 1 else values
+
+    def groups(self, default=None):
+        """Returns a tuple of the values of all the groups."""
+        return tuple(default if value is None else value
+                     for value in self._groups[1:])
+
+    def groupdict(self, default=None):
+        """Returns a dict mapping the names of the named groups to their
+        values."""
+        return dict((name, default if value is None else value)
+                    for name, value in self._named.items())
+
+
+def serialize(value):
+    """Converts the arguments of an event into data that can be encoded as
+    JSON. Users, channels, topics, events, regex matches and the client are
+    replaced by tagged dicts, and anything else that can't be encoded
+    becomes :code:`None`."""
+    if value is None or isinstance(value, (bool, int, long, float,
+                                           basestring)):
+        return value
+    if isinstance(value, (list, tuple, set, frozenset, deque)):
+        return [serialize(v) for v in value]
+    if isinstance(value, dict):
+        return dict((str(k), serialize(v)) for k, v in value.items())
+    if isinstance(value, bones.bot.BonesBot):
+        return {"__client__": True}
+    if isinstance(value, bones.event.User):
+        return {"__user__": {
+            "mask": value.mask if "!" in value.mask else value.nickname,
+            "username": value.username,
+            "hostname": value.hostname,
+            "account": value.account,
+            "realname": value.realname,
+        }}
+    if isinstance(value, bones.event.Channel):
+        return {"__channel__": {
+            "name": value.name,
+            "modes": serialize(value.modes),
+            "topic": serialize(value.topic),
+        }}
+    if isinstance(value, bones.event.Topic):
+        return {"__topic__": [value.text, serialize(value.user)]}
+    if isinstance(value, (RemoteMatch, MatchType)):
+        return {"__match__": [list((value.group(),) + value.groups()),
+                              value.groupdict()]}
+    if isinstance(value, bones.event.Event):
+        return {"__event__": [
+            encodeEventKey(value.__class__), serialize(value.__dict__)
+        ]}
+    return None
+
+
+def deserialize(data, client):
+    """Turns data from :func:`serialize` back into objects, with `client`
+    standing in for the bot."""
+    if isinstance(data, unicode):
+        return data.encode("utf-8")
+    if isinstance(data, list):
+        return [deserialize(v, client) for v in data]
+    if not isinstance(data, dict):
+        return data
+    if "__client__" in data:
+        return client
+    if "__user__" in data:
+        info = bones.bot.encodeStrings(data["__user__"])
+        user = bones.event.User(info["mask"], client)
+        user.username = info["username"]
+        user.hostname = info["hostname"]
+        user.account = info["account"]
+        user.realname = info["realname"]
+        return user
+    if "__channel__" in data:
+        info = data["__channel__"]
+        channel = bones.event.Channel(info["name"].encode("utf-8"), client)
+        channel.modes = deserialize(info["modes"], client)
+        channel.topic = deserialize(info["topic"], client)
+        return channel
+    if "__topic__" in data:
+        text, user = data["__topic__"]
+        return bones.event.Topic(deserialize(text, client),
+                                 deserialize(user, client))
+    if "__match__" in data:
+        # The groups are left as unicode, as they are in the bot.
+        groups, named = data["__match__"]
+        return RemoteMatch(groups, dict((k.encode("utf-8"), v)
+                                        for k, v in named.items()))
+    if "__event__" in data:
+        key, attributes = data["__event__"]
+        klass = decodeEventKey(key)
+        # The event is filled in without calling its constructor.
+        if isinstance(klass, types.ClassType):
+            event = types.InstanceType(klass)
+        else:
+            event = klass.__new__(klass)
+        event.__dict__.update(deserialize(attributes, client))
+        return event
+    return dict((k.encode("utf-8"), deserialize(v, client))
+                for k, v in data.items())
+
+
+class RemoteModule():
+    """Stands in for a :term:`Bones module` that runs in a worker process,
+    and passes the events it handles on to it. The worker is restarted with
+    a backoff if it exits, or if it doesn't answer a ping within
+    :code:`processModuleTimeout` seconds.
+
+    :param factory: The bot factory the module is loaded by.
+    :type factory: :class:`bones.bot.BonesBotFactory`
+    :param path: The Python dot-notation path to the module.
+    :type path: str
+
+    .. attribute:: events
+
+        The event identifiers of the events and triggers that the module
+        handles.
+
+    .. attribute:: queue
+
+        Events waiting to be sent while the worker is starting. Only the
+        latest :attr:`queueSize` events are kept.
+    """
+
+    # Events are never held back from the stand-in, as the worker sets the
+    # module up by itself.
+    ready = True
+    queueSize = 100
+
+    def __init__(self, factory, path, events):
+        self.factory = factory
+        self.path = path
+        self.name = path
+        self.events = events
+        self.queue = deque(maxlen=self.queueSize)
+        self.connection = None
+        self.process = None
+        self.attempts = 0
+        self.stopping = False
+        self._directory = tempfile.mkdtemp(prefix="bones-")
+        self._socket = os.path.join(self._directory, "worker.sock")
+        self._port = None
+        self._started = None
+        self._restartCall = None
+        self._pinger = task.LoopingCall(self.ping)
+        self._pinging = None
+
+    @staticmethod
+    def handlerFor(event):
+        key = encodeEventKey(event)
+
+        def handler(self, *args, **kwargs):
+            data = json.dumps(serialize(args))
+            reactor.callFromThread(self.send, key, data)
+        return handler
+
+    def start(self):
+        """Starts listening on the socket and spawns the worker."""
+        self._restartCall = None
+        if self._port is None:
+            serverFactory = protocol.ServerFactory()
+            serverFactory.protocol = lambda: ParentProtocol(self)
+            self._port = reactor.listenUNIX(self._socket, serverFactory)
+        args = [sys.executable, "-m", "bones.worker", self._socket,
+                self.factory.settings.config.file, self.factory.tag,
+                self.path]
+        log.info("{%s} Starting worker for module %s", self.factory.tag,
+                 self.path)
+        self._started = reactor.seconds()
+        self.process = reactor.spawnProcess(
+            WorkerProcessProtocol(self), sys.executable, args,
+            env=os.environ, childFDs={0: "w", 1: 1, 2: 2},
+        )
+
+    def stop(self):
+        """Stops the worker for good."""
+        self.stopping = True
+        if self._restartCall is not None and self._restartCall.active():
+            self._restartCall.cancel()
+        if self._pinger.running:
+            self._pinger.stop()
+        if self.process is not None:
+            self.process.signalProcess("TERM")
+        if self._port is not None:
+            self._port.stopListening()
+            self._port = None
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def connected(self, connection):
+        self.connection = connection
+        log.info("{%s} Worker for module %s is ready", self.factory.tag,
+                 self.path)
+        interval = self.factory.config.processModuleTimeout / 3
+        self._pinger.start(interval, now=False)
+        while self.queue:
+            self.send(*self.queue.popleft())
+
+    def disconnected(self):
+        self.connection = None
+        self._pinging = None
+        if self._pinger.running:
+            self._pinger.stop()
+        # Make sure the worker is gone, so that it can be started again.
+        if self.process is not None:
+            try:
+                self.process.signalProcess("KILL")
+            except Exception:
+                pass
+
+    def processEnded(self, reason):
+        self.process = None
+        if self.stopping:
+            return
+        uptime = reactor.seconds() - self._started
+        if uptime >= self.factory.config.reconnectMaxDelay:
+            self.attempts = 0
+        self.attempts += 1
+        delay = bones.bot.reconnectDelay(
+            self.attempts, self.factory.config.reconnectDelay,
+            self.factory.config.reconnectMaxDelay
+        )
+        log.error("{%s} Worker for module %s exited (%s), restarting in "
+                  "%.1f seconds", self.factory.tag, self.path,
+                  reason.getErrorMessage(), delay)
+        self._restartCall = reactor.callLater(delay, self.start)
+
+    def send(self, event, args):
+        if self.connection is None:
+            self.queue.append((event, args))
+            return
+        self.connection.callRemote(Deliver, event=event, args=args)
+
+    def ping(self):
+        if self._pinging is not None:
+            if reactor.seconds() - self._pinging < \
+                    self.factory.config.processModuleTimeout:
+                return
+            log.error("{%s} Worker for module %s stopped responding, "
+                      "killing it", self.factory.tag, self.path)
+            self.connection.transport.loseConnection()
+            self.disconnected()
+            return
+        self._pinging = reactor.seconds()
+
+        def answered(result):
+            self._pinging = None
+        d = self.connection.callRemote(Ping)
+        d.addCallback(answered)
+        # An unanswered ping is handled by the next one, so failures are
+        # only logged.
+        d.addErrback(lambda failure: log.debug(
+            "{%s} Ping to worker for module %s failed: %s",
+            self.factory.tag, self.path, failure.getErrorMessage()
+        ))
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, module):
+        self.module = module
+
+    def processEnded(self, reason):
+        self.module.processEnded(reason)
+
+
+class ParentProtocol(amp.AMP):
+    """The bot's end of the connection to a worker."""
+
+    def __init__(self, module):
+        amp.AMP.__init__(self)
+        self.module = module
+
+    def connectionMade(self):
+        amp.AMP.connectionMade(self)
+        self.module.connected(self)
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        if self.module.connection is self:
+            self.module.disconnected()
+
+    @ClientCall.responder
+    def clientCall(self, method, args):
+        client = self.module.factory.client
+        if client is None or method.startswith("_"):
+            return {}
+        args, kwargs = bones.bot.encodeStrings(json.loads(args))
+        try:
+            getattr(client, method)(*args, **kwargs)
+        except Exception as ex:
+            log.exception(ex)
+        return {}
+
+
+class ClientProxy():
+    """Stands in for the :class:`~bones.bot.BonesBot` client in a worker.
+    Calling a method on it makes the bot call the same method on the real
+    client."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.tag = factory.tag
+        self.nickname = factory.nickname
+        self.connection = None
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            data = json.dumps([serialize(args), serialize(kwargs)])
+            reactor.callFromThread(self._call, name, data)
+        return call
+
+    def _call(self, method, data):
+        if self.connection is not None:
+            self.connection.callRemote(ClientCall, method=method, args=data)
+
+
+class WorkerProtocol(amp.AMP):
+    """The worker's end of the connection to the bot."""
+
+    def __init__(self, bot):
+        amp.AMP.__init__(self)
+        # Not called factory, as buildProtocol() overwrites that.
+        self.bot = bot
+
+    def connectionMade(self):
+        amp.AMP.connectionMade(self)
+        self.bot.client.connection = self
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        # Without the bot there's nothing left to do.
+        if reactor.running:
+            reactor.stop()
+
+    @Deliver.responder
+    def deliver(self, event, args):
+        event = decodeEventKey(event)
+        args = deserialize(json.loads(args), self.bot.client)
+        bones.event.fire(self.bot.tag, event, *args)
+        return {}
+
+    @Ping.responder
+    def ping(self):
+        return {}
+
+
+class WorkerFactory(bones.bot.BonesBotFactory):
+    """A bot factory that only loads a single module, and doesn't connect
+    anywhere. The module is given a :class:`ClientProxy` as the client."""
+
+    def __init__(self, settings, path):
+        self.tag = settings.server
+        self.settings = settings
+        self.config = settings.compile(self.configSchema)
+        self.modules = []
+        self.lazyModules = {}
+        self.remoteModules = {}
+        self.moduleLoadTimes = {}
+        self.nicknames = list(self.config.nicknames)
+        self.nickname = self.nicknames.pop(0)
+        self.reconnect = False
+        self.urlopener = urllib2.build_opener()
+        self.urlopener.addheaders = [
+            ('User-agent', 'urllib/2 BonesIRCBot/%s' % self.versionNum)
+        ]
+        self.client = ClientProxy(self)
+        self._modulesSetUp = False
+        self.loadModule(path)
+        self._modulesSetUp = True
+        self.modulesReady = self.setupModules()
+
+
+def main():
+    socket, configFile, server, path = sys.argv[1:5]
+    try:
+        logging.config.fileConfig(configFile)
+    except Exception:
+        logging.basicConfig()
+    settings = BaseConfiguration(configFile).server(server)
+    factory = WorkerFactory(settings, path)
+    clientFactory = protocol.ClientFactory()
+    clientFactory.protocol = lambda: WorkerProtocol(factory)
+    clientFactory.clientConnectionFailed = \
+        lambda connector, reason: reactor.stop()
+    reactor.connectUNIX(socket, clientFactory)
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
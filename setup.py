@@ -38,6 +38,8 @@ bot development using modules able to handle e.g. triggers and such.""",
     entry_points={
         "console_scripts": [
             'bones = bones.__main__:main',
+            'bones-supervisor = bones.supervisor:main',
+            'bones-data = bones.data:main',
         ],
     },
 )